@@ -4,9 +4,21 @@ from dataclasses import dataclass
 from pathlib import Path
 import shutil
 
+import yaml
+
+from md2docx.cache import RenderCache
 from md2docx.preprocess import preprocess_markdown
-from md2docx.pandoc import run_pandoc_to_docx
-from md2docx.docxops import assemble_final_docx
+from md2docx.scheduler import RenderLimits
+from md2docx.sections import convert_sections
+from md2docx.pandoc import prepare_reference_doc, run_pandoc_to_docx
+from md2docx.docxops import BodyPackage, assemble_final_docx, prepare_template_skeleton
+from md2docx.mediaopt import MediaReport
+from md2docx.native import render_markdown_to_body
+
+
+# "pandoc" converts processed.md with pandoc; "native" builds the body in
+# memory (md2docx.native) and skips the intermediate body.docx.
+BUILD_BACKENDS = ("pandoc", "native")
 
 
 @dataclass(frozen=True)
@@ -25,7 +37,23 @@ def build_docx(
     output_docx: Path,
     workdir: Path,
     keep_workdir: bool,
-) -> None:
+    cache: RenderCache | None = None,
+    render_limits: RenderLimits | None = None,
+    code_figures: str | None = None,
+    diagram_format: str | None = None,
+    optimize_media: bool = False,
+    image_dpi: int | None = None,
+    figure_dpi: int | None = None,
+    backend: str | None = None,
+    split_sections: bool = False,
+    package_jobs: int | None = None,
+    low_memory: bool = False,
+) -> MediaReport | None:
+    meta = _load_meta(meta_path)
+    backend = backend or str(meta.get("backend", "pandoc"))
+    if backend not in BUILD_BACKENDS:
+        raise RuntimeError(f"Unknown backend: {backend} (expected one of {', '.join(BUILD_BACKENDS)})")
+
     if workdir.exists():
         shutil.rmtree(workdir)
     workdir.mkdir(parents=True, exist_ok=True)
@@ -40,25 +68,78 @@ def build_docx(
         input_md=input_md,
         out_dir=workdir,
         media_dir=media_dir,
+        cache=cache,
+        limits=render_limits,
+        code_figures=code_figures or str(meta.get("code_figures", "image")),
+        diagram_format=diagram_format or str(meta.get("diagram_format", "png")),
+        figure_dpi=figure_dpi or _meta_dpi(meta, "figure_dpi"),
     )
     processed_md.write_text(processed.markdown, encoding="utf-8")
 
-    run_pandoc_to_docx(
-        input_md=processed_md,
-        output_docx=body_docx,
-        reference_doc=template_docx,
-        # NOTE: when we render Mermaid we reference images under the workdir.
-        # Pandoc will only resolve them if the workdir is in --resource-path.
-        resource_paths=[processed_md.parent, input_md.parent, input_md.parent.parent],
-    )
+    # NOTE: when we render Mermaid we reference images under the workdir.
+    # Pandoc will only resolve them if the workdir is in --resource-path.
+    resource_paths = [processed_md.parent, input_md.parent, input_md.parent.parent]
+    body: Path | BodyPackage
+    if backend == "native":
+        body = render_markdown_to_body(
+            processed.markdown, template_docx=template_docx, resource_paths=resource_paths
+        )
+    elif split_sections or meta.get("split_sections"):
+        # One pandoc run per Heading 1 section, in parallel and cached.
+        body = convert_sections(
+            processed.markdown,
+            workdir=workdir,
+            reference_doc=prepare_reference_doc(template_docx=template_docx, workdir=workdir, cache=cache),
+            resource_paths=resource_paths,
+            cache=cache,
+            limits=render_limits or RenderLimits(),
+        )
+    else:
+        run_pandoc_to_docx(
+            input_md=processed_md,
+            output_docx=body_docx,
+            reference_doc=prepare_reference_doc(template_docx=template_docx, workdir=workdir, cache=cache),
+            resource_paths=resource_paths,
+        )
+        body = body_docx
 
-    assemble_final_docx(
+    media_report = assemble_final_docx(
         template_docx=template_docx,
-        body_docx=body_docx,
+        skeleton=prepare_template_skeleton(template_docx=template_docx, workdir=workdir, cache=cache),
+        body_docx=body,
         output_docx=output_docx,
         meta_path=meta_path,
         sources_path=sources_path,
+        svg_images=processed.svg_images,
+        optimize_images=optimize_media,
+        image_dpi=image_dpi or _meta_dpi(meta, "image_dpi"),
+        package_jobs=package_jobs,
+        low_memory=low_memory or bool(meta.get("low_memory")),
     )
 
+    if cache is not None:
+        cache.prune()
+
     if not keep_workdir:
         shutil.rmtree(workdir)
+
+    return media_report
+
+
+def _meta_dpi(meta: dict, key: str) -> int | None:
+    raw = meta.get(key)
+    if raw is None:
+        return None
+    try:
+        dpi = int(raw)
+    except (TypeError, ValueError):
+        dpi = 0
+    if dpi <= 0:
+        raise RuntimeError(f"Invalid {key} in meta.yaml: {raw!r} (expected a positive integer)")
+    return dpi
+
+
+def _load_meta(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    return yaml.safe_load(path.read_text(encoding="utf-8")) or {}
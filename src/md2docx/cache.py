@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+
+# Defaults for the persistent render cache. Entries are touched on every hit,
+# so age-based eviction drops figures that have not been used in a while.
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_AGE_DAYS = 30
+
+
+def default_cache_dir() -> Path:
+    env = os.environ.get("MD2DOCX_CACHE_DIR")
+    if env:
+        return Path(env).expanduser()
+    xdg = os.environ.get("XDG_CACHE_HOME")
+    base = Path(xdg).expanduser() if xdg else Path.home() / ".cache"
+    return base / "md2docx"
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    root: Path
+    entries: int
+    total_bytes: int
+    oldest: float | None
+    newest: float | None
+
+    def to_text(self) -> str:
+        lines = [
+            f"Cache: {self.root}",
+            f"Entries: {self.entries}",
+            f"Size: {self.total_bytes / (1024 * 1024):.1f} MB",
+        ]
+        if self.oldest is not None:
+            lines.append(f"Oldest: {time.strftime('%Y-%m-%d %H:%M', time.localtime(self.oldest))}")
+        if self.newest is not None:
+            lines.append(f"Newest: {time.strftime('%Y-%m-%d %H:%M', time.localtime(self.newest))}")
+        return "\n".join(lines)
+
+
+class RenderCache:
+    """Content-addressed on-disk store for rendered artifacts.
+
+    Keys are sha256 digests of the renderer identity (tool version, options)
+    plus the figure source, so a cached file is only reused when the exact
+    same renderer would have produced it.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        *,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_age_days: float = DEFAULT_MAX_AGE_DAYS,
+    ) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            data = part.encode("utf-8")
+            h.update(str(len(data)).encode("ascii"))
+            h.update(b":")
+            h.update(data)
+        return h.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def fetch(self, key: str, dest: Path) -> bool:
+        """Copy the cached entry to `dest`. Returns False on a miss."""
+        src = self._entry_path(key)
+        if not src.is_file():
+            return False
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            shutil.copyfile(src, dest)
+            os.utime(src)
+        except OSError:
+            return False
+        return True
+
+    def store(self, key: str, src: Path) -> None:
+        """Atomically copy `src` into the cache under `key`."""
+        dst = self._entry_path(key)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except OSError:
+            Path(tmp).unlink(missing_ok=True)
+
+    def _entries(self) -> list[tuple[Path, os.stat_result]]:
+        out: list[tuple[Path, os.stat_result]] = []
+        if not self.root.exists():
+            return out
+        for shard in self.root.iterdir():
+            if not shard.is_dir() or len(shard.name) != 2:
+                continue
+            for p in shard.iterdir():
+                if p.name.startswith(".tmp-") or not p.is_file():
+                    continue
+                try:
+                    out.append((p, p.stat()))
+                except OSError:
+                    continue
+        return out
+
+    def stats(self) -> CacheStats:
+        entries = self._entries()
+        mtimes = [st.st_mtime for _, st in entries]
+        return CacheStats(
+            root=self.root,
+            entries=len(entries),
+            total_bytes=sum(st.st_size for _, st in entries),
+            oldest=min(mtimes) if mtimes else None,
+            newest=max(mtimes) if mtimes else None,
+        )
+
+    def prune(self) -> int:
+        """Evict stale entries, then least recently used ones until under max_bytes.
+
+        Returns the number of removed entries.
+        """
+        removed = 0
+        cutoff = time.time() - self.max_age_days * 86400
+        kept: list[tuple[Path, os.stat_result]] = []
+        for p, st in self._entries():
+            if st.st_mtime < cutoff:
+                p.unlink(missing_ok=True)
+                removed += 1
+            else:
+                kept.append((p, st))
+
+        total = sum(st.st_size for _, st in kept)
+        kept.sort(key=lambda item: item[1].st_mtime)
+        for p, st in kept:
+            if total <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= st.st_size
+            removed += 1
+        return removed
+
+    def clear(self) -> int:
+        entries = self._entries()
+        for p, _ in entries:
+            p.unlink(missing_ok=True)
+        return len(entries)
@@ -4,7 +4,13 @@ import argparse
 from pathlib import Path
 import sys
 
-from md2docx.build import build_docx
+from md2docx.build import BUILD_BACKENDS, build_docx
+from md2docx.cache import DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_BYTES, RenderCache, default_cache_dir
+from md2docx.mermaid import MERMAID_DAEMON_DEFAULT_PORT, run_mermaid_daemon
+from md2docx.plantuml import PLANTUML_SERVER_DEFAULT_PORT, run_plantuml_server
+from md2docx.pandoc import PANDOC_SERVER_DEFAULT_PORT, PANDOC_SERVER_DEFAULT_TIMEOUT_S, run_pandoc_server
+from md2docx.preprocess import CODE_FIGURE_MODES, DIAGRAM_FORMATS
+from md2docx.scheduler import RenderLimits
 from md2docx.validate import validate_project
 
 
@@ -12,6 +18,35 @@ def _path(p: str) -> Path:
     return Path(p).expanduser().resolve()
 
 
+def _render_cache(args: argparse.Namespace) -> RenderCache:
+    return RenderCache(
+        args.cache_dir,
+        max_bytes=int(args.cache_max_size * 1024 * 1024),
+        max_age_days=args.cache_max_age,
+    )
+
+
+def _add_cache_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument(
+        "--cache-dir",
+        type=_path,
+        default=default_cache_dir(),
+        help="Render cache directory (default: $MD2DOCX_CACHE_DIR or ~/.cache/md2docx)",
+    )
+    p.add_argument(
+        "--cache-max-size",
+        type=float,
+        default=DEFAULT_MAX_BYTES / (1024 * 1024),
+        help="Evict least recently used entries above this size (MB)",
+    )
+    p.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=DEFAULT_MAX_AGE_DAYS,
+        help="Evict entries unused for this many days",
+    )
+
+
 def main(argv: list[str] | None = None) -> int:
     parser = argparse.ArgumentParser(prog="md2docx")
     sub = parser.add_subparsers(dest="cmd", required=True)
@@ -43,6 +78,125 @@ def main(argv: list[str] | None = None) -> int:
         action="store_true",
         help="Do not delete intermediate artifacts",
     )
+    p_build.add_argument(
+        "--backend",
+        choices=BUILD_BACKENDS,
+        default=None,
+        help="Convert the markdown body with pandoc or with the built-in writer, which needs no pandoc "
+        "(default: meta.yaml backend or pandoc)",
+    )
+    p_build.add_argument(
+        "--split-sections",
+        action="store_true",
+        help="Run pandoc per Heading 1 section in parallel and cache each section "
+        "(default: meta.yaml split_sections)",
+    )
+    p_build.add_argument(
+        "--code-figures",
+        choices=CODE_FIGURE_MODES,
+        default=None,
+        help="Render code figures as PNG images or native Word text (default: meta.yaml code_figures or image)",
+    )
+    p_build.add_argument(
+        "--diagram-format",
+        choices=DIAGRAM_FORMATS,
+        default=None,
+        help="Embed Mermaid/PlantUML diagrams as PNG or as SVG with a PNG fallback "
+        "(default: meta.yaml diagram_format or png)",
+    )
+    p_build.add_argument(
+        "--optimize-media",
+        action="store_true",
+        help="Recompress PNG images (palette for flat diagrams, JPEG for photos) and report the bytes saved",
+    )
+    p_build.add_argument(
+        "--figure-dpi",
+        type=int,
+        default=None,
+        help="Render Mermaid/PlantUML PNGs for this DPI at the maximum figure width "
+        "(default: meta.yaml figure_dpi, or the fixed renderer resolution)",
+    )
+    p_build.add_argument(
+        "--image-dpi",
+        type=int,
+        default=None,
+        help="Downsample raster images to this DPI at their displayed size, e.g. 150 or 220 "
+        "(default: meta.yaml image_dpi, or keep full resolution)",
+    )
+    p_build.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always re-render figures instead of using the render cache",
+    )
+    _add_cache_args(p_build)
+    defaults = RenderLimits()
+    p_build.add_argument(
+        "--mermaid-jobs",
+        type=int,
+        default=defaults.mermaid,
+        help="Concurrent Mermaid renders (each one runs a Chromium)",
+    )
+    p_build.add_argument(
+        "--plantuml-jobs",
+        type=int,
+        default=defaults.plantuml,
+        help="Concurrent PlantUML renders (each one runs a JVM)",
+    )
+    p_build.add_argument(
+        "--code-jobs",
+        type=int,
+        default=defaults.code,
+        help="Concurrent code snippet renders",
+    )
+    p_build.add_argument(
+        "--pandoc-jobs",
+        type=int,
+        default=defaults.pandoc,
+        help="Concurrent pandoc section conversions (with --split-sections)",
+    )
+    p_build.add_argument(
+        "--package-jobs",
+        type=int,
+        default=None,
+        help="Threads that serialize and compress the output parts (default: one per CPU)",
+    )
+    p_build.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Assemble very large documents with less memory: move the body instead of copying it "
+        "and stream document.xml into the package (default: meta.yaml low_memory)",
+    )
+
+    p_cache = sub.add_parser("cache", help="Inspect or clean the figure render cache")
+    p_cache.add_argument("action", choices=["stats", "prune", "clear"])
+    _add_cache_args(p_cache)
+
+    p_daemon = sub.add_parser(
+        "mermaid-daemon",
+        help="Run a persistent Mermaid renderer (set MD2DOCX_MERMAID_DAEMON=host:port to use it)",
+    )
+    p_daemon.add_argument("--host", default="127.0.0.1")
+    p_daemon.add_argument("--port", type=int, default=MERMAID_DAEMON_DEFAULT_PORT)
+    p_daemon.add_argument("--pages", type=int, default=4, help="Maximum concurrent browser pages")
+
+    p_puml = sub.add_parser(
+        "plantuml-server",
+        help="Run a local PlantUML server (set MD2DOCX_PLANTUML_SERVER=http://host:port/plantuml to use it)",
+    )
+    p_puml.add_argument("--host", default="127.0.0.1")
+    p_puml.add_argument("--port", type=int, default=PLANTUML_SERVER_DEFAULT_PORT)
+
+    p_pandoc = sub.add_parser(
+        "pandoc-server",
+        help="Run a local pandoc server (set MD2DOCX_PANDOC_SERVER=http://host:port to use it)",
+    )
+    p_pandoc.add_argument("--port", type=int, default=PANDOC_SERVER_DEFAULT_PORT)
+    p_pandoc.add_argument(
+        "--timeout",
+        type=int,
+        default=PANDOC_SERVER_DEFAULT_TIMEOUT_S,
+        help="Maximum seconds per conversion",
+    )
 
     args = parser.parse_args(argv)
 
@@ -59,7 +213,7 @@ def main(argv: list[str] | None = None) -> int:
                 return 2
 
             args.output.parent.mkdir(parents=True, exist_ok=True)
-            build_docx(
+            media_report = build_docx(
                 input_md=args.input,
                 template_docx=args.template,
                 meta_path=args.meta,
@@ -67,10 +221,47 @@ def main(argv: list[str] | None = None) -> int:
                 output_docx=args.output,
                 workdir=args.workdir,
                 keep_workdir=args.keep_workdir,
+                cache=None if args.no_cache else _render_cache(args),
+                render_limits=RenderLimits(
+                    mermaid=args.mermaid_jobs,
+                    plantuml=args.plantuml_jobs,
+                    code=args.code_jobs,
+                    pandoc=args.pandoc_jobs,
+                ),
+                code_figures=args.code_figures,
+                diagram_format=args.diagram_format,
+                optimize_media=args.optimize_media,
+                image_dpi=args.image_dpi,
+                figure_dpi=args.figure_dpi,
+                backend=args.backend,
+                split_sections=args.split_sections,
+                package_jobs=args.package_jobs,
+                low_memory=args.low_memory,
             )
+            if media_report is not None:
+                sys.stdout.write(media_report.to_text() + "\n")
             sys.stdout.write(f"OK: wrote {args.output}\n")
             return 0
 
+        if args.cmd == "cache":
+            cache = _render_cache(args)
+            if args.action == "stats":
+                sys.stdout.write(cache.stats().to_text() + "\n")
+            elif args.action == "prune":
+                sys.stdout.write(f"Removed {cache.prune()} entries\n")
+            else:
+                sys.stdout.write(f"Removed {cache.clear()} entries\n")
+            return 0
+
+        if args.cmd == "mermaid-daemon":
+            return run_mermaid_daemon(host=args.host, port=args.port, pages=args.pages)
+
+        if args.cmd == "plantuml-server":
+            return run_plantuml_server(host=args.host, port=args.port)
+
+        if args.cmd == "pandoc-server":
+            return run_pandoc_server(port=args.port, timeout=args.timeout)
+
         raise RuntimeError(f"Unknown command: {args.cmd}")
     except Exception as e:
         sys.stderr.write(f"ERROR: {e}\n")
@@ -1,18 +1,93 @@
+from functools import lru_cache
 from pathlib import Path
+import threading
 
+import pygments
 from pygments import highlight
 from pygments.formatters.img import ImageFormatter
+from pygments.lexer import Lexer
 from pygments.lexers import TextLexer, get_lexer_by_name
 from pygments.util import ClassNotFound
 
 
+# Pygments style shared by PNG snippets and native Word code blocks.
+CODE_STYLE = "xcode"
+
+
+class _ReusableImageFormatter(ImageFormatter):
+    # ImageFormatter only initializes its draw list in __init__, so reset it
+    # per call to render several snippets with one instance (and one font load).
+    def format(self, tokensource, outfile):
+        self.drawables = []
+        super().format(tokensource, outfile)
+
+
+class CodeRenderer:
+    """Renders code snippets to PNG, reusing fonts, lexers and formatters.
+
+    The mono font is located once, lexers are memoized per language and each
+    thread keeps one formatter, so a batch of snippets pays the setup cost
+    (font scan, plugin registry lookup, TrueType loading) only once.
+    """
+
+    def __init__(self) -> None:
+        self._options = _formatter_options()
+        self._lexers: dict[str, Lexer] = {}
+        self._lexers_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def renderer_id(self) -> str:
+        opts = ",".join(f"{k}={v}" for k, v in sorted(self._options.items()))
+        return f"code|pygments={pygments.__version__}|{opts}"
+
+    def lexer(self, language: str | None) -> Lexer:
+        key = (language or "").lower()
+        lexer = self._lexers.get(key)
+        if lexer is None:
+            with self._lexers_lock:
+                lexer = self._lexers.get(key)
+                if lexer is None:
+                    lexer = _pick_lexer(language)
+                    self._lexers[key] = lexer
+        return lexer
+
+    def render(self, code: str, *, language: str | None) -> bytes:
+        return highlight(code, self.lexer(language), self._formatter())
+
+    def render_to_png(self, code: str, *, language: str | None, output_png: Path) -> None:
+        output_png.parent.mkdir(parents=True, exist_ok=True)
+        output_png.write_bytes(self.render(code, language=language))
+
+    def render_batch(self, jobs: list[tuple[str, str | None, Path]]) -> None:
+        """Render (code, language, output_png) jobs in order."""
+        for code, language, output_png in jobs:
+            self.render_to_png(code, language=language, output_png=output_png)
+
+    def _formatter(self) -> ImageFormatter:
+        formatter = getattr(self._local, "formatter", None)
+        if formatter is None:
+            formatter = _ReusableImageFormatter(**self._options)
+            self._local.formatter = formatter
+        return formatter
+
+
+@lru_cache(maxsize=1)
+def default_code_renderer() -> CodeRenderer:
+    return CodeRenderer()
+
+
 def render_code_to_png(code: str, *, language: str | None, output_png: Path) -> None:
-    output_png.parent.mkdir(parents=True, exist_ok=True)
+    default_code_renderer().render_to_png(code, language=language, output_png=output_png)
+
+
+def render_code_batch(jobs: list[tuple[str, str | None, Path]]) -> None:
+    default_code_renderer().render_batch(jobs)
+
 
-    lexer = _pick_lexer(language)
-    formatter = _build_formatter()
-    data = highlight(code, lexer, formatter)
-    output_png.write_bytes(data)
+def code_renderer_id() -> str:
+    """Identity of the code snippet renderer used for render cache keys."""
+    return default_code_renderer().renderer_id
 
 
 def _pick_lexer(language: str | None):
@@ -24,9 +99,9 @@ def _pick_lexer(language: str | None):
     return TextLexer()
 
 
-def _build_formatter() -> ImageFormatter:
+def _formatter_options() -> dict[str, object]:
     kwargs: dict[str, object] = {
-        "style": "xcode",
+        "style": CODE_STYLE,
         "line_numbers": True,
         "font_size": 16,
         "background_color": "#ffffff",
@@ -41,9 +116,10 @@ def _build_formatter() -> ImageFormatter:
     if font_path:
         kwargs["font_name"] = font_path
 
-    return ImageFormatter(**kwargs)
+    return kwargs
 
 
+@lru_cache(maxsize=1)
 def _find_mono_font() -> str | None:
     candidates = [
         Path("C:/Windows/Fonts/consola.ttf"),
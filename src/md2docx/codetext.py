@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+from functools import lru_cache
+
+from lxml import etree as ET
+from pygments.styles import get_style_by_name
+from pygments.token import _TokenType
+
+from md2docx.codeimg import CODE_STYLE, default_code_renderer
+from md2docx.docxops import CODE_TABLE_CAPTION, W_NS
+
+
+# Native code blocks: a bordered single-cell table, one paragraph per source
+# line with a grey line number and syntax-colored runs.
+CODE_FONT = "Consolas"
+CODE_FONT_SIZE_HALF_PT = 18  # 9pt
+_LINE_NUMBER_COLOR = "666666"
+_CELL_FILL = "F7F7F7"
+_TWIPS_PER_DIGIT = 140
+_TAB_SIZE = 4
+
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+
+def _w(tag: str) -> str:
+    return f"{{{W_NS}}}{tag}"
+
+
+def render_code_to_openxml(code: str, *, language: str | None) -> str:
+    """Render a snippet as a WordprocessingML table (raw openxml for pandoc)."""
+    lexer = default_code_renderer().lexer(language)
+    lines = _tokenize_lines(code, lexer)
+    number_width = len(str(max(1, len(lines))))
+    indent = _TWIPS_PER_DIGIT * (number_width + 2)
+
+    tbl = ET.Element(_w("tbl"), nsmap={"w": W_NS})
+    tblpr = ET.SubElement(tbl, _w("tblPr"))
+    ET.SubElement(tblpr, _w("tblW"), attrib={_w("w"): "5000", _w("type"): "pct"})
+    ET.SubElement(tblpr, _w("jc"), attrib={_w("val"): "center"})
+    borders = ET.SubElement(tblpr, _w("tblBorders"))
+    for side in ("top", "left", "bottom", "right"):
+        ET.SubElement(
+            borders,
+            _w(side),
+            attrib={_w("val"): "single", _w("sz"): "4", _w("space"): "0", _w("color"): "BFBFBF"},
+        )
+    ET.SubElement(tblpr, _w("tblCaption"), attrib={_w("val"): CODE_TABLE_CAPTION})
+    grid = ET.SubElement(tbl, _w("tblGrid"))
+    ET.SubElement(grid, _w("gridCol"))
+
+    tr = ET.SubElement(tbl, _w("tr"))
+    tc = ET.SubElement(tr, _w("tc"))
+    tcpr = ET.SubElement(tc, _w("tcPr"))
+    ET.SubElement(tcpr, _w("tcW"), attrib={_w("w"): "5000", _w("type"): "pct"})
+    ET.SubElement(tcpr, _w("shd"), attrib={_w("val"): "clear", _w("color"): "auto", _w("fill"): _CELL_FILL})
+
+    for lineno, tokens in enumerate(lines, start=1):
+        p = ET.SubElement(tc, _w("p"))
+        ppr = ET.SubElement(p, _w("pPr"))
+        ET.SubElement(
+            ppr,
+            _w("spacing"),
+            attrib={_w("before"): "0", _w("after"): "0", _w("line"): "240", _w("lineRule"): "auto"},
+        )
+        # Hanging indent keeps wrapped lines aligned with the code column.
+        ET.SubElement(ppr, _w("ind"), attrib={_w("left"): str(indent), _w("hanging"): str(indent)})
+        ET.SubElement(ppr, _w("jc"), attrib={_w("val"): "left"})
+
+        p.append(_make_run(str(lineno).rjust(number_width), color=_LINE_NUMBER_COLOR))
+        tab_run = ET.SubElement(p, _w("r"))
+        tab_run.append(_run_props(color=None, bold=False, italic=False))
+        ET.SubElement(tab_run, _w("tab"))
+
+        for text, style in tokens:
+            p.append(_make_run(text, color=style[0], bold=style[1], italic=style[2]))
+
+    return ET.tostring(tbl, encoding="unicode")
+
+
+def _tokenize_lines(code: str, lexer) -> list[list[tuple[str, tuple[str | None, bool, bool]]]]:
+    lines: list[list[tuple[str, tuple[str | None, bool, bool]]]] = [[]]
+    for ttype, value in lexer.get_tokens(code.expandtabs(_TAB_SIZE)):
+        style = _token_style(ttype)
+        parts = value.split("\n")
+        for idx, part in enumerate(parts):
+            if idx > 0:
+                lines.append([])
+            if part:
+                lines[-1].append((part, style))
+    # Pygments always ends the stream with a newline.
+    if len(lines) > 1 and not lines[-1]:
+        lines.pop()
+    return lines
+
+
+@lru_cache(maxsize=512)
+def _token_style(ttype: _TokenType) -> tuple[str | None, bool, bool]:
+    st = get_style_by_name(CODE_STYLE).style_for_token(ttype)
+    return st.get("color"), bool(st.get("bold")), bool(st.get("italic"))
+
+
+def _make_run(text: str, *, color: str | None, bold: bool = False, italic: bool = False) -> ET._Element:
+    r = ET.Element(_w("r"))
+    r.append(_run_props(color=color, bold=bold, italic=italic))
+    t = ET.SubElement(r, _w("t"))
+    t.set(_XML_SPACE, "preserve")
+    t.text = text
+    return r
+
+
+def _run_props(*, color: str | None, bold: bool, italic: bool) -> ET._Element:
+    rpr = ET.Element(_w("rPr"))
+    ET.SubElement(
+        rpr,
+        _w("rFonts"),
+        attrib={_w("ascii"): CODE_FONT, _w("hAnsi"): CODE_FONT, _w("cs"): CODE_FONT},
+    )
+    if bold:
+        ET.SubElement(rpr, _w("b"))
+    if italic:
+        ET.SubElement(rpr, _w("i"))
+    ET.SubElement(rpr, _w("noProof"))
+    if color:
+        ET.SubElement(rpr, _w("color"), attrib={_w("val"): color.upper()})
+    ET.SubElement(rpr, _w("sz"), attrib={_w("val"): str(CODE_FONT_SIZE_HALF_PT)})
+    ET.SubElement(rpr, _w("szCs"), attrib={_w("val"): str(CODE_FONT_SIZE_HALF_PT)})
+    return rpr
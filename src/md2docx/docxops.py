@@ -1,9 +1,14 @@
 from __future__ import annotations
 
 import copy
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+import hashlib
+import io
+import json
+import math
 from pathlib import Path
 import re
+from typing import BinaryIO, Callable
 import zipfile
 import unicodedata
 
@@ -11,6 +16,9 @@ from lxml import etree as ET
 import yaml
 
 from md2docx.bibliography import BibSource, build_sources_customxml, load_sources_yaml
+from md2docx.cache import RenderCache
+from md2docx.mediaopt import MediaReport, downsample_image, optimize_media
+from md2docx.package import PackageWriter, RawEntry, compress_entry, compress_parts, read_raw_entry
 
 
 W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
@@ -19,11 +27,63 @@ PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
 CT_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
 
 NS = {"w": W_NS, "r": R_NS}
+# tblCaption (alt text) of native code blocks emitted by md2docx.codetext; such
+# tables keep their own layout and skip the data-table formatting rules.
+CODE_TABLE_CAPTION = "md2docx-code"
+
+_W_TBL = f"{{{W_NS}}}tbl"
+_W_P = f"{{{W_NS}}}p"
+_W_DRAWING = f"{{{W_NS}}}drawing"
+
+# Precompiled lookups for the per-element formatting handlers (_format_body).
+_XP_ROWS = ET.XPath("w:tr", namespaces=NS)
+_XP_CELLS = ET.XPath("w:tc", namespaces=NS)
+_XP_RUNS = ET.XPath("w:r", namespaces=NS)
+_XP_DESC_PARAGRAPHS = ET.XPath(".//w:p", namespaces=NS)
+_XP_DESC_RUNS = ET.XPath(".//w:r", namespaces=NS)
+_XP_TEXT = ET.XPath(".//w:t/text()", namespaces=NS)
+_XP_TABLE_CAPTION = ET.XPath("w:tblPr/w:tblCaption/@w:val", namespaces=NS)
+_XP_PARAGRAPH_STYLE = ET.XPath("w:pPr/w:pStyle/@w:val", namespaces=NS)
+_XP_PPR = ET.XPath("w:pPr", namespaces=NS)
+_XP_RPR = ET.XPath("w:rPr", namespaces=NS)
+_XP_TRPR = ET.XPath("w:trPr", namespaces=NS)
+_XP_TCPR = ET.XPath("w:tcPr", namespaces=NS)
+_XP_TBLPR = ET.XPath("w:tblPr", namespaces=NS)
+
+_MARKER_PREFIX = b"[[MD2DOCX_"
 _INLINE_MARKER_RE = re.compile(
     r"\[\[MD2DOCX_REF:(fig|tab):([A-Za-z0-9_-]+)\]\]|\[\[MD2DOCX_CITATION:([A-Za-z0-9_-]+)\]\]"
 )
 
 
+@dataclass(frozen=True)
+class BodyPackage:
+    """A body built in memory instead of read from pandoc's body.docx.
+
+    `document` and `rels` are already parsed; `parts` holds the remaining
+    zip entries (styles, numbering, footnotes, media) by path. `markers` is
+    True when captions and references are still marker text rather than
+    Word fields.
+    """
+
+    document: ET._Element
+    rels: ET._Element
+    parts: dict[str, bytes]
+    markers: bool = False
+
+    def read(self, name: str) -> bytes:
+        return self.parts[name]
+
+    def namelist(self) -> list[str]:
+        return list(self.parts)
+
+    def __enter__(self) -> BodyPackage:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        return None
+
+
 @dataclass(frozen=True)
 class _RelItem:
     old_id: str
@@ -33,146 +93,524 @@ class _RelItem:
     target_mode: str | None
 
 
+@dataclass(frozen=True)
+class TemplateSkeleton:
+    """The body-independent part of assemble_final_docx, compiled once per template.
+
+    `document` is the template's document.xml with the list of tables,
+    empty TOC fields and no sample content; every build parses its own
+    copy. Anchors are child index paths from the document root: the body
+    goes in before `insert_before`, the cover placeholders are
+    `cover_texts` and the bibliography field lives in `bibliography`.
+    `entries` are the template parts copied unchanged into every build,
+    still compressed.
+    """
+
+    document: bytes
+    insert_before: tuple[int, ...]
+    cover_texts: tuple[tuple[int, ...], ...]
+    bibliography: tuple[int, ...] | None
+    max_bookmark_id: int
+    rels: bytes
+    content_types: bytes
+    settings: bytes
+    footnotes: bytes
+    endnotes: bytes
+    sources_xml: bytes | None
+    media_names: frozenset[str]
+    # sha256 of a template image -> its rId, for media deduplication.
+    image_rids: dict[str, str]
+    entries: tuple[RawEntry, ...]
+
+
 def assemble_final_docx(
     *,
     template_docx: Path,
-    body_docx: Path,
+    body_docx: Path | BodyPackage,
     output_docx: Path,
     meta_path: Path,
     sources_path: Path,
-) -> None:
+    svg_images: dict[str, Path] | None = None,
+    optimize_images: bool = False,
+    image_dpi: int | None = None,
+    package_jobs: int | None = None,
+    low_memory: bool = False,
+    skeleton: TemplateSkeleton | None = None,
+) -> MediaReport | None:
+    """Merge the pandoc body into the template and write the final document.
+
+    `body_docx` is either pandoc's body.docx or an in-memory BodyPackage
+    (native writer or stitched pandoc sections). `skeleton` is the template
+    compiled by prepare_template_skeleton; without it the template is
+    compiled here.
+
+    `svg_images` maps the sha256 of a rendered PNG diagram to its SVG
+    version; matching images are embedded as SVG with the PNG as fallback.
+    With `image_dpi` raster images are resampled to that resolution at their
+    final displayed size. With `optimize_images` the body's PNGs are
+    recompressed and the savings are returned. The rewritten parts are
+    serialized and compressed on up to `package_jobs` threads (default: one
+    per CPU).
+
+    With `low_memory` the body is parsed from the zip stream without
+    libxml2's size limits, its blocks are moved into the template rather
+    than copied (a BodyPackage is consumed) and document.xml is streamed
+    into the package one block at a time; parts are written sequentially.
+    """
     meta = _load_yaml(meta_path) if meta_path.exists() else {}
     sources = load_sources_yaml(sources_path)
 
-    with zipfile.ZipFile(template_docx, "r") as zt, zipfile.ZipFile(body_docx, "r") as zb:
-        # Load XML parts
-        tmpl_doc = _xml_from_bytes(zt.read("word/document.xml"))
-        tmpl_rels = _xml_from_bytes(zt.read("word/_rels/document.xml.rels"))
-        types_xml = _xml_from_bytes(zt.read("[Content_Types].xml"))
+    if skeleton is None:
+        skeleton = _compile_template(template_docx.read_bytes())
+    in_memory = isinstance(body_docx, BodyPackage)
+    body_zip = body_docx if in_memory else zipfile.ZipFile(body_docx, "r")
+    with body_zip as zb:
+        # Load XML parts; anchors are resolved before the body shifts them.
+        tmpl_doc = _xml_from_bytes(skeleton.document)
+        tmpl_rels = _xml_from_bytes(skeleton.rels)
+        types_xml = _xml_from_bytes(skeleton.content_types)
+        insert_before = _resolve_child_path(tmpl_doc, skeleton.insert_before)
+        cover_texts = [_resolve_child_path(tmpl_doc, path) for path in skeleton.cover_texts]
+        bibliography = (
+            _resolve_child_path(tmpl_doc, skeleton.bibliography) if skeleton.bibliography is not None else None
+        )
 
-        body_doc = _xml_from_bytes(zb.read("word/document.xml"))
-        body_rels = _xml_from_bytes(zb.read("word/_rels/document.xml.rels"))
+        if in_memory:
+            body_doc, body_rels = body_docx.document, body_docx.rels
+            markers = body_docx.markers
+        else:
+            if low_memory:
+                with zb.open("word/document.xml") as f:
+                    body_doc = ET.parse(f, _xml_parser(huge_tree=True)).getroot()
+                markers = bool(_XP_MARKER_TEXT(body_doc))
+            else:
+                body_bytes = zb.read("word/document.xml")
+                body_doc = _xml_from_bytes(body_bytes)
+                # Without marker text the fields came from the pandoc Lua filter.
+                markers = _MARKER_PREFIX in body_bytes
+            body_rels = _xml_from_bytes(zb.read("word/_rels/document.xml.rels"))
 
         # Merge relationships + media
-        rel_map, added_media = _merge_rels_and_media(tmpl_rels, body_rels, zt=zt, zb=zb)
-        _ensure_content_types(types_xml, added_media=added_media)
+        rel_map, added_media, svg_rel_map = _merge_rels_and_media(
+            tmpl_rels, body_rels, skeleton=skeleton, zb=zb, svg_images=svg_images
+        )
 
         # Merge footnotes/endnotes and patch body doc
         footnote_map, endnote_map, new_footnotes_xml, new_endnotes_xml = _merge_notes(
-            zt=zt, zb=zb
+            skeleton=skeleton, zb=zb
         )
         _patch_note_refs(body_doc, footnote_map=footnote_map, endnote_map=endnote_map)
 
         # Patch relationship ids in body doc
         _patch_relationship_ids(body_doc, rel_id_map=rel_map)
 
-        # Apply cover metadata and ensure list of tables exists
-        _apply_cover_meta(tmpl_doc, meta)
-        _ensure_list_of_tables(tmpl_doc)
+        # Reference the SVG part of diagrams rendered with a PNG fallback.
+        _attach_svg_blips(body_doc, svg_rel_map=svg_rel_map)
+
+        # Apply cover metadata
+        _apply_cover_meta(cover_texts, meta)
 
-        # Replace the sample content with body content
-        inserted_nodes = _replace_content_region(tmpl_doc, body_doc)
+        # Put the body where the template's sample content was. A body.docx
+        # tree is ours to move from; a BodyPackage only in low-memory mode.
+        inserted_nodes = _insert_body(insert_before, body_doc, move=low_memory or not in_memory)
 
         # Replace markers with Word fields
-        _replace_markers(tmpl_doc)
+        if markers:
+            max_bm = max([skeleton.max_bookmark_id] + [_max_bookmark_id(n) for n in inserted_nodes])
+            _replace_markers(inserted_nodes, first_bookmark_id=max_bm + 1)
+        else:
+            _shift_bookmark_ids(inserted_nodes, offset=skeleton.max_bookmark_id)
+            _keep_captions_with_next(inserted_nodes)
 
         # Align figure images consistently (caption above, centered image).
         _center_captioned_figure_images(tmpl_doc)
 
-        # Ensure tables in body content have borders.
-        _apply_table_borders(inserted_nodes)
-
-        # Center tables and bold header rows.
-        _format_tables(inserted_nodes)
-
-        # Keep tables together with their caption and source line.
-        _keep_tables_with_surroundings(inserted_nodes)
+        # Table borders, centering, header rows, keep-together and color
+        # swatches; source lines; Heading1 page breaks; image height caps.
+        _format_body(inserted_nodes)
 
-        # Center and italicize source lines ("Fuente: ...") in body content.
-        _format_source_paragraphs(inserted_nodes)
+        # Resample oversized raster images to the target DPI at their final size.
+        if image_dpi:
+            _downsample_images(inserted_nodes, tmpl_rels=tmpl_rels, added_media=added_media, dpi=image_dpi)
 
-        # Start each Heading1 on a new page.
-        _page_break_before_heading1(inserted_nodes)
-
-        # Cap oversized images to fit within page height.
-        _cap_image_heights(inserted_nodes)
-
-        # Clear placeholder text from TOC/List of Figures/Tables fields.
-        _clear_toc_placeholders(tmpl_doc)
+        media_report = None
+        if optimize_images:
+            media_report = optimize_media(added_media)
+            _apply_media_report(tmpl_rels, added_media, media_report)
+        _ensure_content_types(types_xml, added_media=added_media)
 
         # Replace cached BIBLIOGRAPHY field text with actual sources.
-        _replace_bibliography_cache(tmpl_doc, sources)
+        if bibliography is not None:
+            _replace_bibliography_cache(bibliography, sources)
 
         # Bibliography sources customXml
-        item1_xml = zt.read("customXml/item1.xml") if "customXml/item1.xml" in zt.namelist() else None
         new_item1_xml = (
-            build_sources_customxml(template_item1_xml=item1_xml, sources=sources)
-            if item1_xml is not None
+            build_sources_customxml(template_item1_xml=skeleton.sources_xml, sources=sources)
+            if skeleton.sources_xml is not None
             else None
         )
 
-        # Apply color swatches to cells containing hex color codes.
-        _apply_color_swatches(inserted_nodes)
-
-        settings_xml = _xml_from_bytes(zt.read("word/settings.xml"))
+        settings_xml = _xml_from_bytes(skeleton.settings)
         _set_settings_language(settings_xml, meta.get("lang", "es-BO"))
-        _ensure_update_fields(settings_xml)
 
-        # Build output package
+        # Build output package. Untouched template parts are copied still
+        # compressed; only rewritten parts are deflated (media is stored).
         output_docx.parent.mkdir(parents=True, exist_ok=True)
-        with zipfile.ZipFile(output_docx, "w", compression=zipfile.ZIP_DEFLATED) as zo:
-            for info in zt.infolist():
-                name = info.filename
-                if name in (
-                    "[Content_Types].xml",
-                    "word/document.xml",
-                    "word/_rels/document.xml.rels",
-                    "word/styles.xml",
-                    "word/numbering.xml",
-                    "word/footnotes.xml",
-                    "word/endnotes.xml",
-                    "word/settings.xml",
-                    "customXml/item1.xml",
-                ):
-                    continue
-                zo.writestr(info, zt.read(name))
+        with PackageWriter(output_docx) as zo:
+            for entry in skeleton.entries:
+                zo.write_raw(entry)
 
-            # Write replaced parts
-            zo.writestr("[Content_Types].xml", _xml_to_bytes(types_xml))
-            zo.writestr("word/document.xml", _xml_to_bytes(tmpl_doc))
-            zo.writestr("word/_rels/document.xml.rels", _xml_to_bytes(tmpl_rels))
-
-            # Use pandoc-generated styles/numbering for list fidelity
+            # Replaced parts are serialized and compressed concurrently,
+            # then written in this order.
             styles_xml = _xml_from_bytes(zb.read("word/styles.xml"))
             _set_document_language(styles_xml, meta.get("lang", "es-BO"))
             _add_heading_spacing(styles_xml)
-            zo.writestr("word/styles.xml", _xml_to_bytes(styles_xml))
-            zo.writestr("word/numbering.xml", zb.read("word/numbering.xml"))
+            parts: list[tuple[str, bytes | Callable[[], bytes]]] = [
+                ("[Content_Types].xml", lambda: _xml_to_bytes(types_xml)),
+                ("word/document.xml", lambda: _xml_to_bytes(tmpl_doc)),
+                ("word/_rels/document.xml.rels", lambda: _xml_to_bytes(tmpl_rels)),
+                # Use pandoc-generated styles/numbering for list fidelity
+                ("word/styles.xml", lambda: _xml_to_bytes(styles_xml)),
+            ]
+            if in_memory:
+                parts.append(("word/numbering.xml", zb.read("word/numbering.xml")))
+            else:
+                zo.write_raw(read_raw_entry(zb, zb.getinfo("word/numbering.xml")))
+            parts += [
+                ("word/footnotes.xml", new_footnotes_xml),
+                ("word/endnotes.xml", new_endnotes_xml),
+                # Settings (with updateFields=true)
+                ("word/settings.xml", lambda: _xml_to_bytes(settings_xml)),
+            ]
+            if new_item1_xml is not None:
+                parts.append(("customXml/item1.xml", new_item1_xml))
+            parts += list(added_media.items())
+
+            if low_memory:
+                # One part at a time, and document.xml never as a single bytes object.
+                for name, data in parts:
+                    if name == "word/document.xml":
+                        with zo.open(name) as f:
+                            _write_document_xml(f, tmpl_doc)
+                    else:
+                        zo.writestr(name, data if isinstance(data, bytes) else data())
+            else:
+                for entry in compress_parts(parts, max_workers=package_jobs):
+                    zo.write_raw(entry)
+
+    return media_report
+
+
+# Template parts that assemble_final_docx rewrites or takes from the body;
+# every other part is copied as is.
+_REWRITTEN_PARTS = frozenset(
+    {
+        "[Content_Types].xml",
+        "word/document.xml",
+        "word/_rels/document.xml.rels",
+        "word/styles.xml",
+        "word/numbering.xml",
+        "word/footnotes.xml",
+        "word/endnotes.xml",
+        "word/settings.xml",
+        "customXml/item1.xml",
+    }
+)
 
-            # Notes
-            zo.writestr("word/footnotes.xml", new_footnotes_xml)
-            zo.writestr("word/endnotes.xml", new_endnotes_xml)
+# Bump when _compile_template changes what it prepares.
+_SKELETON_VERSION = "1"
+# Anchors and digests of a cached skeleton, next to its XML parts.
+_SKELETON_INFO = "md2docx-skeleton.json"
 
-            # Settings (with updateFields=true)
-            zo.writestr("word/settings.xml", _xml_to_bytes(settings_xml))
 
-            if new_item1_xml is not None:
-                zo.writestr("customXml/item1.xml", new_item1_xml)
+def prepare_template_skeleton(*, template_docx: Path, workdir: Path, cache: RenderCache | None) -> TemplateSkeleton:
+    """Compile the template for assemble_final_docx, cached by its content hash.
+
+    The cached file is a zip with the prepared template parts, the parts
+    copied unchanged (still compressed) and the anchors.
+    """
+    data = template_docx.read_bytes()
+    if cache is None:
+        return _compile_template(data)
+    path = workdir / "template-skeleton.zip"
+    key = RenderCache.make_key("template-skeleton", _SKELETON_VERSION, hashlib.sha256(data).hexdigest())
+    if cache.fetch(key, path):
+        try:
+            return _read_skeleton(path)
+        except (KeyError, ValueError, zipfile.BadZipFile):
+            # A damaged entry is compiled again and replaced.
+            pass
+    skeleton = _compile_template(data)
+    _write_skeleton(skeleton, path)
+    cache.store(key, path)
+    return skeleton
+
+
+def _write_skeleton(skeleton: TemplateSkeleton, path: Path) -> None:
+    info = {
+        "insert_before": skeleton.insert_before,
+        "cover_texts": skeleton.cover_texts,
+        "bibliography": skeleton.bibliography,
+        "max_bookmark_id": skeleton.max_bookmark_id,
+        "media_names": sorted(skeleton.media_names),
+        "image_rids": skeleton.image_rids,
+    }
+    parts = {
+        "word/document.xml": skeleton.document,
+        "word/_rels/document.xml.rels": skeleton.rels,
+        "[Content_Types].xml": skeleton.content_types,
+        "word/settings.xml": skeleton.settings,
+        "word/footnotes.xml": skeleton.footnotes,
+        "word/endnotes.xml": skeleton.endnotes,
+    }
+    if skeleton.sources_xml is not None:
+        parts["customXml/item1.xml"] = skeleton.sources_xml
+    with PackageWriter(path) as zo:
+        for entry in skeleton.entries:
+            zo.write_raw(entry)
+        for name, data in parts.items():
+            zo.writestr(name, data)
+        zo.writestr(_SKELETON_INFO, json.dumps(info).encode("utf-8"))
+
+
+def _read_skeleton(path: Path) -> TemplateSkeleton:
+    with zipfile.ZipFile(path, "r") as zs:
+        info = json.loads(zs.read(_SKELETON_INFO))
+        names = zs.namelist()
+        return TemplateSkeleton(
+            document=zs.read("word/document.xml"),
+            insert_before=tuple(info["insert_before"]),
+            cover_texts=tuple(tuple(p) for p in info["cover_texts"]),
+            bibliography=tuple(info["bibliography"]) if info["bibliography"] is not None else None,
+            max_bookmark_id=info["max_bookmark_id"],
+            rels=zs.read("word/_rels/document.xml.rels"),
+            content_types=zs.read("[Content_Types].xml"),
+            settings=zs.read("word/settings.xml"),
+            footnotes=zs.read("word/footnotes.xml"),
+            endnotes=zs.read("word/endnotes.xml"),
+            sources_xml=zs.read("customXml/item1.xml") if "customXml/item1.xml" in names else None,
+            media_names=frozenset(info["media_names"]),
+            image_rids=info["image_rids"],
+            entries=tuple(
+                read_raw_entry(zs, i)
+                for i in zs.infolist()
+                if i.filename not in _REWRITTEN_PARTS and i.filename != _SKELETON_INFO
+            ),
+        )
+
+
+def _compile_template(data: bytes) -> TemplateSkeleton:
+    with zipfile.ZipFile(io.BytesIO(data), "r") as zt:
+        names = zt.namelist()
+        doc = _xml_from_bytes(zt.read("word/document.xml"))
+        rels = zt.read("word/_rels/document.xml.rels")
+        max_bookmark_id = _max_bookmark_id(doc)
 
-            # Added media
-            for target_path, blob in added_media.items():
-                zo.writestr(target_path, blob)
+        _ensure_list_of_tables(doc)
+        # Clear placeholder text from TOC/List of Figures/Tables fields.
+        _clear_toc_placeholders(doc)
+
+        # Drop the sample content; the body is inserted in its place.
+        body = doc.find(".//w:body", namespaces=NS)
+        start_idx, end_idx = _find_content_region(doc)
+        del body[start_idx:end_idx]
+
+        bibliography = _find_bibliography_container(doc)
+
+        settings = _xml_from_bytes(zt.read("word/settings.xml"))
+        _ensure_update_fields(settings)
+
+        image_rids: dict[str, str] = {}
+        for rel in _xml_from_bytes(rels).findall(f"{{{PKG_REL_NS}}}Relationship"):
+            rid = rel.get("Id")
+            path = f"word/{rel.get('Target') or ''}"
+            if rid and (rel.get("Type") or "").endswith("/image") and rel.get("TargetMode") is None and path in names:
+                image_rids.setdefault(hashlib.sha256(zt.read(path)).hexdigest(), rid)
+
+        return TemplateSkeleton(
+            document=_xml_to_bytes(doc),
+            insert_before=_child_path(body[start_idx]),
+            cover_texts=tuple(_child_path(t) for t in _cover_text_nodes(doc)),
+            bibliography=_child_path(bibliography) if bibliography is not None else None,
+            max_bookmark_id=max_bookmark_id,
+            rels=rels,
+            content_types=zt.read("[Content_Types].xml"),
+            settings=_xml_to_bytes(settings),
+            footnotes=zt.read("word/footnotes.xml"),
+            endnotes=zt.read("word/endnotes.xml"),
+            sources_xml=zt.read("customXml/item1.xml") if "customXml/item1.xml" in names else None,
+            media_names=frozenset(n.split("/")[-1] for n in names if n.startswith("word/media/")),
+            image_rids=image_rids,
+            entries=tuple(
+                read_raw_entry(zt, info) for info in zt.infolist() if info.filename not in _REWRITTEN_PARTS
+            ),
+        )
+
+
+def _child_path(el: ET._Element) -> tuple[int, ...]:
+    path: list[int] = []
+    parent = el.getparent()
+    while parent is not None:
+        path.append(parent.index(el))
+        el, parent = parent, parent.getparent()
+    return tuple(reversed(path))
+
+
+def _resolve_child_path(root: ET._Element, path: tuple[int, ...]) -> ET._Element:
+    el = root
+    for idx in path:
+        el = el[idx]
+    return el
+
+
+# Parts of the template that pandoc reads from --reference-doc. Everything
+# else (cover content, headers, images, customXml) is dropped.
+_REFERENCE_DOC_PARTS = (
+    "word/styles.xml",
+    "word/numbering.xml",
+    "word/theme/theme1.xml",
+    "word/settings.xml",
+    "word/fontTable.xml",
+)
+_OFFICE_DOC_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+_REFERENCE_DOC_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def write_reference_doc(*, template_docx: Path, output_docx: Path) -> None:
+    """Write a copy of the template reduced to what pandoc's reference doc needs.
+
+    Styles, numbering, theme, settings and font table are kept; the body is
+    replaced by the template's final section properties. The zip is written
+    with fixed timestamps, so the same template always gives the same bytes.
+    """
+    with zipfile.ZipFile(template_docx, "r") as zt:
+        names = set(zt.namelist())
+        kept = [n for n in _REFERENCE_DOC_PARTS if n in names]
+
+        tmpl_doc = _xml_from_bytes(zt.read("word/document.xml"))
+        doc = ET.Element(ET.QName(W_NS, "document"), nsmap={"w": W_NS, "r": R_NS})
+        body = ET.SubElement(doc, ET.QName(W_NS, "body"))
+        sect_pr = tmpl_doc.find("w:body/w:sectPr", namespaces=NS)
+        if sect_pr is not None:
+            sect_pr = copy.deepcopy(sect_pr)
+            for ref in sect_pr.findall("w:headerReference", namespaces=NS) + sect_pr.findall(
+                "w:footerReference", namespaces=NS
+            ):
+                sect_pr.remove(ref)
+            body.append(sect_pr)
+
+        rels = _xml_from_bytes(zt.read("word/_rels/document.xml.rels"))
+        for rel in rels.findall(f"{{{PKG_REL_NS}}}Relationship"):
+            if rel.get("TargetMode") == "External" or f"word/{rel.get('Target')}" not in kept:
+                rels.remove(rel)
+
+        pkg_rels = ET.Element(ET.QName(PKG_REL_NS, "Relationships"), nsmap={None: PKG_REL_NS})
+        ET.SubElement(
+            pkg_rels,
+            ET.QName(PKG_REL_NS, "Relationship"),
+            Id="rId1",
+            Type=_OFFICE_DOC_REL,
+            Target="word/document.xml",
+        )
+
+        types_xml = _xml_from_bytes(zt.read("[Content_Types].xml"))
+        for override in types_xml.findall(f"{{{CT_NS}}}Override"):
+            part = (override.get("PartName") or "").lstrip("/")
+            if part != "word/document.xml" and part not in kept:
+                types_xml.remove(override)
+
+        entries = [
+            compress_entry(name, _xml_to_bytes(root), date_time=_REFERENCE_DOC_DATE)
+            for name, root in (
+                ("[Content_Types].xml", types_xml),
+                ("_rels/.rels", pkg_rels),
+                ("word/document.xml", doc),
+                ("word/_rels/document.xml.rels", rels),
+            )
+        ]
+        entries.extend(
+            replace(read_raw_entry(zt, zt.getinfo(name)), date_time=_REFERENCE_DOC_DATE)
+            for name in kept
+        )
+
+    output_docx.parent.mkdir(parents=True, exist_ok=True)
+    with PackageWriter(output_docx) as zo:
+        for entry in entries:
+            zo.write_raw(entry)
+
+
+def _apply_media_report(tmpl_rels: ET._Element, added_media: dict[str, bytes], report: MediaReport) -> None:
+    """Swap in optimized media blobs, retargeting relationships of renamed parts."""
+    renamed: dict[str, str] = {}
+    for img in report.images:
+        del added_media[img.original_path]
+        added_media[img.path] = img.data
+        if img.path != img.original_path:
+            renamed[img.original_path.removeprefix("word/")] = img.path.removeprefix("word/")
+    if not renamed:
+        return
+    for rel in tmpl_rels.findall(f"{{{PKG_REL_NS}}}Relationship"):
+        target = rel.get("Target") or ""
+        if target in renamed:
+            rel.set("Target", renamed[target])
+
+
+_XMLNS_DECL_RE = re.compile(rb' xmlns(?::[^=\s>]+)?="[^"]*"')
+_XMLNS_RUN_RE = re.compile(rb'(<[^\s>/]+)((?: xmlns(?::[^=\s>]+)?="[^"]*")+)')
+
+
+def _xml_parser(*, huge_tree: bool = False) -> ET.XMLParser:
+    return ET.XMLParser(remove_blank_text=False, huge_tree=huge_tree)
 
 
 def _xml_from_bytes(data: bytes) -> ET._Element:
-    parser = ET.XMLParser(remove_blank_text=False)
-    return ET.fromstring(data, parser=parser)
+    return ET.fromstring(data, parser=_xml_parser())
 
 
 def _xml_to_bytes(root: ET._Element) -> bytes:
     return ET.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
 
 
+def _write_document_xml(f: BinaryIO, doc: ET._Element) -> None:
+    """Serialize `doc` into `f` block by block instead of as one bytes object.
+
+    xmlfile writes the declaration and the document/body tags. Each block is
+    written with ET.tostring, which repeats every namespace declared on the
+    root; those are dropped again since the root already declares them.
+    """
+    root_decls = {
+        (f' xmlns:{prefix}="{uri}"' if prefix else f' xmlns="{uri}"').encode() for prefix, uri in doc.nsmap.items()
+    }
+    # libxml2 writes a start tag's declarations as one run; blocks share a few.
+    stripped_runs: dict[bytes, bytes] = {}
+
+    def write_block(el: ET._Element) -> None:
+        data = ET.tostring(el, encoding="UTF-8", xml_declaration=False)
+        m = _XMLNS_RUN_RE.match(data)
+        if m is None:
+            f.write(data)
+            return
+        run = m.group(2)
+        if run not in stripped_runs:
+            stripped_runs[run] = b"".join(d for d in _XMLNS_DECL_RE.findall(run) if d not in root_decls)
+        f.write(m.group(1))
+        f.write(stripped_runs[run])
+        f.write(data[m.end() :])
+
+    with ET.xmlfile(f, encoding="UTF-8") as xf:
+        xf.write_declaration(standalone=True)
+        with xf.element(doc.tag, attrib=dict(doc.attrib), nsmap=doc.nsmap):
+            for child in doc:
+                if child.tag != ET.QName(W_NS, "body"):
+                    xf.flush()
+                    write_block(child)
+                    continue
+                with xf.element(child.tag, attrib=dict(child.attrib)):
+                    xf.flush()
+                    for block in child:
+                        write_block(block)
+
+
 def _load_yaml(path: Path) -> dict:
     return yaml.safe_load(path.read_text(encoding="utf-8")) or {}
 
@@ -218,17 +656,27 @@ def _merge_rels_and_media(
     tmpl_rels: ET._Element,
     body_rels: ET._Element,
     *,
-    zt: zipfile.ZipFile,
-    zb: zipfile.ZipFile,
-) -> tuple[dict[str, str], dict[str, bytes]]:
+    skeleton: TemplateSkeleton,
+    zb: zipfile.ZipFile | BodyPackage,
+    svg_images: dict[str, Path] | None = None,
+) -> tuple[dict[str, str], dict[str, bytes], dict[str, str]]:
     """Copy image/hyperlink relationships from body -> template.
 
+    Media is deduplicated by content: identical blobs (also those already in
+    the template, see TemplateSkeleton.image_rids) share one part and one
+    relationship, and hyperlinks with the same target share one relationship.
+
+    PNG images whose sha256 is a key of `svg_images` get a second image
+    relationship to the SVG part.
+
     Returns:
       - rel_id_map: old rId -> new rId
       - added_media: zip path -> bytes
+      - svg_rel_map: new PNG rId -> SVG rId
     """
     rel_id_map: dict[str, str] = {}
     added_media: dict[str, bytes] = {}
+    svg_rel_map: dict[str, str] = {}
 
     tmpl_ids = [_rel.get("Id") for _rel in tmpl_rels.findall(f"{{{PKG_REL_NS}}}Relationship")]
     max_n = 0
@@ -245,7 +693,7 @@ def _merge_rels_and_media(
         return f"rId{max_n}"
 
     # Track used media filenames in template
-    used_media = set(n.split("/")[-1] for n in zt.namelist() if n.startswith("word/media/"))
+    used_media = set(skeleton.media_names)
     media_counter = 1
 
     def new_media_name(ext: str) -> str:
@@ -257,6 +705,17 @@ def _merge_rels_and_media(
                 used_media.add(name)
                 return name
 
+    # sha256 of an image blob -> rId, and (target, mode) of a hyperlink -> rId
+    image_rids = dict(skeleton.image_rids)
+    hyperlink_rids: dict[tuple[str, str | None], str] = {}
+    for rel in tmpl_rels.findall(f"{{{PKG_REL_NS}}}Relationship"):
+        rel_type = rel.get("Type") or ""
+        rid = rel.get("Id")
+        if not rid:
+            continue
+        if rel_type.endswith("/hyperlink"):
+            hyperlink_rids.setdefault((rel.get("Target") or "", rel.get("TargetMode")), rid)
+
     for rel in body_rels.findall(f"{{{PKG_REL_NS}}}Relationship"):
         old_id = rel.get("Id")
         rel_type = rel.get("Type") or ""
@@ -269,6 +728,10 @@ def _merge_rels_and_media(
             # Copy media file
             src_path = f"word/{target}"
             blob = zb.read(src_path)
+            digest = hashlib.sha256(blob).hexdigest()
+            if digest in image_rids:
+                rel_id_map[old_id] = image_rids[digest]
+                continue
             ext = target.split(".")[-1].lower()
             name = new_media_name(ext)
             dst_target = f"media/{name}"
@@ -276,6 +739,7 @@ def _merge_rels_and_media(
 
             new_id = next_rid()
             rel_id_map[old_id] = new_id
+            image_rids[digest] = new_id
             added_media[dst_path] = blob
 
             new_rel = ET.Element(ET.QName(PKG_REL_NS, "Relationship"))
@@ -283,11 +747,29 @@ def _merge_rels_and_media(
             new_rel.set("Type", rel_type)
             new_rel.set("Target", dst_target)
             tmpl_rels.append(new_rel)
+
+            svg_path = (svg_images or {}).get(digest)
+            if svg_path is not None:
+                svg_target = f"media/{new_media_name('svg')}"
+                svg_id = next_rid()
+                svg_rel_map[new_id] = svg_id
+                added_media[f"word/{svg_target}"] = svg_path.read_bytes()
+
+                svg_rel = ET.Element(ET.QName(PKG_REL_NS, "Relationship"))
+                svg_rel.set("Id", svg_id)
+                svg_rel.set("Type", rel_type)
+                svg_rel.set("Target", svg_target)
+                tmpl_rels.append(svg_rel)
             continue
 
         if rel_type.endswith("/hyperlink"):
+            link_key = (target, target_mode)
+            if link_key in hyperlink_rids:
+                rel_id_map[old_id] = hyperlink_rids[link_key]
+                continue
             new_id = next_rid()
             rel_id_map[old_id] = new_id
+            hyperlink_rids[link_key] = new_id
             new_rel = ET.Element(ET.QName(PKG_REL_NS, "Relationship"))
             new_rel.set("Id", new_id)
             new_rel.set("Type", rel_type)
@@ -297,12 +779,14 @@ def _merge_rels_and_media(
             tmpl_rels.append(new_rel)
             continue
 
-    return rel_id_map, added_media
+    return rel_id_map, added_media, svg_rel_map
 
 
-def _merge_notes(*, zt: zipfile.ZipFile, zb: zipfile.ZipFile) -> tuple[dict[int, int], dict[int, int], bytes, bytes]:
-    tmpl_foot = _xml_from_bytes(zt.read("word/footnotes.xml"))
-    tmpl_end = _xml_from_bytes(zt.read("word/endnotes.xml"))
+def _merge_notes(
+    *, skeleton: TemplateSkeleton, zb: zipfile.ZipFile | BodyPackage
+) -> tuple[dict[int, int], dict[int, int], bytes, bytes]:
+    tmpl_foot = _xml_from_bytes(skeleton.footnotes)
+    tmpl_end = _xml_from_bytes(skeleton.endnotes)
     body_foot = _xml_from_bytes(zb.read("word/footnotes.xml"))
     body_end = _xml_from_bytes(zb.read("word/endnotes.xml")) if "word/endnotes.xml" in zb.namelist() else None
 
@@ -386,7 +870,20 @@ def _patch_relationship_ids(doc: ET._Element, *, rel_id_map: dict[str, str]) ->
             el.set(ET.QName(R_NS, "id"), rel_id_map[old])
 
 
-def _apply_cover_meta(doc: ET._Element, meta: dict) -> None:
+_COVER_PLACEHOLDERS = ("titulo del documento", "subtitulo del documento")
+_COVER_LINES = ("Elaborado por:", "Fecha:")
+
+
+def _cover_text_nodes(doc: ET._Element) -> list[ET._Element]:
+    """Text nodes of the cover placeholders that _apply_cover_meta fills in."""
+    return [
+        t
+        for t in doc.iter(f"{{{W_NS}}}t")
+        if t.text and (t.text in _COVER_LINES or _normalize_cover_text(t.text) in _COVER_PLACEHOLDERS)
+    ]
+
+
+def _apply_cover_meta(texts: list[ET._Element], meta: dict) -> None:
     title = str(meta.get("title", "")).strip()
     subtitle = str(meta.get("subtitle", "")).strip()
     author = str(meta.get("author", "")).strip()
@@ -399,15 +896,13 @@ def _apply_cover_meta(doc: ET._Element, meta: dict) -> None:
         repl["subtitulo del documento"] = subtitle
 
     if repl:
-        for t in doc.findall(".//w:t", namespaces=NS):
-            if not t.text:
-                continue
-            norm = _normalize_cover_text(t.text)
+        for t in texts:
+            norm = _normalize_cover_text(t.text or "")
             if norm in repl:
                 t.text = repl[norm]
 
     # Replace author/date lines
-    for t in doc.findall(".//w:t", namespaces=NS):
+    for t in texts:
         if t.text == "Elaborado por:" and author:
             t.text = f"Elaborado por: {author}"
         if t.text == "Fecha:" and date:
@@ -496,14 +991,13 @@ def _make_toc_field_paragraph(*, style_id: str, caption_label: str) -> ET._Eleme
     return p
 
 
-def _replace_content_region(tmpl_doc: ET._Element, body_doc: ET._Element) -> list[ET._Element]:
+def _find_content_region(tmpl_doc: ET._Element) -> tuple[int, int]:
+    """Child index range of the template's w:body holding the sample content."""
     tmpl_body = tmpl_doc.find(".//w:body", namespaces=NS)
-    body_body = body_doc.find(".//w:body", namespaces=NS)
-    if tmpl_body is None or body_body is None:
+    if tmpl_body is None:
         raise RuntimeError("Invalid docx: missing w:body")
 
     tmpl_children = list(tmpl_body)
-    body_children = [c for c in list(body_body) if c.tag != ET.QName(W_NS, "sectPr")]
 
     # Find insertion start: first Heading1 after the figure list field.
     fig_instr = tmpl_doc.xpath(
@@ -540,107 +1034,114 @@ def _replace_content_region(tmpl_doc: ET._Element, body_doc: ET._Element) -> lis
     if end_idx is None:
         raise RuntimeError("Unable to find references section (Referencias) in template")
 
-    # Remove old sample content
-    for _ in range(end_idx - start_idx):
-        del tmpl_children[start_idx]
-    # Rebuild body children in-place
-    inserted = [copy.deepcopy(c) for c in body_children]
-    tmpl_body[:] = tmpl_children[:start_idx] + inserted + tmpl_children[start_idx:]
+    return start_idx, end_idx
+
+
+def _insert_body(anchor: ET._Element, body_doc: ET._Element, *, move: bool = False) -> list[ET._Element]:
+    """Insert the body's blocks before `anchor` and return them.
+
+    Blocks are copied unless `move` is set, which takes them out of `body_doc`.
+    """
+    body_body = body_doc.find(".//w:body", namespaces=NS)
+    if body_body is None:
+        raise RuntimeError("Invalid docx: missing w:body")
+
+    blocks = [c for c in body_body if c.tag != ET.QName(W_NS, "sectPr")]
+    inserted = blocks if move else [copy.deepcopy(c) for c in blocks]
+    for node in inserted:
+        anchor.addprevious(node)
     return inserted
 
 
 def _is_paragraph_style(p: ET._Element, style_id: str) -> bool:
-    if p.tag != ET.QName(W_NS, "p"):
+    if p.tag != _W_P:
         return False
-    pstyle = p.find("./w:pPr/w:pStyle", namespaces=NS)
-    if pstyle is None:
-        return False
-    return pstyle.get(ET.QName(W_NS, "val")) == style_id
+    return style_id in _XP_PARAGRAPH_STYLE(p)
+
 
+_CAPTION_MARKER_RE = re.compile(r"^\[\[MD2DOCX_CAPTION_(FIG|TAB):([A-Za-z0-9_-]+)\|(.*)\]\]$")
+_CAPTION_LABELS = {"FIG": ("fig", "Figura"), "TAB": ("tab", "Tabla")}
+_XP_MARKER_TEXT = ET.XPath("descendant-or-self::w:t[contains(., '[[MD2DOCX_')]", namespaces=NS)
+_XP_PARENT_PARAGRAPH = ET.XPath("ancestor::w:p[1]", namespaces=NS)
 
-def _replace_markers(doc: ET._Element) -> None:
-    max_bm = _max_bookmark_id(doc)
-    next_bm = max_bm + 1
 
-    fig_numbers: dict[str, int] = {}
-    tab_numbers: dict[str, int] = {}
-    fig_counter = 0
-    tab_counter = 0
+def _replace_markers(nodes: list[ET._Element], *, first_bookmark_id: int) -> None:
+    """Turn caption, REF and CITATION marker text in `nodes` into Word fields.
+
+    Only the text nodes that contain a marker are visited: they are indexed
+    once, captions are numbered in document order, and then the inline
+    markers are expanded so that references can point forward.
+    """
+    marker_texts = [t for node in nodes for t in _XP_MARKER_TEXT(node)]
+    next_bm = first_bookmark_id
+
+    numbers: dict[str, dict[str, int]] = {"fig": {}, "tab": {}}
+    counters = {"fig": 0, "tab": 0}
+    checked: set[ET._Element] = set()
+    captions: list[ET._Element] = []
 
     # Captions are expected to be the entire paragraph text
-    for p in doc.findall(".//w:p", namespaces=NS):
-        text = "".join([t.text or "" for t in p.findall(".//w:t", namespaces=NS)]).strip()
-        m = re.match(r"^\[\[MD2DOCX_CAPTION_FIG:([A-Za-z0-9_-]+)\|(.*)\]\]$", text)
-        if m:
-            fig_id = m.group(1)
-            title = m.group(2)
-            fig_counter += 1
-            fig_numbers[fig_id] = fig_counter
-            bm_name = _bookmark_name("fig", fig_id)
-            _replace_paragraph_with_caption(
-                p,
-                label="Figura",
-                seq_name="Figura",
-                title=title,
-                bookmark=bm_name,
-                bm_id=next_bm,
-                number=fig_counter,
-            )
-            next_bm += 1
+    for t in marker_texts:
+        found = _XP_PARENT_PARAGRAPH(t)
+        if not found or found[0] in checked:
             continue
-
-        m = re.match(r"^\[\[MD2DOCX_CAPTION_TAB:([A-Za-z0-9_-]+)\|(.*)\]\]$", text)
-        if m:
-            tab_id = m.group(1)
-            title = m.group(2)
-            tab_counter += 1
-            tab_numbers[tab_id] = tab_counter
-            bm_name = _bookmark_name("tab", tab_id)
-            _replace_paragraph_with_caption(
-                p,
-                label="Tabla",
-                seq_name="Tabla",
-                title=title,
-                bookmark=bm_name,
-                bm_id=next_bm,
-                number=tab_counter,
-            )
-            next_bm += 1
+        p = found[0]
+        checked.add(p)
+        m = _CAPTION_MARKER_RE.match(_paragraph_text(p).strip())
+        if not m:
             continue
+        kind, label = _CAPTION_LABELS[m.group(1)]
+        counters[kind] += 1
+        numbers[kind][m.group(2)] = counters[kind]
+        _replace_paragraph_with_caption(
+            p,
+            label=label,
+            seq_name=label,
+            title=m.group(3),
+            bookmark=_bookmark_name(kind, m.group(2)),
+            bm_id=next_bm,
+            number=counters[kind],
+        )
+        captions.append(p)
+        next_bm += 1
+
+    # Caption titles may hold references; their runs were rebuilt above.
+    for p in captions:
+        marker_texts.extend(_XP_MARKER_TEXT(p))
 
     # Inline replacements for REF and CITATION markers
-    for p in doc.findall(".//w:p", namespaces=NS):
-        for t in list(p.findall(".//w:t", namespaces=NS)):
-            if not t.text:
-                continue
-            _replace_inline_markers_in_textnode(
-                t,
-                fig_numbers=fig_numbers,
-                tab_numbers=tab_numbers,
-            )
+    for t in marker_texts:
+        r = t.getparent()
+        if r is None or r.getparent() is None:
+            # A caption marker's original run, removed with the paragraph text.
+            continue
+        _replace_inline_markers_in_textnode(t, fig_numbers=numbers["fig"], tab_numbers=numbers["tab"])
 
 
-def _apply_table_borders(nodes: list[ET._Element]) -> None:
-    seen: set[int] = set()
-    for tbl in _iter_tables(nodes):
-        key = id(tbl)
-        if key in seen:
-            continue
-        seen.add(key)
-        _ensure_table_borders(tbl)
+def _format_body(nodes: list[ET._Element]) -> None:
+    """Apply the _BODY_HANDLERS rules to the inserted body content in one walk.
 
+    Elements are collected before any handler runs, so handlers may add
+    properties (tblPr, trPr, pPr, rPr) without disturbing the walk. A table
+    is seen before its own paragraphs, as with the former per-rule passes.
+    """
+    tags = tuple(_BODY_HANDLERS)
+    for el in [el for node in nodes for el in node.iter(*tags)]:
+        for handler in _BODY_HANDLERS[el.tag]:
+            handler(el)
+
+
+def _first(xpath: ET.XPath, el: ET._Element) -> ET._Element | None:
+    found = xpath(el)
+    return found[0] if found else None
 
-def _iter_tables(nodes: list[ET._Element]) -> list[ET._Element]:
-    out: list[ET._Element] = []
-    for node in nodes:
-        if node.tag == ET.QName(W_NS, "tbl"):
-            out.append(node)
-        out.extend(node.findall(".//w:tbl", namespaces=NS))
-    return out
+
+def _is_code_table(tbl: ET._Element) -> bool:
+    return CODE_TABLE_CAPTION in _XP_TABLE_CAPTION(tbl)
 
 
 def _ensure_table_borders(tbl: ET._Element) -> None:
-    tblpr = tbl.find("w:tblPr", namespaces=NS)
+    tblpr = _first(_XP_TBLPR, tbl)
     if tblpr is None:
         tblpr = ET.SubElement(tbl, ET.QName(W_NS, "tblPr"))
     borders = tblpr.find("w:tblBorders", namespaces=NS)
@@ -667,7 +1168,7 @@ def _apply_border_attrs(el: ET._Element) -> None:
 _MAX_TABLE_ROWS_KEEP_TOGETHER = 12
 
 
-def _keep_tables_with_surroundings(nodes: list[ET._Element]) -> None:
+def _keep_table_together(tbl: ET._Element) -> None:
     """Prevent table rows from splitting and keep small tables on one page.
 
     For ALL tables:
@@ -677,39 +1178,35 @@ def _keep_tables_with_surroundings(nodes: list[ET._Element]) -> None:
     For ALL tables:
       - keepNext on last row's paragraphs to stay with the source line below.
     """
-    for tbl in _iter_tables(nodes):
-        rows = tbl.findall("./w:tr", namespaces=NS)
-        if not rows:
-            continue
-        small = len(rows) <= _MAX_TABLE_ROWS_KEEP_TOGETHER
-        for idx, row in enumerate(rows):
-            # Prevent row from splitting across pages.
-            trpr = row.find("w:trPr", namespaces=NS)
-            if trpr is None:
-                trpr = ET.SubElement(row, ET.QName(W_NS, "trPr"))
-                row.insert(0, trpr)
-            if trpr.find("w:cantSplit", namespaces=NS) is None:
-                ET.SubElement(trpr, ET.QName(W_NS, "cantSplit"))
-            # For small tables OR the last row: keepNext to stay together.
-            is_last = idx == len(rows) - 1
-            if small or is_last:
-                for p in row.findall(".//w:p", namespaces=NS):
-                    _ensure_keep_next(p)
-
-
-def _format_tables(nodes: list[ET._Element]) -> None:
-    seen: set[int] = set()
-    for tbl in _iter_tables(nodes):
-        key = id(tbl)
-        if key in seen:
-            continue
-        seen.add(key)
-        _center_table(tbl)
+    if _is_code_table(tbl):
+        return
+    rows = _XP_ROWS(tbl)
+    if not rows:
+        return
+    small = len(rows) <= _MAX_TABLE_ROWS_KEEP_TOGETHER
+    for idx, row in enumerate(rows):
+        # Prevent row from splitting across pages.
+        trpr = _first(_XP_TRPR, row)
+        if trpr is None:
+            trpr = ET.SubElement(row, ET.QName(W_NS, "trPr"))
+            row.insert(0, trpr)
+        if trpr.find("w:cantSplit", namespaces=NS) is None:
+            ET.SubElement(trpr, ET.QName(W_NS, "cantSplit"))
+        # For small tables OR the last row: keepNext to stay together.
+        is_last = idx == len(rows) - 1
+        if small or is_last:
+            for p in _XP_DESC_PARAGRAPHS(row):
+                _ensure_keep_next(p)
+
+
+def _format_table(tbl: ET._Element) -> None:
+    _center_table(tbl)
+    if not _is_code_table(tbl):
         _bold_table_header(tbl)
 
 
 def _center_table(tbl: ET._Element) -> None:
-    tblpr = tbl.find("w:tblPr", namespaces=NS)
+    tblpr = _first(_XP_TBLPR, tbl)
     if tblpr is None:
         tblpr = ET.SubElement(tbl, ET.QName(W_NS, "tblPr"))
     jc = tblpr.find("w:jc", namespaces=NS)
@@ -719,16 +1216,15 @@ def _center_table(tbl: ET._Element) -> None:
 
 
 def _bold_table_header(tbl: ET._Element) -> None:
-    rows = tbl.findall("./w:tr", namespaces=NS)
+    rows = _XP_ROWS(tbl)
     if not rows:
         return
-    header = rows[0]
-    for r in header.findall(".//w:r", namespaces=NS):
+    for r in _XP_DESC_RUNS(rows[0]):
         _ensure_run_bold(r)
 
 
 def _ensure_run_bold(r: ET._Element) -> None:
-    rpr = r.find("w:rPr", namespaces=NS)
+    rpr = _first(_XP_RPR, r)
     if rpr is None:
         rpr = ET.Element(ET.QName(W_NS, "rPr"))
         r.insert(0, rpr)
@@ -747,35 +1243,20 @@ def _ensure_run_bold(r: ET._Element) -> None:
     b_cs.set(ET.QName(W_NS, "val"), "1")
 
 
-def _format_source_paragraphs(nodes: list[ET._Element]) -> None:
-    seen: set[int] = set()
-    for p in _iter_paragraphs(nodes):
-        key = id(p)
-        if key in seen:
-            continue
-        seen.add(key)
-        text = _paragraph_text(p).strip()
-        if not text.lower().startswith("fuente:"):
-            continue
-        _center_paragraph(p)
-        _italicize_paragraph_runs(p)
-
-
-def _iter_paragraphs(nodes: list[ET._Element]) -> list[ET._Element]:
-    out: list[ET._Element] = []
-    for node in nodes:
-        if node.tag == ET.QName(W_NS, "p"):
-            out.append(node)
-        out.extend(node.findall(".//w:p", namespaces=NS))
-    return out
+def _format_source_paragraph(p: ET._Element) -> None:
+    """Center and italicize source lines ("Fuente: ...")."""
+    if not _paragraph_text(p).strip().lower().startswith("fuente:"):
+        return
+    _center_paragraph(p)
+    _italicize_paragraph_runs(p)
 
 
 def _paragraph_text(p: ET._Element) -> str:
-    return "".join([t.text or "" for t in p.findall(".//w:t", namespaces=NS)])
+    return "".join(_XP_TEXT(p))
 
 
 def _center_paragraph(p: ET._Element) -> None:
-    ppr = p.find("w:pPr", namespaces=NS)
+    ppr = _first(_XP_PPR, p)
     if ppr is None:
         ppr = ET.SubElement(p, ET.QName(W_NS, "pPr"))
     jc = ppr.find("w:jc", namespaces=NS)
@@ -785,8 +1266,8 @@ def _center_paragraph(p: ET._Element) -> None:
 
 
 def _italicize_paragraph_runs(p: ET._Element) -> None:
-    for r in p.findall("./w:r", namespaces=NS):
-        rpr = r.find("w:rPr", namespaces=NS)
+    for r in _XP_RUNS(p):
+        rpr = _first(_XP_RPR, r)
         if rpr is None:
             rpr = ET.Element(ET.QName(W_NS, "rPr"))
             r.insert(0, rpr)
@@ -805,26 +1286,21 @@ def _italicize_paragraph_runs(p: ET._Element) -> None:
         i_cs.set(ET.QName(W_NS, "val"), "1")
 
 
-def _page_break_before_heading1(nodes: list[ET._Element]) -> None:
-    """Add pageBreakBefore to every Heading1 paragraph so each section starts on a new page."""
-    for node in nodes:
-        targets = [node] if _is_paragraph_style(node, "Heading1") else []
-        targets.extend(
-            p for p in node.findall(".//w:p", namespaces=NS)
-            if _is_paragraph_style(p, "Heading1")
-        )
-        for p in targets:
-            ppr = p.find("w:pPr", namespaces=NS)
-            if ppr is None:
-                ppr = ET.SubElement(p, ET.QName(W_NS, "pPr"))
-                p.insert(0, ppr)
-            if ppr.find("w:pageBreakBefore", namespaces=NS) is None:
-                ET.SubElement(ppr, ET.QName(W_NS, "pageBreakBefore"))
+def _page_break_before_heading1(p: ET._Element) -> None:
+    """Add pageBreakBefore to a Heading1 paragraph so each section starts on a new page."""
+    if not _is_paragraph_style(p, "Heading1"):
+        return
+    ppr = _first(_XP_PPR, p)
+    if ppr is None:
+        ppr = ET.SubElement(p, ET.QName(W_NS, "pPr"))
+        p.insert(0, ppr)
+    if ppr.find("w:pageBreakBefore", namespaces=NS) is None:
+        ET.SubElement(ppr, ET.QName(W_NS, "pageBreakBefore"))
 
 
 def _ensure_keep_next(p: ET._Element) -> None:
     """Add w:keepNext to a paragraph so it stays on the same page as the next element."""
-    ppr = p.find("w:pPr", namespaces=NS)
+    ppr = _first(_XP_PPR, p)
     if ppr is None:
         ppr = ET.SubElement(p, ET.QName(W_NS, "pPr"))
         p.insert(0, ppr)
@@ -835,37 +1311,105 @@ def _ensure_keep_next(p: ET._Element) -> None:
 
 WP_NS = "http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing"
 A_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+ASVG_NS = "http://schemas.microsoft.com/office/drawing/2016/SVG/main"
+# a:ext uri under which Office 2016+ looks for the SVG version of a picture.
+_SVG_BLIP_EXT_URI = "{96DAC541-7B7A-43D3-8B79-37D633B846F1}"
+
+
+def _attach_svg_blips(doc: ET._Element, *, svg_rel_map: dict[str, str]) -> None:
+    """Add an asvg:svgBlip extension to pictures that have an SVG part.
+
+    The a:blip keeps pointing at the PNG, which older readers display.
+    """
+    if not svg_rel_map:
+        return
+    embed_attr = f"{{{R_NS}}}embed"
+    for blip in doc.iter(f"{{{A_NS}}}blip"):
+        svg_id = svg_rel_map.get(blip.get(embed_attr) or "")
+        if svg_id is None:
+            continue
+        ext_lst = blip.find(f"{{{A_NS}}}extLst")
+        if ext_lst is None:
+            ext_lst = ET.SubElement(blip, f"{{{A_NS}}}extLst")
+        ext = ET.SubElement(ext_lst, f"{{{A_NS}}}ext", attrib={"uri": _SVG_BLIP_EXT_URI})
+        svg_blip = ET.SubElement(ext, f"{{{ASVG_NS}}}svgBlip", nsmap={"asvg": ASVG_NS})
+        svg_blip.set(embed_attr, svg_id)
 
 # Maximum image height in EMUs (5.5 inches).  Page is ~11in - 1.18in*2 margins = 8.64in usable.
 # 5.5in leaves comfortable room for caption + source line without dominating the page.
-_MAX_IMAGE_HEIGHT_EMU = int(5.5 * 914400)
+_EMU_PER_INCH = 914400
+_MAX_IMAGE_HEIGHT_EMU = int(5.5 * _EMU_PER_INCH)
+
+
+def _cap_image_height(drawing: ET._Element) -> None:
+    """Constrain an image that exceeds the maximum page height, preserving aspect ratio.
+
+    The extent is shared by the PNG and its SVG extension, so both scale together.
+    """
+    for container in list(drawing):
+        # wp:inline or wp:anchor
+        extent = container.find(f"{{{WP_NS}}}extent")
+        if extent is None:
+            continue
+        cx = int(extent.get("cx", "0"))
+        cy = int(extent.get("cy", "0"))
+        if cy <= _MAX_IMAGE_HEIGHT_EMU or cy == 0:
+            continue
+        ratio = _MAX_IMAGE_HEIGHT_EMU / cy
+        new_cx = int(cx * ratio)
+        new_cy = _MAX_IMAGE_HEIGHT_EMU
+        extent.set("cx", str(new_cx))
+        extent.set("cy", str(new_cy))
+        # Also update a:ext inside the graphic
+        for a_ext in container.iter(f"{{{A_NS}}}ext"):
+            # Skip a:extLst/a:ext entries (e.g. the svgBlip extension).
+            if a_ext.get("cy") is None:
+                continue
+            a_cx = int(a_ext.get("cx", "0"))
+            a_cy = int(a_ext.get("cy", "0"))
+            if a_cy > _MAX_IMAGE_HEIGHT_EMU:
+                a_ext.set("cx", str(int(a_cx * ratio)))
+                a_ext.set("cy", str(new_cy))
 
 
-def _cap_image_heights(nodes: list[ET._Element]) -> None:
-    """Constrain images that exceed the maximum page height, preserving aspect ratio."""
+def _downsample_images(
+    nodes: list[ET._Element],
+    *,
+    tmpl_rels: ET._Element,
+    added_media: dict[str, bytes],
+    dpi: int,
+) -> None:
+    """Resample added media to `dpi` at the largest size it is displayed at."""
+    embed_attr = f"{{{R_NS}}}embed"
+    # rId -> largest displayed extent (cx, cy) in EMUs
+    extents: dict[str, tuple[int, int]] = {}
     for node in nodes:
-        for drawing in list(node.findall(".//w:drawing", namespaces=NS)):
-            for container in list(drawing):
-                # wp:inline or wp:anchor
+        for drawing in node.iter(f"{{{W_NS}}}drawing"):
+            for container in drawing:
                 extent = container.find(f"{{{WP_NS}}}extent")
                 if extent is None:
                     continue
                 cx = int(extent.get("cx", "0"))
                 cy = int(extent.get("cy", "0"))
-                if cy <= _MAX_IMAGE_HEIGHT_EMU or cy == 0:
-                    continue
-                ratio = _MAX_IMAGE_HEIGHT_EMU / cy
-                new_cx = int(cx * ratio)
-                new_cy = _MAX_IMAGE_HEIGHT_EMU
-                extent.set("cx", str(new_cx))
-                extent.set("cy", str(new_cy))
-                # Also update a:ext inside the graphic
-                for a_ext in container.findall(f".//{{{A_NS}}}ext"):
-                    a_cx = int(a_ext.get("cx", "0"))
-                    a_cy = int(a_ext.get("cy", "0"))
-                    if a_cy > _MAX_IMAGE_HEIGHT_EMU:
-                        a_ext.set("cx", str(int(a_cx * ratio)))
-                        a_ext.set("cy", str(new_cy))
+                for blip in container.iter(f"{{{A_NS}}}blip"):
+                    rid = blip.get(embed_attr)
+                    if rid:
+                        prev = extents.get(rid, (0, 0))
+                        extents[rid] = (max(prev[0], cx), max(prev[1], cy))
+
+    for rel in tmpl_rels.findall(f"{{{PKG_REL_NS}}}Relationship"):
+        size = extents.get(rel.get("Id") or "")
+        path = f"word/{rel.get('Target') or ''}"
+        if size is None or path not in added_media:
+            continue
+        resampled = downsample_image(
+            added_media[path],
+            ext=path.rsplit(".", 1)[-1],
+            max_width=math.ceil(size[0] / _EMU_PER_INCH * dpi),
+            max_height=math.ceil(size[1] / _EMU_PER_INCH * dpi),
+        )
+        if resampled is not None:
+            added_media[path] = resampled
 
 
 def _clear_toc_placeholders(doc: ET._Element) -> None:
@@ -995,30 +1539,31 @@ def _make_bib_paragraph(text: str) -> ET._Element:
     return new_p
 
 
-def _replace_bibliography_cache(doc: ET._Element, sources: list[BibSource]) -> None:
-    """Replace the cached BIBLIOGRAPHY field result with actual formatted entries.
-
-    The template's inner bibliography SDT contains a single paragraph with
-    the BIBLIOGRAPHY field and cached result runs.  We rebuild the entire
-    inner SDT content: one field paragraph (begin/instr/separate/result/end)
-    plus one extra paragraph per additional source.
-    """
+def _find_bibliography_container(doc: ET._Element) -> ET._Element | None:
+    """The element (sdtContent) holding the template's BIBLIOGRAPHY field paragraph."""
     bib_instr = doc.xpath(
         "//w:instrText[contains(., 'BIBLIOGRAPHY')]", namespaces=NS
     )
     if not bib_instr:
-        return
+        return None
 
     # Navigate up to the paragraph, then its container (sdtContent).
     p = bib_instr[0].getparent()
     while p is not None and p.tag != ET.QName(W_NS, "p"):
         p = p.getparent()
     if p is None:
-        return
-    container = p.getparent()
-    if container is None:
-        return
+        return None
+    return p.getparent()
+
+
+def _replace_bibliography_cache(container: ET._Element, sources: list[BibSource]) -> None:
+    """Replace the cached BIBLIOGRAPHY field result with actual formatted entries.
 
+    The template's inner bibliography SDT contains a single paragraph with
+    the BIBLIOGRAPHY field and cached result runs.  We rebuild the entire
+    inner SDT content: one field paragraph (begin/instr/separate/result/end)
+    plus one extra paragraph per additional source.
+    """
     # Remove all existing content from the container.
     for child in list(container):
         container.remove(child)
@@ -1104,28 +1649,36 @@ def _set_settings_language(settings: ET._Element, lang_code: str) -> None:
 _HEX_COLOR_RE = re.compile(r"^#([0-9a-fA-F]{6})$")
 
 
-def _apply_color_swatches(nodes: list[ET._Element]) -> None:
+def _apply_color_swatches(tbl: ET._Element) -> None:
     """Find table cells containing a hex color code and apply that color as cell shading."""
-    for tbl in _iter_tables(nodes):
-        for row in tbl.findall("./w:tr", namespaces=NS):
-            for tc in row.findall("./w:tc", namespaces=NS):
-                cell_text = "".join(
-                    t.text or "" for t in tc.findall(".//w:t", namespaces=NS)
-                ).strip()
-                m = _HEX_COLOR_RE.match(cell_text)
-                if not m:
-                    continue
-                color = m.group(1).upper()
-                tcpr = tc.find("w:tcPr", namespaces=NS)
-                if tcpr is None:
-                    tcpr = ET.SubElement(tc, ET.QName(W_NS, "tcPr"))
-                    tc.insert(0, tcpr)
-                shd = tcpr.find("w:shd", namespaces=NS)
-                if shd is None:
-                    shd = ET.SubElement(tcpr, ET.QName(W_NS, "shd"))
-                shd.set(ET.QName(W_NS, "val"), "clear")
-                shd.set(ET.QName(W_NS, "color"), "auto")
-                shd.set(ET.QName(W_NS, "fill"), color)
+    if _is_code_table(tbl):
+        return
+    for row in _XP_ROWS(tbl):
+        for tc in _XP_CELLS(row):
+            m = _HEX_COLOR_RE.match("".join(_XP_TEXT(tc)).strip())
+            if not m:
+                continue
+            color = m.group(1).upper()
+            tcpr = _first(_XP_TCPR, tc)
+            if tcpr is None:
+                tcpr = ET.SubElement(tc, ET.QName(W_NS, "tcPr"))
+                tc.insert(0, tcpr)
+            shd = tcpr.find("w:shd", namespaces=NS)
+            if shd is None:
+                shd = ET.SubElement(tcpr, ET.QName(W_NS, "shd"))
+            shd.set(ET.QName(W_NS, "val"), "clear")
+            shd.set(ET.QName(W_NS, "color"), "auto")
+            shd.set(ET.QName(W_NS, "fill"), color)
+
+
+# Formatting rules for the inserted body content, by element tag, in the
+# order they apply to each element. _format_body runs them all in a single
+# walk, so a new rule is a new handler here rather than another traversal.
+_BODY_HANDLERS: dict[str, tuple[Callable[[ET._Element], None], ...]] = {
+    _W_TBL: (_ensure_table_borders, _format_table, _keep_table_together, _apply_color_swatches),
+    _W_P: (_format_source_paragraph, _page_break_before_heading1),
+    _W_DRAWING: (_cap_image_height,),
+}
 
 
 def _replace_inline_markers_in_textnode(
@@ -1200,16 +1753,12 @@ def _center_captioned_figure_images(doc: ET._Element) -> None:
 
 def _insert_after_textnode(t: ET._Element, new_nodes: list[ET._Element]) -> None:
     # Insert after the parent run of this text node.
-    r = t.getparent()
-    if r is None:
+    anchor = t.getparent()
+    if anchor is None or anchor.getparent() is None:
         return
-    p = r.getparent()
-    if p is None:
-        return
-    idx = list(p).index(r)
     for n in new_nodes:
-        idx += 1
-        p.insert(idx, n)
+        anchor.addnext(n)
+        anchor = n
 
 
 def _replace_paragraph_with_caption(
@@ -1366,7 +1915,7 @@ def _bookmark_name(kind: str, raw_id: str) -> str:
 
 def _max_bookmark_id(doc: ET._Element) -> int:
     max_id = 0
-    for bm in doc.findall(".//w:bookmarkStart", namespaces=NS):
+    for bm in doc.iter(f"{{{W_NS}}}bookmarkStart"):
         raw = bm.get(ET.QName(W_NS, "id"))
         if raw is None:
             continue
@@ -1378,6 +1927,26 @@ def _max_bookmark_id(doc: ET._Element) -> int:
     return max_id
 
 
+def _shift_bookmark_ids(nodes: list[ET._Element], *, offset: int) -> None:
+    # Bodies with fields already in place (native writer, Lua filter) carry
+    # their own bookmark ids; move them above the template's.
+    if not offset:
+        return
+    id_attr = ET.QName(W_NS, "id")
+    for node in nodes:
+        for bm in node.iter(ET.QName(W_NS, "bookmarkStart"), ET.QName(W_NS, "bookmarkEnd")):
+            raw = bm.get(id_attr)
+            if raw is not None and raw.isdigit():
+                bm.set(id_attr, str(int(raw) + offset))
+
+
+def _keep_captions_with_next(nodes: list[ET._Element]) -> None:
+    # Same as _replace_paragraph_with_caption does for marker captions.
+    for node in nodes:
+        if _is_paragraph_style(node, "Caption"):
+            _ensure_keep_next(node)
+
+
 def _stable_int(s: str) -> int:
     # Deterministic pseudo-id
     h = 0
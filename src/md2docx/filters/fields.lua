@@ -0,0 +1,169 @@
+-- Emits the Word structures for md2docx markers during pandoc conversion:
+-- caption paragraphs with a bookmark and a SEQ field, REF fields and
+-- CITATION content controls. Mirrors md2docx.docxops, which still handles
+-- marker text that reaches the docx (e.g. through `pandoc server`, which
+-- runs no filters).
+
+-- doc:walk and pandoc.Inlines need pandoc 2.17. With an older pandoc the
+-- filter does nothing and docxops replaces the markers instead.
+local function pandoc_at_least(major, minor)
+  local v = PANDOC_VERSION
+  if v == nil then
+    return false
+  end
+  local a, b = v[1] or 0, v[2] or 0
+  return a > major or (a == major and b >= minor)
+end
+
+if not pandoc_at_least(2, 17) then
+  return {}
+end
+
+local CAPTION_PATTERN = "^%[%[MD2DOCX_CAPTION_(%u%u%u):([%w_%-]+)|(.*)%]%]$"
+local INLINE_PATTERN = "%[%[MD2DOCX_([%u]+):([%w_:%-]+)%]%]"
+
+local LABELS = { FIG = "Figura", TAB = "Tabla" }
+local KINDS = { FIG = "fig", TAB = "tab" }
+
+-- Bookmark ids only need to be unique within the body; md2docx moves them
+-- above the template's ids. Start high to stay clear of pandoc's own.
+local BOOKMARK_BASE = 100000
+
+local numbers = { fig = {}, tab = {} }
+local counts = { fig = 0, tab = 0 }
+local next_bookmark = BOOKMARK_BASE
+
+local function escape(s)
+  return (s:gsub("&", "&amp;"):gsub("<", "&lt;"):gsub(">", "&gt;"):gsub('"', "&quot;"))
+end
+
+local function text_run(text)
+  return '<w:r><w:t xml:space="preserve">' .. escape(text) .. "</w:t></w:r>"
+end
+
+local function field_runs(instr, result)
+  return '<w:r><w:fldChar w:fldCharType="begin"/></w:r>'
+    .. '<w:r><w:instrText xml:space="preserve"> ' .. escape(instr) .. " </w:instrText></w:r>"
+    .. '<w:r><w:fldChar w:fldCharType="separate"/></w:r>'
+    .. "<w:r><w:rPr><w:noProof/></w:rPr><w:t>" .. escape(result) .. "</w:t></w:r>"
+    .. '<w:r><w:fldChar w:fldCharType="end"/></w:r>'
+end
+
+-- Same id as docxops._stable_int.
+local function stable_int(s)
+  local h = 0
+  for i = 1, #s do
+    h = (h * 131 + s:byte(i)) & 0x7FFFFFFF
+  end
+  if h == 0 then
+    h = 1
+  end
+  return h
+end
+
+local function bookmark_name(kind, raw_id)
+  local base = raw_id:gsub("[^%w_]+", "_")
+  if not base:match("^%a") then
+    base = "x_" .. base
+  end
+  return kind .. "_" .. base
+end
+
+local function caption_marker(div)
+  if div.attributes["custom-style"] ~= "Caption" or #div.content ~= 1 then
+    return nil
+  end
+  local text = pandoc.utils.stringify(div.content[1])
+  return text:match(CAPTION_PATTERN)
+end
+
+local function number_captions(doc)
+  -- REF fields may precede their caption, so number everything first.
+  doc:walk({
+    Div = function(div)
+      local label, id = caption_marker(div)
+      if label and KINDS[label] then
+        local kind = KINDS[label]
+        if not numbers[kind][id] then
+          counts[kind] = counts[kind] + 1
+          numbers[kind][id] = counts[kind]
+        end
+      end
+    end,
+  })
+  return nil
+end
+
+local function caption_block(div)
+  local label, id, title = caption_marker(div)
+  if not (label and KINDS[label]) then
+    return nil
+  end
+  local kind = KINDS[label]
+  next_bookmark = next_bookmark + 1
+  local xml = '<w:bookmarkStart w:id="' .. next_bookmark .. '" w:name="' .. bookmark_name(kind, id) .. '"/>'
+    .. text_run(LABELS[label] .. " ")
+    .. field_runs("SEQ " .. LABELS[label] .. " \\* ARABIC", tostring(numbers[kind][id]))
+    .. '<w:bookmarkEnd w:id="' .. next_bookmark .. '"/>'
+    .. text_run(". " .. title)
+  -- A paragraph in the Caption div rather than a raw block: pandoc styles
+  -- the paragraph after a raw block as "First Paragraph".
+  div.content = { pandoc.Para({ pandoc.RawInline("openxml", xml) }) }
+  return div
+end
+
+local function inline_field(kind, arg)
+  if kind == "CITATION" then
+    return pandoc.RawInline(
+      "openxml",
+      '<w:sdt><w:sdtPr><w:id w:val="' .. stable_int(arg) .. '"/><w:citation/></w:sdtPr><w:sdtEndPr/><w:sdtContent>'
+        .. field_runs("CITATION " .. arg .. " \\l 12298", "(Cita)")
+        .. "</w:sdtContent></w:sdt>"
+    )
+  end
+  local ref_kind, id = arg:match("^(%a+):([%w_%-]+)$")
+  if kind ~= "REF" or not numbers[ref_kind or ""] then
+    return nil
+  end
+  local label = ref_kind == "fig" and "Figura" or "Tabla"
+  local n = numbers[ref_kind][id]
+  local result = n and (label .. " " .. n) or label
+  return pandoc.RawInline("openxml", field_runs("REF " .. bookmark_name(ref_kind, id) .. " \\h", result))
+end
+
+local function replace_inline_markers(str)
+  local text = str.text
+  if not text:find("[[MD2DOCX_", 1, true) then
+    return nil
+  end
+  local out = pandoc.Inlines({})
+  local pos = 1
+  while true do
+    local s, e, kind, arg = text:find(INLINE_PATTERN, pos)
+    if not s then
+      break
+    end
+    local field = inline_field(kind, arg)
+    if field then
+      if s > pos then
+        out:insert(pandoc.Str(text:sub(pos, s - 1)))
+      end
+      out:insert(field)
+    else
+      out:insert(pandoc.Str(text:sub(pos, e)))
+    end
+    pos = e + 1
+  end
+  if pos == 1 then
+    return nil
+  end
+  if pos <= #text then
+    out:insert(pandoc.Str(text:sub(pos)))
+  end
+  return out
+end
+
+return {
+  { Pandoc = number_captions },
+  { Div = caption_block, Str = replace_inline_markers },
+}
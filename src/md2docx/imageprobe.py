@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+import io
+import re
+import struct
+from typing import BinaryIO
+
+from lxml import etree as ET
+
+
+# SVG lengths are converted to CSS pixels (96 per inch).
+_SVG_UNITS_PX = {
+    "": 1.0,
+    "px": 1.0,
+    "pt": 96 / 72,
+    "pc": 16.0,
+    "in": 96.0,
+    "cm": 96 / 2.54,
+    "mm": 96 / 25.4,
+}
+_SVG_LENGTH_RE = re.compile(r"^\s*([0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)\s*([a-z]*)\s*$")
+
+# JPEG start-of-frame markers (SOF0..SOF15 minus DHT, JPG and DAC).
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+@dataclass(frozen=True)
+class ImageInfo:
+    format: str  # "png" | "jpeg" | "gif" | "webp" | "svg"
+    # Pixels; CSS pixels for SVG.
+    width: int
+    height: int
+    # (x, y) pixels per inch when the file declares it.
+    dpi: tuple[float, float] | None = None
+
+
+def probe_image(path: Path) -> ImageInfo | None:
+    """Size, DPI and format of an image file, reading only its header.
+
+    Returns None for unknown or truncated files. Results are memoized by
+    path, mtime and size.
+    """
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return _probe_file(str(path), st.st_mtime_ns, st.st_size)
+
+
+def probe_image_bytes(data: bytes) -> ImageInfo | None:
+    return _probe_stream(io.BytesIO(data))
+
+
+@lru_cache(maxsize=1024)
+def _probe_file(path: str, mtime_ns: int, size: int) -> ImageInfo | None:
+    try:
+        with open(path, "rb") as f:
+            return _probe_stream(f)
+    except OSError:
+        return None
+
+
+def _probe_stream(f: BinaryIO) -> ImageInfo | None:
+    head = f.read(32)
+    f.seek(0)
+    try:
+        if head.startswith(b"\x89PNG\r\n\x1a\n"):
+            return _probe_png(f)
+        if head.startswith(b"\xff\xd8"):
+            return _probe_jpeg(f)
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            w, h = struct.unpack("<HH", head[6:10])
+            return ImageInfo(format="gif", width=w, height=h)
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return _probe_webp(head)
+        if b"<svg" in head or head.lstrip().startswith((b"<?xml", b"<!--", b"<!DOCTYPE")):
+            return _probe_svg(f)
+    except (struct.error, ValueError, ET.XMLSyntaxError):
+        return None
+    return None
+
+
+def _probe_png(f: BinaryIO) -> ImageInfo | None:
+    f.seek(8)
+    width = height = 0
+    dpi = None
+    # IHDR comes first; pHYs, if any, comes before the first IDAT.
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, ctype = struct.unpack(">I4s", header)
+        if ctype == b"IHDR":
+            width, height = struct.unpack(">II", f.read(8))
+            f.seek(length - 8 + 4, io.SEEK_CUR)
+        elif ctype == b"pHYs":
+            ppu_x, ppu_y, unit = struct.unpack(">IIB", f.read(9))
+            if unit == 1:
+                dpi = (ppu_x * 0.0254, ppu_y * 0.0254)
+            f.seek(length - 9 + 4, io.SEEK_CUR)
+        elif ctype in (b"IDAT", b"IEND"):
+            break
+        else:
+            f.seek(length + 4, io.SEEK_CUR)
+    if not width or not height:
+        return None
+    return ImageInfo(format="png", width=width, height=height, dpi=dpi)
+
+
+def _probe_jpeg(f: BinaryIO) -> ImageInfo | None:
+    f.seek(2)
+    dpi = None
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+            continue
+        if code == 0xD9:
+            return None
+        (length,) = struct.unpack(">H", f.read(2))
+        if code == 0xE0 and length >= 14:
+            segment = f.read(length - 2)
+            if segment[:5] == b"JFIF\x00":
+                unit, x, y = struct.unpack(">BHH", segment[7:12])
+                if unit == 1:
+                    dpi = (float(x), float(y))
+                elif unit == 2:
+                    dpi = (x * 2.54, y * 2.54)
+            continue
+        if code in _JPEG_SOF:
+            _, height, width = struct.unpack(">BHH", f.read(5))
+            return ImageInfo(format="jpeg", width=width, height=height, dpi=dpi)
+        f.seek(length - 2, io.SEEK_CUR)
+
+
+def _probe_webp(head: bytes) -> ImageInfo | None:
+    chunk = head[12:16]
+    if chunk == b"VP8 ":
+        w, h = struct.unpack("<HH", head[26:30])
+        return ImageInfo(format="webp", width=w & 0x3FFF, height=h & 0x3FFF)
+    if chunk == b"VP8L":
+        bits = int.from_bytes(head[21:25], "little")
+        return ImageInfo(format="webp", width=(bits & 0x3FFF) + 1, height=((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b"VP8X":
+        w = int.from_bytes(head[24:27], "little") + 1
+        h = int.from_bytes(head[27:30], "little") + 1
+        return ImageInfo(format="webp", width=w, height=h)
+    return None
+
+
+def _probe_svg(f: BinaryIO) -> ImageInfo | None:
+    # Only the root element is parsed.
+    for _, root in ET.iterparse(f, events=("start",), resolve_entities=False, no_network=True):
+        if ET.QName(root).localname != "svg":
+            return None
+        width = _svg_length(root.get("width"))
+        height = _svg_length(root.get("height"))
+        if width is None or height is None:
+            view_box = (root.get("viewBox") or "").replace(",", " ").split()
+            if len(view_box) != 4:
+                return None
+            vb_w, vb_h = float(view_box[2]), float(view_box[3])
+            if vb_w <= 0 or vb_h <= 0:
+                return None
+            if width is None and height is None:
+                width, height = vb_w, vb_h
+            elif width is None:
+                width = height * vb_w / vb_h
+            else:
+                height = width * vb_h / vb_w
+        return ImageInfo(format="svg", width=round(width), height=round(height), dpi=(96.0, 96.0))
+    return None
+
+
+def _svg_length(value: str | None) -> float | None:
+    if not value:
+        return None
+    m = _SVG_LENGTH_RE.match(value)
+    if not m or m.group(2) not in _SVG_UNITS_PX:
+        # Percentages and unknown units depend on the viewport.
+        return None
+    return float(m.group(1)) * _SVG_UNITS_PX[m.group(2)]
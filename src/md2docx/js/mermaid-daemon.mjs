@@ -0,0 +1,149 @@
+// Long-running Mermaid renderer for md2docx.
+//
+// Keeps one headless Chromium alive and renders diagrams on request through
+// mermaid-cli's renderMermaid() API. Requests arrive over a local TCP socket
+// as one JSON object per line; each reply is one JSON line:
+//
+//   -> {"definition": "...", "format": "png", "scale": 4, "width": 1600, "backgroundColor": "transparent"}
+//   <- {"ok": true, "data": "<base64>"}  |  {"ok": false, "error": "..."}
+//
+// Started by `md2docx mermaid-daemon`; not meant to be run by hand.
+
+import fs from "node:fs";
+import net from "node:net";
+import path from "node:path";
+import { createRequire } from "node:module";
+import { pathToFileURL } from "node:url";
+
+function parseArgs(argv) {
+  const out = {};
+  for (let i = 0; i < argv.length; i++) {
+    const a = argv[i];
+    if (a.startsWith("--")) {
+      out[a.slice(2)] = argv[i + 1];
+      i++;
+    }
+  }
+  return out;
+}
+
+function packageEntry(moduleDir) {
+  const pkg = JSON.parse(fs.readFileSync(path.join(moduleDir, "package.json"), "utf8"));
+  let entry = null;
+  const exp = pkg.exports && (pkg.exports["."] ?? pkg.exports);
+  if (typeof exp === "string") {
+    entry = exp;
+  } else if (exp && typeof exp === "object") {
+    entry = exp.import ?? exp.default ?? null;
+    if (entry && typeof entry === "object") entry = entry.default ?? null;
+  }
+  entry = entry ?? pkg.module ?? pkg.main ?? "index.js";
+  return pathToFileURL(path.join(moduleDir, entry)).href;
+}
+
+const args = parseArgs(process.argv.slice(2));
+const host = args.host ?? "127.0.0.1";
+const port = Number(args.port ?? 7337);
+const maxPages = Math.max(1, Number(args.pages ?? 4));
+const moduleDir = args["module-dir"];
+if (!moduleDir) {
+  console.error("mermaid-daemon: --module-dir is required");
+  process.exit(2);
+}
+
+const { renderMermaid } = await import(packageEntry(moduleDir));
+const requireFromCli = createRequire(path.join(moduleDir, "package.json"));
+const puppeteer = (await import(pathToFileURL(requireFromCli.resolve("puppeteer")).href)).default;
+
+let launchOpts = { headless: "shell" };
+if (args["puppeteer-config"]) {
+  launchOpts = { ...launchOpts, ...JSON.parse(fs.readFileSync(args["puppeteer-config"], "utf8")) };
+}
+
+let browserPromise = null;
+
+function getBrowser() {
+  if (!browserPromise) {
+    browserPromise = puppeteer.launch(launchOpts).then((browser) => {
+      browser.on("disconnected", () => {
+        browserPromise = null;
+      });
+      return browser;
+    });
+  }
+  return browserPromise;
+}
+
+// Bound the number of concurrently open pages.
+let active = 0;
+const waiting = [];
+
+async function withPage(fn) {
+  if (active >= maxPages) {
+    await new Promise((resolve) => waiting.push(resolve));
+  }
+  active++;
+  try {
+    return await fn();
+  } finally {
+    active--;
+    const next = waiting.shift();
+    if (next) next();
+  }
+}
+
+async function render(req) {
+  const browser = await getBrowser();
+  const format = req.format ?? "png";
+  const { data } = await withPage(() =>
+    renderMermaid(browser, req.definition, format, {
+      viewport: {
+        width: Number(req.width ?? 800),
+        height: Number(req.height ?? 600),
+        deviceScaleFactor: Number(req.scale ?? 1),
+      },
+      backgroundColor: req.backgroundColor ?? "white",
+      mermaidConfig: req.mermaidConfig ?? { theme: "default" },
+    }),
+  );
+  return Buffer.from(data).toString("base64");
+}
+
+const server = net.createServer((socket) => {
+  let buf = "";
+  socket.setEncoding("utf8");
+  socket.on("data", async (chunk) => {
+    buf += chunk;
+    let nl;
+    while ((nl = buf.indexOf("\n")) >= 0) {
+      const line = buf.slice(0, nl);
+      buf = buf.slice(nl + 1);
+      if (!line.trim()) continue;
+      let reply;
+      try {
+        reply = { ok: true, data: await render(JSON.parse(line)) };
+      } catch (err) {
+        reply = { ok: false, error: String(err && err.message ? err.message : err) };
+      }
+      socket.write(JSON.stringify(reply) + "\n");
+    }
+  });
+  socket.on("error", () => {});
+});
+
+await getBrowser();
+server.listen(port, host, () => {
+  console.log(`mermaid-daemon listening on ${host}:${port} (pages=${maxPages})`);
+});
+
+for (const sig of ["SIGINT", "SIGTERM"]) {
+  process.on(sig, async () => {
+    server.close();
+    if (browserPromise) {
+      try {
+        await (await browserPromise).close();
+      } catch {}
+    }
+    process.exit(0);
+  });
+}
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import PurePosixPath
+import io
+import os
+import subprocess
+
+from PIL import Image
+
+from md2docx.imageprobe import probe_image_bytes
+
+
+# A PNG is re-encoded as JPEG only when that is at most this fraction of the
+# (already optimized) PNG size: photos shrink a lot, screenshots barely do.
+JPEG_MAX_RATIO = 0.5
+JPEG_QUALITY = 85
+
+# Images with at most this many distinct colors are treated as flat-color
+# diagrams and quantized to a 256-color palette. Opaque images with <= 256
+# colors get an exact palette, so the conversion is lossless.
+PALETTE_MAX_COLORS = 4096
+
+_PALETTE_SIZE = 256
+
+# Raster formats that can be resampled; vector (svg, emf, wmf) and possibly
+# animated (gif) images are kept as they are.
+RESAMPLE_EXTS = ("png", "jpg", "jpeg", "bmp", "tif", "tiff", "webp")
+# Do not resample images that are at most this much larger than needed.
+RESAMPLE_SLACK = 1.1
+_EXIF_ORIENTATION = 0x0112
+
+# Authored SVG images are embedded with a PNG rendering for the a:blip, at
+# this multiple of their CSS pixel size. rsvg-convert is also what pandoc
+# uses to rasterize SVG.
+SVG_FALLBACK_ZOOM = 2.0
+_RSVG_TIMEOUT_S = 60
+
+
+@dataclass(frozen=True)
+class ImageSaving:
+    original_path: str
+    # Zip path of the optimized part (differs when converted to JPEG).
+    path: str
+    original_bytes: int
+    data: bytes
+    method: str  # "png" | "palette" | "jpeg" | "unchanged"
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - len(self.data)
+
+
+@dataclass(frozen=True)
+class MediaReport:
+    images: list[ImageSaving]
+
+    @property
+    def saved_bytes(self) -> int:
+        return sum(i.saved_bytes for i in self.images)
+
+    def to_text(self) -> str:
+        lines = []
+        for img in self.images:
+            if img.method == "unchanged":
+                continue
+            lines.append(
+                f"  {PurePosixPath(img.original_path).name}: {img.original_bytes / 1024:.1f} KB -> "
+                f"{len(img.data) / 1024:.1f} KB ({img.method})"
+            )
+        total = sum(i.original_bytes for i in self.images)
+        lines.append(
+            f"Media: {len(self.images)} images, saved {self.saved_bytes / 1024:.1f} KB of {total / 1024:.1f} KB"
+        )
+        return "\n".join(lines)
+
+
+def optimize_media(media: dict[str, bytes], *, max_workers: int | None = None) -> MediaReport:
+    """Recompress the PNG parts of `media` (zip path -> bytes).
+
+    Metadata chunks are dropped, flat-color images are palettized and opaque
+    photographic images become JPEG when that is much smaller. A part is only
+    replaced when the result is smaller. Non-PNG parts are left untouched.
+    """
+    paths = [p for p in media if p.lower().endswith(".png")]
+    if not paths:
+        return MediaReport(images=[])
+
+    workers = max(1, min(len(paths), max_workers or os.cpu_count() or 2))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="md2docx-media") as pool:
+        images = list(pool.map(lambda p: _optimize_png(p, media[p]), paths))
+    return MediaReport(images=images)
+
+
+def downsample_image(data: bytes, *, ext: str, max_width: int, max_height: int) -> bytes | None:
+    """Shrink a raster image to fit max_width x max_height pixels.
+
+    Returns None when the image is not resampled (vector or unknown format,
+    already small enough, or EXIF-rotated JPEG).
+    """
+    ext = ext.lower()
+    if ext not in RESAMPLE_EXTS or max_width <= 0 or max_height <= 0:
+        return None
+    info = probe_image_bytes(data)
+    if info is not None and info.width <= max_width * RESAMPLE_SLACK and info.height <= max_height * RESAMPLE_SLACK:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            if im.width <= max_width * RESAMPLE_SLACK and im.height <= max_height * RESAMPLE_SLACK:
+                return None
+            if im.getexif().get(_EXIF_ORIENTATION, 1) != 1:
+                return None
+            fmt = im.format
+            img = im.convert("RGBA") if im.mode in ("P", "LA", "1") or "transparency" in im.info else im.copy()
+    except OSError:
+        return None
+
+    ratio = min(max_width / img.width, max_height / img.height)
+    size = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+    img = img.resize(size, Image.Resampling.LANCZOS)
+
+    buf = io.BytesIO()
+    if fmt == "JPEG":
+        img.convert("RGB").save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        img.save(buf, format=fmt or "PNG")
+    out = buf.getvalue()
+    return out if len(out) < len(data) else None
+
+
+def convert_to_png(data: bytes) -> bytes:
+    """Re-encode a raster image Word cannot display (e.g. WebP) as PNG."""
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            img = im.convert("RGBA") if im.mode not in ("RGB", "RGBA", "L", "LA", "P") else im.copy()
+    except OSError as e:
+        raise RuntimeError(f"Unable to decode image: {e}") from e
+    return _save_png(img)
+
+
+def rasterize_svg(data: bytes, *, zoom: float = SVG_FALLBACK_ZOOM) -> bytes:
+    """Render an SVG to PNG with rsvg-convert."""
+    cmd = ["rsvg-convert", "--format", "png", "--zoom", str(zoom)]
+    try:
+        p = subprocess.run(cmd, input=data, capture_output=True, timeout=_RSVG_TIMEOUT_S)
+    except FileNotFoundError as e:
+        raise RuntimeError("rsvg-convert (librsvg) is required to embed SVG images") from e
+    except subprocess.TimeoutExpired as e:
+        raise RuntimeError(f"rsvg-convert timed out after {_RSVG_TIMEOUT_S}s") from e
+    if p.returncode != 0 or not p.stdout:
+        stderr = p.stderr.decode("utf-8", errors="replace").strip()
+        raise RuntimeError(f"rsvg-convert failed (code {p.returncode}): {stderr}")
+    return p.stdout
+
+
+def _optimize_png(path: str, data: bytes) -> ImageSaving:
+    best = ImageSaving(original_path=path, path=path, original_bytes=len(data), data=data, method="unchanged")
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            im.load()
+            img = im.copy()
+    except OSError:
+        return best
+
+    if img.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+        return best
+
+    def consider(candidate: bytes, *, method: str, ext: str = "png") -> None:
+        nonlocal best
+        if len(candidate) < len(best.data):
+            out_path = str(PurePosixPath(path).with_suffix(f".{ext}"))
+            best = ImageSaving(
+                original_path=path, path=out_path, original_bytes=len(data), data=candidate, method=method
+            )
+
+    # Lossless re-encode at maximum zlib effort; ancillary chunks (text, time,
+    # ICC, pHYs) are not carried over.
+    consider(_save_png(img), method="png")
+
+    palette = _to_palette(img)
+    if palette is not None:
+        consider(_save_png(palette), method="palette")
+    elif _is_opaque(img):
+        jpeg = _save_jpeg(img)
+        if len(jpeg) <= JPEG_MAX_RATIO * len(best.data):
+            consider(jpeg, method="jpeg", ext="jpg")
+
+    return best
+
+
+def _save_png(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def _save_jpeg(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return buf.getvalue()
+
+
+def _is_opaque(img: Image.Image) -> bool:
+    if img.mode in ("LA", "RGBA"):
+        lo, _ = img.getchannel("A").getextrema()
+        return lo == 255
+    return "transparency" not in img.info
+
+
+def _to_palette(img: Image.Image) -> Image.Image | None:
+    if img.mode in ("1", "P"):
+        return None
+    rgba = img.convert("RGBA")
+    colors = rgba.getcolors(PALETTE_MAX_COLORS)
+    if colors is None:
+        return None
+    if len(colors) <= _PALETTE_SIZE and _is_opaque(img):
+        # Exact palette: every pixel maps to its own color, nothing is lost.
+        palette = Image.new("P", (1, 1))
+        palette.putpalette([c for _, rgba_color in colors for c in rgba_color[:3]])
+        return img.convert("RGB").quantize(palette=palette, dither=Image.Dither.NONE)
+    return rgba.quantize(colors=_PALETTE_SIZE, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
@@ -1,75 +1,328 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from pathlib import Path
+import base64
+import json
+import math
+import socket
 import subprocess
 import tempfile
 import os
 import shutil
 
 
+# Render options. They are part of the render cache key, so any change here
+# invalidates previously cached diagrams.
+MERMAID_SCALE = "4"
+# PNG fallback next to an embedded SVG only needs to be legible in old readers.
+MERMAID_FALLBACK_SCALE = "1"
+MERMAID_WIDTH = "1600"
+# Mermaid lays diagrams out in CSS pixels, 96 per inch.
+_CSS_PX_PER_IN = 96
+MERMAID_BACKGROUND = "transparent"
+
+# When set (host:port), renders go to a running `md2docx mermaid-daemon` first
+# and fall back to spawning mmdc when the daemon is unreachable.
+MERMAID_DAEMON_ENV = "MD2DOCX_MERMAID_DAEMON"
+MERMAID_DAEMON_DEFAULT_PORT = 7337
+_DAEMON_CONNECT_TIMEOUT_S = 2.0
+_DAEMON_RENDER_TIMEOUT_S = 120.0
+_VERSION_PROBE_TIMEOUT_S = 15.0
+
+
+# SVG output is embedded in Word, which ignores <foreignObject>; plain SVG
+# text labels keep the labels visible.
+_SVG_MERMAID_CONFIG = {"htmlLabels": False, "flowchart": {"htmlLabels": False}}
+
+
 def render_mermaid_to_png(mermaid_src: str, *, output_png: Path) -> None:
-    output_png.parent.mkdir(parents=True, exist_ok=True)
+    render_mermaid(mermaid_src, output=output_png, fmt="png")
+
+
+def mermaid_size_for_dpi(dpi: int, *, max_width_in: float) -> tuple[str, str]:
+    """Return (scale, width) rendering a full-width diagram at `dpi` pixels per inch.
+
+    mmdc only accepts integer scale factors, so the viewport width (CSS px)
+    absorbs the remainder: diagrams that fill it come out at exactly
+    `max_width_in * dpi` pixels.
+    """
+    scale = max(1, math.ceil(dpi / _CSS_PX_PER_IN))
+    return str(scale), str(round(max_width_in * dpi / scale))
+
+
+def render_mermaid(
+    mermaid_src: str,
+    *,
+    output: Path,
+    fmt: str = "png",
+    scale: str = MERMAID_SCALE,
+    width: str = MERMAID_WIDTH,
+) -> None:
+    """Render one diagram to `output` as "png" or "svg"."""
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    if _render_via_daemon(mermaid_src, output=output, fmt=fmt, scale=scale, width=width):
+        return
 
     with tempfile.TemporaryDirectory() as td:
         td_path = Path(td)
         in_path = td_path / "diagram.mmd"
         in_path.write_text(mermaid_src, encoding="utf-8")
+        _run_mmdc(["-i", str(in_path), "-o", str(output)], fmt=fmt, scale=scale, width=width, config_dir=td_path)
+
+
+def render_mermaid_batch(
+    jobs: list[tuple[str, Path]],
+    *,
+    fmt: str = "png",
+    scale: str = MERMAID_SCALE,
+    width: str = MERMAID_WIDTH,
+) -> None:
+    """Render several diagrams with a single mmdc (one Chromium) invocation.
+
+    Uses mmdc's markdown mode: every ```mermaid block of the input document is
+    rendered to `<output>-<n>.<fmt>` in order. If the batch fails (e.g. one
+    diagram has a syntax error) we fall back to one process per diagram so the
+    error is reported for the offending figure.
+    """
+    if not jobs:
+        return
+    if len(jobs) == 1 or os.environ.get(MERMAID_DAEMON_ENV):
+        for src, output in jobs:
+            render_mermaid(src, output=output, fmt=fmt, scale=scale, width=width)
+        return
+
+    try:
+        _render_markdown_batch(jobs, fmt=fmt, scale=scale, width=width)
+    except RuntimeError:
+        for src, output in jobs:
+            render_mermaid(src, output=output, fmt=fmt, scale=scale, width=width)
+
+
+def _render_markdown_batch(jobs: list[tuple[str, Path]], *, fmt: str, scale: str, width: str) -> None:
+    with tempfile.TemporaryDirectory() as td:
+        td_path = Path(td)
+        in_path = td_path / "diagrams.md"
+        out_path = td_path / "out.md"
+        in_path.write_text(
+            "".join(f"```mermaid\n{src}\n```\n\n" for src, _ in jobs),
+            encoding="utf-8",
+        )
+        _run_mmdc(
+            ["-i", str(in_path), "-o", str(out_path), "--outputFormat", fmt],
+            fmt=fmt,
+            scale=scale,
+            width=width,
+            config_dir=td_path,
+        )
+
+        rendered = [td_path / f"out-{n}.{fmt}" for n in range(1, len(jobs) + 1)]
+        missing = [p.name for p in rendered if not p.exists()]
+        if missing:
+            raise RuntimeError(f"mmdc batch did not produce {missing}")
+        for (_, output), artifact in zip(jobs, rendered):
+            output.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(artifact), output)
+
+
+def _run_mmdc(io_args: list[str], *, fmt: str, scale: str, width: str, config_dir: Path) -> None:
+    extra: list[str] = []
+    if fmt == "svg":
+        config_path = config_dir / "mermaid-config.json"
+        config_path.write_text(json.dumps(_SVG_MERMAID_CONFIG), encoding="utf-8")
+        extra = ["--configFile", str(config_path)]
+
+    cmds: list[list[str]] = []
+    for base in _mmdc_candidates():
+        cmds.append(
+            [
+                *base,
+                *io_args,
+                *extra,
+                "--backgroundColor",
+                MERMAID_BACKGROUND,
+                "--scale",
+                scale,
+                "--width",
+                width,
+            ]
+        )
+
+    last_err: Exception | None = None
+    for cmd in cmds:
+        try:
+            _run(cmd)
+            return
+        except FileNotFoundError as e:
+            last_err = e
+        except subprocess.CalledProcessError as e:
+            last_err = RuntimeError(e.stderr.decode("utf-8", errors="replace"))
+
+    raise RuntimeError(f"Unable to render mermaid. Tried: {cmds}. Last error: {last_err}")
+
 
-        # Prefer explicit config/env, then local install, then npx.
-        candidates: list[list[str]] = []
-
-        env_mmdc = os.environ.get("MD2DOCX_MMDC")
-        if env_mmdc:
-            candidates.append([env_mmdc])
-
-        candidates.append(["mmdc"])
-
-        # repo-local install (npm): node_modules/.bin/mmdc(.cmd)
-        local = Path.cwd() / "node_modules" / ".bin" / ("mmdc.cmd" if os.name == "nt" else "mmdc")
-        if local.exists():
-            candidates.append([str(local)])
-
-        # last resort: npx (may download)
-        candidates.append(["npx", "-y", "@mermaid-js/mermaid-cli"])
-
-        cmds: list[list[str]] = []
-        for base in candidates:
-            cmds.append(
-                [
-                    *base,
-                    "-i",
-                    str(in_path),
-                    "-o",
-                    str(output_png),
-                    "--backgroundColor",
-                    "transparent",
-                    "--scale",
-                    "4",
-                    "--width",
-                    "1600",
-                ]
-            )
-
-        last_err: Exception | None = None
-        for cmd in cmds:
-            try:
-                _run(cmd)
-                return
-            except FileNotFoundError as e:
-                last_err = e
-            except subprocess.CalledProcessError as e:
-                last_err = RuntimeError(e.stderr.decode("utf-8", errors="replace"))
-
-        raise RuntimeError(f"Unable to render mermaid. Tried: {cmds}. Last error: {last_err}")
-
-
-def _run(cmd: list[str]) -> None:
+def _render_via_daemon(mermaid_src: str, *, output: Path, fmt: str, scale: str, width: str) -> bool:
+    """Render through the Mermaid daemon. Returns False if no daemon is reachable."""
+    addr = os.environ.get(MERMAID_DAEMON_ENV)
+    if not addr:
+        return False
+    host, _, port = addr.rpartition(":")
+    if not host:
+        host, port = addr, str(MERMAID_DAEMON_DEFAULT_PORT)
+
+    request = {
+        "definition": mermaid_src,
+        "format": fmt,
+        "scale": float(scale),
+        "width": int(width),
+        "backgroundColor": MERMAID_BACKGROUND,
+    }
+    if fmt == "svg":
+        request["mermaidConfig"] = {"theme": "default", **_SVG_MERMAID_CONFIG}
+    try:
+        conn = socket.create_connection((host, int(port)), timeout=_DAEMON_CONNECT_TIMEOUT_S)
+    except (OSError, ValueError):
+        return False
+
+    with conn:
+        conn.settimeout(_DAEMON_RENDER_TIMEOUT_S)
+        try:
+            conn.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            raw = _recv_line(conn)
+        except OSError:
+            return False
+
+    try:
+        reply = json.loads(raw)
+    except json.JSONDecodeError:
+        return False
+    if not reply.get("ok"):
+        raise RuntimeError(f"Unable to render mermaid (daemon): {reply.get('error')}")
+    output.write_bytes(base64.b64decode(reply["data"]))
+    return True
+
+
+def _recv_line(conn: socket.socket) -> bytes:
+    chunks: list[bytes] = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        nl = chunk.find(b"\n")
+        if nl >= 0:
+            chunks.append(chunk[:nl])
+            break
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def run_mermaid_daemon(*, host: str, port: int, pages: int) -> int:
+    """Run the Mermaid render daemon in the foreground until interrupted."""
+    node_bin = shutil.which("node")
+    if not node_bin:
+        raise RuntimeError("Node.js not found in PATH (required for the Mermaid daemon)")
+
+    module_dir = _mermaid_cli_module_dir()
+    if module_dir is None:
+        raise RuntimeError(
+            "@mermaid-js/mermaid-cli not found. Run `npm install` in this repository "
+            "or `npm i -g @mermaid-js/mermaid-cli`."
+        )
+
+    script = Path(__file__).resolve().parent / "js" / "mermaid-daemon.mjs"
+    cmd = [
+        node_bin,
+        str(script),
+        "--host",
+        host,
+        "--port",
+        str(port),
+        "--pages",
+        str(pages),
+        "--module-dir",
+        str(module_dir),
+    ]
+    puppeteer_config = os.environ.get("MD2DOCX_PUPPETEER_CONFIG")
+    if puppeteer_config:
+        cmd.extend(["--puppeteer-config", puppeteer_config])
+
+    try:
+        return subprocess.run(cmd).returncode
+    except KeyboardInterrupt:
+        return 0
+
+
+def _mermaid_cli_module_dir() -> Path | None:
+    roots = [Path.cwd() / "node_modules"]
+    npm_bin = shutil.which("npm")
+    if npm_bin:
+        try:
+            out = _run([npm_bin, "root", "-g"])
+            roots.append(Path(out.decode("utf-8", errors="replace").strip()))
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            pass
+
+    for root in roots:
+        candidate = root / "@mermaid-js" / "mermaid-cli"
+        if (candidate / "package.json").exists():
+            return candidate
+    return None
+
+
+def mermaid_renderer_id() -> str:
+    """Identity of the Mermaid renderer used for render cache keys."""
+    return (
+        f"mermaid|mmdc={_mmdc_version()}|scale={MERMAID_SCALE}"
+        f"|width={MERMAID_WIDTH}|bg={MERMAID_BACKGROUND}"
+    )
+
+
+def _mmdc_candidates() -> list[list[str]]:
+    # Prefer explicit config/env, then local install, then npx.
+    candidates: list[list[str]] = []
+
+    env_mmdc = os.environ.get("MD2DOCX_MMDC")
+    if env_mmdc:
+        candidates.append([env_mmdc])
+
+    candidates.append(["mmdc"])
+
+    # repo-local install (npm): node_modules/.bin/mmdc(.cmd)
+    local = Path.cwd() / "node_modules" / ".bin" / ("mmdc.cmd" if os.name == "nt" else "mmdc")
+    if local.exists():
+        candidates.append([str(local)])
+
+    # last resort: npx (may download)
+    candidates.append(["npx", "-y", "@mermaid-js/mermaid-cli"])
+    return candidates
+
+
+@lru_cache(maxsize=1)
+def _mmdc_version() -> str:
+    # Only probe installed binaries: npx may hit the network just to print a
+    # version, and this runs even when every diagram is already cached.
+    for base in _mmdc_candidates():
+        if base[0] == "npx":
+            continue
+        try:
+            out = _run([*base, "--version"], timeout=_VERSION_PROBE_TIMEOUT_S)
+        except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            continue
+        version = out.decode("utf-8", errors="replace").strip()
+        if version:
+            return version
+    return "unknown"
+
+
+def _run(cmd: list[str], *, timeout: float | None = None) -> bytes:
     # On Windows, tools installed via npm are often .cmd wrappers.
     if os.name == "nt":
         exe = shutil.which(cmd[0]) or cmd[0]
         if str(exe).lower().endswith((".cmd", ".bat")):
             # Use cmd.exe to run .cmd/.bat reliably.
-            subprocess.run(["cmd", "/c", *cmd], check=True, capture_output=True)
-            return
+            return subprocess.run(
+                ["cmd", "/c", *cmd], check=True, capture_output=True, timeout=timeout
+            ).stdout
 
-    subprocess.run(cmd, check=True, capture_output=True)
+    return subprocess.run(cmd, check=True, capture_output=True, timeout=timeout).stdout
@@ -0,0 +1,1044 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+import hashlib
+import re
+import zipfile
+
+from lxml import etree as ET
+
+from md2docx.codetext import CODE_FONT
+from md2docx.docxops import (
+    A_NS,
+    NS,
+    PKG_REL_NS,
+    R_NS,
+    W_NS,
+    WP_NS,
+    _INLINE_MARKER_RE,
+    BodyPackage,
+    _bookmark_name,
+    _make_citation_sdt,
+    _make_ref_field_runs,
+    _attach_svg_blips,
+    _make_run_with_text,
+    _replace_paragraph_with_caption,
+)
+from md2docx.imageprobe import probe_image
+from md2docx.mediaopt import convert_to_png, rasterize_svg
+
+
+# In-process replacement for the pandoc markdown -> docx step. It covers the
+# subset documented in docs/markdown-schema.md (what preprocess_markdown
+# emits plus plain prose): headings, paragraphs, nested lists, pipe tables,
+# images, emphasis, code, links, footnotes, block quotes, fenced divs and raw
+# openxml blocks. Captions, cross references and citations become Word
+# fields directly, so the assembler has no marker text to scan.
+
+PIC_NS = "http://schemas.openxmlformats.org/drawingml/2006/picture"
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+_REL_IMAGE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"
+_REL_HYPERLINK = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink"
+
+_EMU_PER_INCH = 914400
+_EMU_PER_TWIP = 635
+# Letter page with 1in margins, used when the template has no sectPr.
+_DEFAULT_TEXT_WIDTH_TWIPS = 9360
+_DEFAULT_IMAGE_DPI = 96.0
+_LENGTH_EMU = {"in": _EMU_PER_INCH, "cm": 360000, "mm": 36000, "pt": 12700, "px": _EMU_PER_INCH / 96}
+
+# New lists are numbered above the template's ids, like pandoc does.
+_FIRST_NUM_ID = 1001
+_BULLETS = ("•", "◦", "▪")
+_ORDERED_FORMATS = ("decimal", "lowerLetter", "lowerRoman")
+_LIST_INDENT_TWIPS = 720
+_LIST_HANGING_TWIPS = 360
+
+_CAPTION_RE = re.compile(r"^\[\[MD2DOCX_CAPTION_(FIG|TAB):([A-Za-z0-9_-]+)\|(.*)\]\]$")
+_HEADING_RE = re.compile(r"^(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$")
+_HEADING_ATTRS_RE = re.compile(r"\s*\{([^}]*)\}\s*$")
+_FENCE_RE = re.compile(r"^(\s*)(`{3,}|~{3,})\s*(.*)$")
+_DIV_OPEN_RE = re.compile(r"^:{3,}\s*(\{.*\}|[\w-]+)\s*:*\s*$")
+_DIV_CLOSE_RE = re.compile(r"^:{3,}\s*$")
+_LIST_ITEM_RE = re.compile(r"^(\s*)([-*+]|\d+[.)])[ \t]+(.*)$")
+_TABLE_DELIM_RE = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+_HRULE_RE = re.compile(r"^\s{0,3}([-*_])(\s*\1){2,}\s*$")
+_FOOTNOTE_DEF_RE = re.compile(r"^\[\^([^\]\s]+)\]:[ \t]?(.*)$")
+_ATTR_RE = re.compile(r"""([\w-]+)=(?:"([^"]*)"|'([^']*)'|(\S+))""")
+_ESCAPABLE = set("\\`*_{}[]()#+-.!|>~\"'$@^:<")
+
+
+@dataclass(frozen=True)
+class _Inline:
+    kind: str  # text | code | strong | emph | link | image | span | note | ref | cite | break
+    text: str = ""
+    children: tuple[_Inline, ...] = ()
+    target: str = ""
+    attrs: tuple[tuple[str, str], ...] = ()
+
+
+def render_markdown_to_body(markdown: str, *, template_docx: Path, resource_paths: list[Path]) -> BodyPackage:
+    """Convert processed markdown to an in-memory body package.
+
+    The result stands in for pandoc's body.docx in assemble_final_docx.
+    """
+    with zipfile.ZipFile(template_docx, "r") as zt:
+        styles = ET.fromstring(zt.read("word/styles.xml"))
+        numbering = ET.fromstring(zt.read("word/numbering.xml"))
+        text_width = _text_width_twips(ET.fromstring(zt.read("word/document.xml")))
+
+    writer = _BodyWriter(
+        resource_paths=resource_paths,
+        numbering=numbering,
+        max_image_width_emu=text_width * _EMU_PER_TWIP,
+        text_width_twips=text_width,
+    )
+    writer.write(markdown)
+    _ensure_code_styles(styles)
+
+    parts: dict[str, bytes] = {
+        "word/styles.xml": _to_bytes(styles),
+        "word/numbering.xml": _to_bytes(numbering),
+        "word/footnotes.xml": _to_bytes(writer.footnotes),
+    }
+    parts.update(writer.media)
+    return BodyPackage(document=writer.document, rels=writer.rels, parts=parts)
+
+
+def _to_bytes(root: ET._Element) -> bytes:
+    return ET.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+
+def _w(tag: str) -> str:
+    return f"{{{W_NS}}}{tag}"
+
+
+def _text_width_twips(doc: ET._Element) -> int:
+    sect = doc.find("./w:body/w:sectPr", namespaces=NS)
+    if sect is None:
+        return _DEFAULT_TEXT_WIDTH_TWIPS
+    pg_sz = sect.find("w:pgSz", namespaces=NS)
+    pg_mar = sect.find("w:pgMar", namespaces=NS)
+    try:
+        width = int(pg_sz.get(_w("w"))) - int(pg_mar.get(_w("left"))) - int(pg_mar.get(_w("right")))
+    except (AttributeError, TypeError, ValueError):
+        return _DEFAULT_TEXT_WIDTH_TWIPS
+    return width if width > 0 else _DEFAULT_TEXT_WIDTH_TWIPS
+
+
+def _ensure_code_styles(styles: ET._Element) -> None:
+    # pandoc adds these to the reference styles; the template does not have them.
+    existing = {s.get(_w("styleId")) for s in styles.findall("w:style", namespaces=NS)}
+    if "VerbatimChar" not in existing:
+        st = ET.SubElement(
+            styles, _w("style"), attrib={_w("type"): "character", _w("customStyle"): "1", _w("styleId"): "VerbatimChar"}
+        )
+        ET.SubElement(st, _w("name"), attrib={_w("val"): "Verbatim Char"})
+        rpr = ET.SubElement(st, _w("rPr"))
+        ET.SubElement(rpr, _w("rFonts"), attrib={_w("ascii"): CODE_FONT, _w("hAnsi"): CODE_FONT, _w("cs"): CODE_FONT})
+    if "SourceCode" not in existing:
+        st = ET.SubElement(
+            styles, _w("style"), attrib={_w("type"): "paragraph", _w("customStyle"): "1", _w("styleId"): "SourceCode"}
+        )
+        ET.SubElement(st, _w("name"), attrib={_w("val"): "Source Code"})
+        ET.SubElement(st, _w("basedOn"), attrib={_w("val"): "Normal"})
+        ET.SubElement(st, _w("link"), attrib={_w("val"): "VerbatimChar"})
+        ppr = ET.SubElement(st, _w("pPr"))
+        ET.SubElement(ppr, _w("wordWrap"), attrib={_w("val"): "off"})
+
+
+class _BodyWriter:
+    def __init__(
+        self,
+        *,
+        resource_paths: list[Path],
+        numbering: ET._Element,
+        max_image_width_emu: int,
+        text_width_twips: int,
+    ) -> None:
+        self.resource_paths = resource_paths
+        self.numbering = numbering
+        self.max_image_width_emu = max_image_width_emu
+        self.text_width_twips = text_width_twips
+
+        self.document = ET.Element(_w("document"), nsmap={"w": W_NS, "r": R_NS, "wp": WP_NS, "a": A_NS, "pic": PIC_NS})
+        self.body = ET.SubElement(self.document, _w("body"))
+        self.rels = ET.Element(f"{{{PKG_REL_NS}}}Relationships", nsmap={None: PKG_REL_NS})
+        self.footnotes = ET.Element(_w("footnotes"), nsmap={"w": W_NS, "r": R_NS})
+        self.media: dict[str, bytes] = {}
+
+        self._next_rel = 1
+        self._image_rids: dict[str, str] = {}
+        # PNG rId of an authored SVG -> rId of the SVG itself.
+        self._svg_rids: dict[str, str] = {}
+        self._link_rids: dict[str, str] = {}
+        # Bookmark ids are local; the assembler shifts them above the template's.
+        self._next_bookmark = 1
+        self._next_docpr = 1
+        self._slugs: set[str] = set()
+
+        self._note_defs: dict[str, list[str]] = {}
+        self._note_ids: dict[str, int] = {}
+        self._fig_numbers: dict[str, int] = {}
+        self._tab_numbers: dict[str, int] = {}
+
+        self._bullet_abstract, self._ordered_abstract = self._add_abstract_nums()
+        self._next_num = _FIRST_NUM_ID
+        self._first_para = True
+        self._div_styles: list[str | None] = []
+
+        self._init_footnotes()
+
+    # ---- entry point -------------------------------------------------------
+
+    def write(self, markdown: str) -> None:
+        lines = self._collect_footnote_defs(markdown.replace("\r\n", "\n").split("\n"))
+        self._number_captions(lines)
+        self._blocks(lines, self.body)
+
+    # ---- pre-passes --------------------------------------------------------
+
+    def _collect_footnote_defs(self, lines: list[str]) -> list[str]:
+        out: list[str] = []
+        fence: str | None = None
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            m = _FENCE_RE.match(line)
+            if m and (fence is None or m.group(2).startswith(fence)):
+                fence = None if fence else m.group(2)[:3]
+            if fence is None:
+                d = _FOOTNOTE_DEF_RE.match(line)
+                if d:
+                    body = [d.group(2)]
+                    i += 1
+                    while i < len(lines) and (
+                        lines[i].startswith(("    ", "\t"))
+                        or (not lines[i].strip() and i + 1 < len(lines) and lines[i + 1].startswith(("    ", "\t")))
+                    ):
+                        body.append(lines[i][4:] if lines[i].startswith("    ") else lines[i].lstrip("\t"))
+                        i += 1
+                    self._note_defs[d.group(1)] = body
+                    continue
+            out.append(line)
+            i += 1
+        return out
+
+    def _number_captions(self, lines: list[str]) -> None:
+        # REF fields need the final number even when they precede the caption.
+        for line in lines:
+            m = _CAPTION_RE.match(line.strip())
+            if not m:
+                continue
+            numbers = self._fig_numbers if m.group(1) == "FIG" else self._tab_numbers
+            numbers.setdefault(m.group(2), len(numbers) + 1)
+
+    # ---- blocks ------------------------------------------------------------
+
+    def _blocks(self, lines: list[str], parent: ET._Element, *, style: str | None = None) -> None:
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            stripped = line.strip()
+            if not stripped:
+                i += 1
+                continue
+
+            if stripped.startswith("<!--"):
+                while i < len(lines) and "-->" not in lines[i]:
+                    i += 1
+                i += 1
+                continue
+
+            m = _FENCE_RE.match(line)
+            if m:
+                i = self._fenced_block(lines, i, parent, fence=m.group(2), info=m.group(3).strip())
+                continue
+
+            if _DIV_CLOSE_RE.match(stripped) and self._div_styles:
+                self._div_styles.pop()
+                i += 1
+                continue
+            m = _DIV_OPEN_RE.match(stripped)
+            if m:
+                self._div_styles.append(_parse_attrs(m.group(1)).get("custom-style"))
+                i += 1
+                continue
+
+            m = _HEADING_RE.match(line)
+            if m:
+                self._heading(len(m.group(1)), m.group(2), parent)
+                i += 1
+                continue
+
+            if _HRULE_RE.match(line):
+                self._horizontal_rule(parent)
+                i += 1
+                continue
+
+            if "|" in line and i + 1 < len(lines) and "-" in lines[i + 1] and _TABLE_DELIM_RE.match(lines[i + 1]):
+                i = self._table(lines, i, parent)
+                continue
+
+            if stripped.startswith(">"):
+                quoted: list[str] = []
+                while i < len(lines) and lines[i].strip().startswith(">"):
+                    quoted.append(re.sub(r"^\s*> ?", "", lines[i]))
+                    i += 1
+                self._blocks(quoted, parent, style="BlockText")
+                continue
+
+            if _LIST_ITEM_RE.match(line):
+                i = self._list(lines, i, parent)
+                continue
+
+            para = [line]
+            i += 1
+            while i < len(lines) and lines[i].strip() and not _starts_block(lines[i]):
+                para.append(lines[i])
+                i += 1
+            self._paragraph("\n".join(para).strip(), parent, style=style)
+
+    def _current_div_style(self) -> str | None:
+        for s in reversed(self._div_styles):
+            if s:
+                return s
+        return None
+
+    def _paragraph(self, text: str, parent: ET._Element, *, style: str | None = None) -> None:
+        m = _CAPTION_RE.match(text)
+        if m:
+            self._caption(m.group(1), m.group(2), m.group(3), parent)
+            return
+
+        inlines = _parse_inlines(text)
+        style = style or self._current_div_style()
+        if style is None:
+            style = "FirstParagraph" if self._first_para else "BodyText"
+        p = self._new_paragraph(parent, style=style)
+        self._emit_inlines(inlines, p)
+        self._first_para = False
+
+    def _caption(self, kind: str, raw_id: str, title: str, parent: ET._Element) -> None:
+        p = self._new_paragraph(parent, style="Caption")
+        if kind == "FIG":
+            label, short, number = "Figura", "fig", self._fig_numbers[raw_id]
+        else:
+            label, short, number = "Tabla", "tab", self._tab_numbers[raw_id]
+        _replace_paragraph_with_caption(
+            p,
+            label=label,
+            seq_name=label,
+            title=title,
+            bookmark=_bookmark_name(short, raw_id),
+            bm_id=self._bookmark_id(),
+            number=number,
+        )
+        self._first_para = False
+
+    def _heading(self, level: int, text: str, parent: ET._Element) -> None:
+        m = _HEADING_ATTRS_RE.search(text)
+        explicit = re.search(r"#([\w.:-]+)", m.group(1)) if m else None
+        if m:
+            text = text[: m.start()]
+        name = explicit.group(1) if explicit else self._slug(text)
+        self._slugs.add(name)
+        p = self._new_paragraph(parent, style=f"Heading{level}")
+        bm_id = self._bookmark_id()
+        ET.SubElement(p, _w("bookmarkStart"), attrib={_w("id"): str(bm_id), _w("name"): name})
+        self._emit_inlines(_parse_inlines(text), p)
+        ET.SubElement(p, _w("bookmarkEnd"), attrib={_w("id"): str(bm_id)})
+        self._first_para = True
+
+    def _horizontal_rule(self, parent: ET._Element) -> None:
+        p = self._new_paragraph(parent, style=None)
+        bdr = ET.SubElement(p.find("w:pPr", namespaces=NS), _w("pBdr"))
+        ET.SubElement(bdr, _w("bottom"), attrib={_w("val"): "single", _w("sz"): "6", _w("space"): "1", _w("color"): "auto"})
+        self._first_para = True
+
+    def _fenced_block(self, lines: list[str], i: int, parent: ET._Element, *, fence: str, info: str) -> int:
+        body: list[str] = []
+        i += 1
+        while i < len(lines) and not lines[i].strip().startswith(fence):
+            body.append(lines[i])
+            i += 1
+        i += 1
+
+        if info.replace(" ", "") == "{=openxml}":
+            self._raw_openxml("\n".join(body), parent)
+            return i
+
+        p = self._new_paragraph(parent, style="SourceCode")
+        for n, code_line in enumerate(body):
+            if n:
+                ET.SubElement(ET.SubElement(p, _w("r")), _w("br"))
+            if code_line:
+                p.append(self._run(code_line, rstyle="VerbatimChar"))
+        self._first_para = False
+        return i
+
+    def _raw_openxml(self, xml: str, parent: ET._Element) -> None:
+        # Same contract as pandoc's raw_attribute: block-level w:p / w:tbl.
+        wrapped = f'<w:root xmlns:w="{W_NS}" xmlns:r="{R_NS}">{xml}</w:root>'
+        for el in ET.fromstring(wrapped):
+            parent.append(el)
+        self._first_para = False
+
+    def _table(self, lines: list[str], i: int, parent: ET._Element) -> int:
+        header = _split_row(lines[i])
+        aligns = [_cell_alignment(c) for c in _split_row(lines[i + 1])]
+        i += 2
+        rows: list[list[str]] = []
+        while i < len(lines) and lines[i].strip() and "|" in lines[i]:
+            rows.append(_split_row(lines[i]))
+            i += 1
+
+        ncols = len(header)
+        aligns = (aligns + [None] * ncols)[:ncols]
+        tbl = ET.SubElement(parent, _w("tbl"))
+        tblpr = ET.SubElement(tbl, _w("tblPr"))
+        ET.SubElement(tblpr, _w("tblStyle"), attrib={_w("val"): "Table"})
+        ET.SubElement(tblpr, _w("tblW"), attrib={_w("w"): "0", _w("type"): "auto"})
+        look = {"firstRow": "1", "lastRow": "0", "firstColumn": "0", "lastColumn": "0", "noHBand": "0", "noVBand": "0"}
+        ET.SubElement(tblpr, _w("tblLook"), attrib={**{_w(k): v for k, v in look.items()}, _w("val"): "0020"})
+        grid = ET.SubElement(tbl, _w("tblGrid"))
+        for _ in range(ncols):
+            ET.SubElement(grid, _w("gridCol"), attrib={_w("w"): str(self.text_width_twips // ncols)})
+
+        for r_idx, cells in enumerate([header, *rows]):
+            tr = ET.SubElement(tbl, _w("tr"))
+            if r_idx == 0:
+                ET.SubElement(ET.SubElement(tr, _w("trPr")), _w("tblHeader"))
+            cells = (cells + [""] * ncols)[:ncols]
+            for c_idx, cell in enumerate(cells):
+                tc = ET.SubElement(tr, _w("tc"))
+                ET.SubElement(tc, _w("tcPr"))
+                p = self._new_paragraph(tc, style="Compact")
+                if aligns[c_idx]:
+                    ET.SubElement(p.find("w:pPr", namespaces=NS), _w("jc"), attrib={_w("val"): aligns[c_idx]})
+                self._emit_inlines(_parse_inlines(cell), p)
+        self._first_para = False
+        return i
+
+    def _list(self, lines: list[str], i: int, parent: ET._Element) -> int:
+        # Items as (indent, ordered, start, text); continuation lines are
+        # folded into the item text.
+        items: list[tuple[int, bool, int, str]] = []
+        while i < len(lines):
+            line = lines[i]
+            m = _LIST_ITEM_RE.match(line)
+            if m:
+                marker = m.group(2)
+                ordered = marker[0].isdigit()
+                items.append((len(m.group(1).expandtabs(4)), ordered, int(marker[:-1]) if ordered else 1, m.group(3)))
+                i += 1
+                continue
+            # Indented or lazy continuation of the previous item.
+            if line.strip() and items and (line.startswith((" ", "\t")) or lines[i - 1].strip()):
+                indent, ordered, start, text = items[-1]
+                items[-1] = (indent, ordered, start, f"{text}\n{line.strip()}")
+                i += 1
+                continue
+            if not line.strip() and i + 1 < len(lines) and (
+                _LIST_ITEM_RE.match(lines[i + 1]) or lines[i + 1].startswith((" ", "\t"))
+            ):
+                i += 1
+                continue
+            break
+
+        indents: list[int] = []
+        # Active numId per level: (numId, ordered)
+        active: list[tuple[int, bool]] = []
+        for indent, ordered, start, text in items:
+            while indents and indents[-1] > indent:
+                indents.pop()
+            if not indents or indent > indents[-1]:
+                indents.append(indent)
+            level = len(indents) - 1
+            del active[level + 1 :]
+            if len(active) <= level or active[level][1] != ordered:
+                del active[level:]
+                while len(active) < level:
+                    active.append((self._new_num(ordered, level=len(active), start=1), ordered))
+                active.append((self._new_num(ordered, level=level, start=start), ordered))
+
+            p = self._new_paragraph(parent, style="Compact")
+            numpr = ET.SubElement(p.find("w:pPr", namespaces=NS), _w("numPr"))
+            ET.SubElement(numpr, _w("ilvl"), attrib={_w("val"): str(level)})
+            ET.SubElement(numpr, _w("numId"), attrib={_w("val"): str(active[level][0])})
+            self._emit_inlines(_parse_inlines(text), p)
+        self._first_para = True
+        return i
+
+    # ---- numbering ---------------------------------------------------------
+
+    def _add_abstract_nums(self) -> tuple[int, int]:
+        ids = [int(a.get(_w("abstractNumId"))) for a in self.numbering.findall("w:abstractNum", namespaces=NS)]
+        first = max(ids, default=0) + 1
+        bullet = self._abstract_num(first, ordered=False)
+        ordered = self._abstract_num(first + 1, ordered=True)
+        # abstractNum elements must precede every w:num.
+        first_num = self.numbering.find("w:num", namespaces=NS)
+        for el in (bullet, ordered):
+            if first_num is not None:
+                first_num.addprevious(el)
+            else:
+                self.numbering.append(el)
+        return first, first + 1
+
+    def _abstract_num(self, abstract_id: int, *, ordered: bool) -> ET._Element:
+        an = ET.Element(_w("abstractNum"), attrib={_w("abstractNumId"): str(abstract_id)})
+        ET.SubElement(an, _w("multiLevelType"), attrib={_w("val"): "multilevel"})
+        for lvl in range(9):
+            el = ET.SubElement(an, _w("lvl"), attrib={_w("ilvl"): str(lvl)})
+            ET.SubElement(el, _w("start"), attrib={_w("val"): "1"})
+            if ordered:
+                ET.SubElement(el, _w("numFmt"), attrib={_w("val"): _ORDERED_FORMATS[lvl % len(_ORDERED_FORMATS)]})
+                ET.SubElement(el, _w("lvlText"), attrib={_w("val"): f"%{lvl + 1}."})
+            else:
+                ET.SubElement(el, _w("numFmt"), attrib={_w("val"): "bullet"})
+                ET.SubElement(el, _w("lvlText"), attrib={_w("val"): _BULLETS[lvl % len(_BULLETS)]})
+            ET.SubElement(el, _w("lvlJc"), attrib={_w("val"): "left"})
+            ppr = ET.SubElement(el, _w("pPr"))
+            ET.SubElement(
+                ppr,
+                _w("ind"),
+                attrib={_w("left"): str(_LIST_INDENT_TWIPS * (lvl + 1)), _w("hanging"): str(_LIST_HANGING_TWIPS)},
+            )
+        return an
+
+    def _new_num(self, ordered: bool, *, level: int, start: int) -> int:
+        num_id = self._next_num
+        self._next_num += 1
+        num = ET.SubElement(self.numbering, _w("num"), attrib={_w("numId"): str(num_id)})
+        abstract = self._ordered_abstract if ordered else self._bullet_abstract
+        ET.SubElement(num, _w("abstractNumId"), attrib={_w("val"): str(abstract)})
+        # Each list restarts its own counter.
+        override = ET.SubElement(num, _w("lvlOverride"), attrib={_w("ilvl"): str(level)})
+        ET.SubElement(override, _w("startOverride"), attrib={_w("val"): str(start)})
+        return num_id
+
+    # ---- inlines -----------------------------------------------------------
+
+    def _emit_inlines(
+        self,
+        inlines: list[_Inline],
+        parent: ET._Element,
+        *,
+        bold: bool = False,
+        italic: bool = False,
+        rstyle: str | None = None,
+    ) -> None:
+        for node in inlines:
+            if node.kind == "text":
+                parent.append(self._run(node.text, bold=bold, italic=italic, rstyle=rstyle))
+            elif node.kind == "code":
+                parent.append(self._run(node.text, bold=bold, italic=italic, rstyle="VerbatimChar"))
+            elif node.kind == "break":
+                ET.SubElement(ET.SubElement(parent, _w("r")), _w("br"))
+            elif node.kind == "strong":
+                self._emit_inlines(list(node.children), parent, bold=True, italic=italic, rstyle=rstyle)
+            elif node.kind == "emph":
+                self._emit_inlines(list(node.children), parent, bold=bold, italic=True, rstyle=rstyle)
+            elif node.kind == "span":
+                style = dict(node.attrs).get("custom-style") or rstyle
+                self._emit_inlines(list(node.children), parent, bold=bold, italic=italic, rstyle=style)
+            elif node.kind == "link":
+                link = ET.SubElement(parent, _w("hyperlink"))
+                if node.target.startswith("#"):
+                    link.set(_w("anchor"), node.target[1:])
+                else:
+                    link.set(f"{{{R_NS}}}id", self._hyperlink_rid(node.target))
+                self._emit_inlines(list(node.children), link, bold=bold, italic=italic, rstyle="Hyperlink")
+            elif node.kind == "image":
+                drawing = self._image(node.target, dict(node.attrs), alt=_plain_text(node.children))
+                if drawing is not None:
+                    r = ET.SubElement(parent, _w("r"))
+                    r.append(drawing)
+            elif node.kind == "note":
+                self._footnote_reference(node.text, parent)
+            elif node.kind == "ref":
+                numbers = self._fig_numbers if node.target == "fig" else self._tab_numbers
+                label = "Figura" if node.target == "fig" else "Tabla"
+                n = numbers.get(node.text)
+                parent.extend(
+                    _make_ref_field_runs(
+                        bookmark=_bookmark_name(node.target, node.text),
+                        result_text=f"{label} {n}" if n is not None else label,
+                    )
+                )
+            elif node.kind == "cite":
+                parent.append(_make_citation_sdt(tag=node.text))
+
+    def _run(
+        self, text: str, *, bold: bool = False, italic: bool = False, rstyle: str | None = None
+    ) -> ET._Element:
+        r = _make_run_with_text(text)
+        if bold or italic or rstyle:
+            rpr = ET.Element(_w("rPr"))
+            if rstyle:
+                ET.SubElement(rpr, _w("rStyle"), attrib={_w("val"): rstyle})
+            if bold:
+                ET.SubElement(rpr, _w("b"))
+                ET.SubElement(rpr, _w("bCs"))
+            if italic:
+                ET.SubElement(rpr, _w("i"))
+                ET.SubElement(rpr, _w("iCs"))
+            r.insert(0, rpr)
+        t = r.find("w:t", namespaces=NS)
+        t.set(_XML_SPACE, "preserve")
+        return r
+
+    def _footnote_reference(self, note_id: str, parent: ET._Element) -> None:
+        lines = self._note_defs.get(note_id)
+        if lines is None:
+            parent.append(self._run(f"[^{note_id}]"))
+            return
+        n = self._note_ids.get(note_id)
+        if n is None:
+            n = len(self._note_ids) + 1
+            self._note_ids[note_id] = n
+            self._footnote(n, lines)
+        r = ET.SubElement(parent, _w("r"))
+        ET.SubElement(ET.SubElement(r, _w("rPr")), _w("rStyle"), attrib={_w("val"): "FootnoteReference"})
+        ET.SubElement(r, _w("footnoteReference"), attrib={_w("id"): str(n)})
+
+    def _init_footnotes(self) -> None:
+        for note_id, kind, mark in (("-1", "separator", "separator"), ("0", "continuationSeparator", "continuationSeparator")):
+            fn = ET.SubElement(self.footnotes, _w("footnote"), attrib={_w("type"): kind, _w("id"): note_id})
+            ET.SubElement(ET.SubElement(fn, _w("p")), _w("r")).append(ET.Element(_w(mark)))
+
+    def _footnote(self, n: int, lines: list[str]) -> None:
+        fn = ET.SubElement(self.footnotes, _w("footnote"), attrib={_w("id"): str(n)})
+        paragraphs = [p.strip() for p in "\n".join(lines).split("\n\n") if p.strip()]
+        for idx, text in enumerate(paragraphs or [""]):
+            p = self._new_paragraph(fn, style="FootnoteText")
+            if idx == 0:
+                r = ET.SubElement(p, _w("r"))
+                ET.SubElement(ET.SubElement(r, _w("rPr")), _w("rStyle"), attrib={_w("val"): "FootnoteReference"})
+                ET.SubElement(r, _w("footnoteRef"))
+                p.append(self._run(" "))
+            self._emit_inlines(_parse_inlines(text), p)
+
+    # ---- relationships and media -------------------------------------------
+
+    def _rid(self) -> str:
+        rid = f"rId{self._next_rel}"
+        self._next_rel += 1
+        return rid
+
+    def _hyperlink_rid(self, url: str) -> str:
+        rid = self._link_rids.get(url)
+        if rid is None:
+            rid = self._rid()
+            self._link_rids[url] = rid
+            ET.SubElement(
+                self.rels,
+                f"{{{PKG_REL_NS}}}Relationship",
+                attrib={"Id": rid, "Type": _REL_HYPERLINK, "Target": url, "TargetMode": "External"},
+            )
+        return rid
+
+    def _resolve(self, src: str) -> Path | None:
+        p = Path(src)
+        if p.is_absolute():
+            return p if p.is_file() else None
+        for base in self.resource_paths:
+            candidate = base / p
+            if candidate.is_file():
+                return candidate
+        return None
+
+    def _image(self, src: str, attrs: dict[str, str], *, alt: str) -> ET._Element | None:
+        path = self._resolve(src)
+        if path is None:
+            raise RuntimeError(f"Image not found: {src}")
+        info = probe_image(path)
+        if info is None or info.width <= 0 or info.height <= 0:
+            raise RuntimeError(f"Unsupported image: {path}")
+
+        dpi = info.dpi[0] if info.dpi and info.dpi[0] > 0 else _DEFAULT_IMAGE_DPI
+        natural_cx = info.width / dpi * _EMU_PER_INCH
+        natural_cy = info.height / dpi * _EMU_PER_INCH
+        cx = _length_emu(attrs.get("width"), self.max_image_width_emu)
+        cy = _length_emu(attrs.get("height"), self.max_image_width_emu)
+        if cx and not cy:
+            cy = cx * natural_cy / natural_cx
+        elif cy and not cx:
+            cx = cy * natural_cx / natural_cy
+        elif not cx and not cy:
+            cx, cy = natural_cx, natural_cy
+        if cx > self.max_image_width_emu:
+            cy = cy * self.max_image_width_emu / cx
+            cx = self.max_image_width_emu
+        cx, cy = int(cx), int(cy)
+
+        data = path.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        rid = self._image_rids.get(digest)
+        if rid is None:
+            rid = self._rid()
+            self._image_rids[digest] = rid
+            if info.format == "svg":
+                # Word shows the SVG through asvg:svgBlip; the a:blip needs a PNG.
+                self._add_image(rid, "png", rasterize_svg(data))
+                self._svg_rids[rid] = self._rid()
+                self._add_image(self._svg_rids[rid], "svg", data)
+            elif info.format == "webp":
+                self._add_image(rid, "png", convert_to_png(data))
+            else:
+                self._add_image(rid, "jpeg" if info.format == "jpeg" else info.format, data)
+
+        docpr_id = self._next_docpr
+        self._next_docpr += 1
+        drawing = ET.Element(_w("drawing"))
+        inline = ET.SubElement(drawing, f"{{{WP_NS}}}inline")
+        ET.SubElement(inline, f"{{{WP_NS}}}extent", attrib={"cx": str(cx), "cy": str(cy)})
+        ET.SubElement(inline, f"{{{WP_NS}}}effectExtent", attrib={"b": "0", "l": "0", "r": "0", "t": "0"})
+        ET.SubElement(
+            inline, f"{{{WP_NS}}}docPr", attrib={"descr": alt, "title": "", "id": str(docpr_id), "name": "Picture"}
+        )
+        graphic = ET.SubElement(inline, f"{{{A_NS}}}graphic")
+        gdata = ET.SubElement(graphic, f"{{{A_NS}}}graphicData", attrib={"uri": PIC_NS})
+        pic = ET.SubElement(gdata, f"{{{PIC_NS}}}pic")
+        nv = ET.SubElement(pic, f"{{{PIC_NS}}}nvPicPr")
+        ET.SubElement(nv, f"{{{PIC_NS}}}cNvPr", attrib={"descr": src, "id": "0", "name": path.name})
+        ET.SubElement(ET.SubElement(nv, f"{{{PIC_NS}}}cNvPicPr"), f"{{{A_NS}}}picLocks", attrib={"noChangeArrowheads": "1", "noChangeAspect": "1"})
+        fill = ET.SubElement(pic, f"{{{PIC_NS}}}blipFill")
+        ET.SubElement(fill, f"{{{A_NS}}}blip", attrib={f"{{{R_NS}}}embed": rid})
+        ET.SubElement(ET.SubElement(fill, f"{{{A_NS}}}stretch"), f"{{{A_NS}}}fillRect")
+        sppr = ET.SubElement(pic, f"{{{PIC_NS}}}spPr", attrib={"bwMode": "auto"})
+        xfrm = ET.SubElement(sppr, f"{{{A_NS}}}xfrm")
+        ET.SubElement(xfrm, f"{{{A_NS}}}off", attrib={"x": "0", "y": "0"})
+        ET.SubElement(xfrm, f"{{{A_NS}}}ext", attrib={"cx": str(cx), "cy": str(cy)})
+        geom = ET.SubElement(sppr, f"{{{A_NS}}}prstGeom", attrib={"prst": "rect"})
+        ET.SubElement(geom, f"{{{A_NS}}}avLst")
+        ET.SubElement(sppr, f"{{{A_NS}}}noFill")
+        _attach_svg_blips(drawing, svg_rel_map=self._svg_rids)
+        return drawing
+
+    def _add_image(self, rid: str, ext: str, data: bytes) -> None:
+        target = f"media/{rid}.{ext}"
+        self.media[f"word/{target}"] = data
+        ET.SubElement(
+            self.rels, f"{{{PKG_REL_NS}}}Relationship", attrib={"Id": rid, "Type": _REL_IMAGE, "Target": target}
+        )
+
+    # ---- helpers -----------------------------------------------------------
+
+    def _new_paragraph(self, parent: ET._Element, *, style: str | None) -> ET._Element:
+        p = ET.SubElement(parent, _w("p"))
+        ppr = ET.SubElement(p, _w("pPr"))
+        if style:
+            ET.SubElement(ppr, _w("pStyle"), attrib={_w("val"): style})
+        return p
+
+    def _bookmark_id(self) -> int:
+        bm_id = self._next_bookmark
+        self._next_bookmark += 1
+        return bm_id
+
+    def _slug(self, text: str) -> str:
+        # pandoc's auto_identifiers: lowercase, punctuation dropped, spaces to
+        # hyphens, everything before the first letter removed.
+        plain = _plain_text(_parse_inlines(text))
+        s = "".join(ch for ch in plain.lower() if ch.isalnum() or ch in " _-.")
+        s = re.sub(r"\s+", "-", s.strip())
+        s = re.sub(r"^[^a-z\u00c0-\uffff]+", "", s) or "section"
+        slug, n = s, 0
+        while slug in self._slugs:
+            n += 1
+            slug = f"{s}-{n}"
+        self._slugs.add(slug)
+        return slug
+
+
+def _starts_block(line: str) -> bool:
+    # Blocks that end a paragraph without a blank line in between.
+    stripped = line.strip()
+    return bool(_FENCE_RE.match(line) or _DIV_OPEN_RE.match(stripped) or _DIV_CLOSE_RE.match(stripped))
+
+
+def _length_emu(value: str | None, full_width_emu: int) -> float | None:
+    if not value:
+        return None
+    m = re.match(r"^\s*([0-9]*\.?[0-9]+)\s*(in|cm|mm|pt|px|%)?\s*$", value)
+    if not m:
+        return None
+    n = float(m.group(1))
+    unit = m.group(2) or "px"
+    if unit == "%":
+        return full_width_emu * n / 100
+    return n * _LENGTH_EMU[unit]
+
+
+def _parse_attrs(raw: str) -> dict[str, str]:
+    raw = raw.strip()
+    if raw.startswith("{"):
+        raw = raw[1:-1]
+    else:
+        # `::: Name` is shorthand for a class, not a style.
+        return {}
+    return {m.group(1): next(g for g in m.groups()[1:] if g is not None) for m in _ATTR_RE.finditer(raw)}
+
+
+def _split_row(line: str) -> list[str]:
+    s = line.strip()
+    if s.startswith("|"):
+        s = s[1:]
+    if s.endswith("|") and not s.endswith("\\|"):
+        s = s[:-1]
+    cells: list[str] = []
+    cur: list[str] = []
+    in_code = False
+    i = 0
+    while i < len(s):
+        ch = s[i]
+        if ch == "\\" and i + 1 < len(s) and s[i + 1] == "|":
+            cur.append("|")
+            i += 2
+            continue
+        if ch == "`":
+            in_code = not in_code
+        if ch == "|" and not in_code:
+            cells.append("".join(cur).strip())
+            cur = []
+        else:
+            cur.append(ch)
+        i += 1
+    cells.append("".join(cur).strip())
+    return cells
+
+
+def _cell_alignment(delim: str) -> str | None:
+    left, right = delim.startswith(":"), delim.endswith(":")
+    if left and right:
+        return "center"
+    if right:
+        return "right"
+    if left:
+        return "left"
+    return None
+
+
+def _plain_text(inlines: tuple[_Inline, ...] | list[_Inline]) -> str:
+    out: list[str] = []
+    for node in inlines:
+        if node.kind in ("text", "code"):
+            out.append(node.text)
+        elif node.kind == "break":
+            out.append(" ")
+        else:
+            out.append(_plain_text(node.children))
+    return "".join(out)
+
+
+# ---- inline parser ---------------------------------------------------------
+
+
+def _parse_inlines(text: str) -> list[_Inline]:
+    out: list[_Inline] = []
+    buf: list[str] = []
+
+    def flush() -> None:
+        if buf:
+            out.append(_Inline("text", text="".join(buf)))
+            buf.clear()
+
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+
+        if ch == "\\" and i + 1 < n:
+            if text[i + 1] == "\n":
+                flush()
+                out.append(_Inline("break"))
+                i += 2
+                continue
+            if text[i + 1] in _ESCAPABLE:
+                buf.append(text[i + 1])
+                i += 2
+                continue
+
+        if ch == "\n":
+            flush_break = len(buf) > 0 and "".join(buf).endswith("  ")
+            if flush_break:
+                while buf and buf[-1] == " ":
+                    buf.pop()
+                flush()
+                out.append(_Inline("break"))
+            else:
+                buf.append(" ")
+            i += 1
+            continue
+
+        if ch == "`":
+            run = len(text[i:]) - len(text[i:].lstrip("`"))
+            ticks = text[i : i + run]
+            end = text.find(ticks, i + run)
+            if end != -1:
+                flush()
+                out.append(_Inline("code", text=text[i + run : end].strip().replace("\n", " ")))
+                i = end + run
+                continue
+            buf.append(ticks)
+            i += run
+            continue
+
+        if ch == "[" and text.startswith("[[MD2DOCX_", i):
+            m = _INLINE_MARKER_RE.match(text, i)
+            if m:
+                flush()
+                if m.group(1):
+                    out.append(_Inline("ref", text=m.group(2), target=m.group(1)))
+                else:
+                    out.append(_Inline("cite", text=m.group(3)))
+                i = m.end()
+                continue
+
+        if ch == "<" and text.startswith("<!--", i):
+            end = text.find("-->", i)
+            if end != -1:
+                i = end + 3
+                continue
+
+        if ch == "<":
+            m = re.match(r"<((?:https?|mailto):[^>\s]+)>", text[i:])
+            if m:
+                flush()
+                url = m.group(1)
+                out.append(_Inline("link", target=url, children=(_Inline("text", text=url),)))
+                i += m.end()
+                continue
+
+        if ch == "[" and text.startswith("[^", i):
+            m = re.match(r"\[\^([^\]\s]+)\]", text[i:])
+            if m:
+                flush()
+                out.append(_Inline("note", text=m.group(1)))
+                i += m.end()
+                continue
+
+        if ch == "[" or (ch == "!" and text.startswith("![", i)):
+            parsed = _parse_bracketed(text, i + (1 if ch == "!" else 0), image=ch == "!")
+            if parsed is not None:
+                flush()
+                node, i = parsed
+                out.append(node)
+                continue
+
+        if ch in "*_":
+            delim = ch * 2 if text.startswith(ch * 2, i) else ch
+            parsed_em = _parse_emphasis(text, i, delim)
+            if parsed_em is not None:
+                flush()
+                node, i = parsed_em
+                out.append(node)
+                continue
+            buf.append(delim)
+            i += len(delim)
+            continue
+
+        buf.append(ch)
+        i += 1
+
+    flush()
+    return out
+
+
+def _matching(text: str, start: int, open_ch: str, close_ch: str) -> int:
+    # Index of the bracket closing text[start], skipping escapes and code spans.
+    depth = 0
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == "`":
+            end = text.find("`", i + 1)
+            if end == -1:
+                return -1
+            i = end + 1
+            continue
+        if ch == open_ch:
+            depth += 1
+        elif ch == close_ch:
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return -1
+
+
+def _parse_bracketed(text: str, start: int, *, image: bool) -> tuple[_Inline, int] | None:
+    close = _matching(text, start, "[", "]")
+    if close == -1:
+        return None
+    label = text[start + 1 : close]
+    after = close + 1
+
+    if after < len(text) and text[after] == "(":
+        end = _matching(text, after, "(", ")")
+        if end == -1:
+            return None
+        dest = text[after + 1 : end].strip()
+        m = re.match(r'^<?([^>\s]*)>?(?:\s+"[^"]*")?$', dest)
+        target = m.group(1) if m else dest
+        after = end + 1
+        attrs: tuple[tuple[str, str], ...] = ()
+        if after < len(text) and text[after] == "{":
+            attr_end = text.find("}", after)
+            if attr_end != -1:
+                attrs = tuple(_parse_attrs(text[after : attr_end + 1]).items())
+                after = attr_end + 1
+        kind = "image" if image else "link"
+        return _Inline(kind, target=target, children=tuple(_parse_inlines(label)), attrs=attrs), after
+
+    if not image and after < len(text) and text[after] == "{":
+        attr_end = text.find("}", after)
+        if attr_end != -1:
+            attrs = tuple(_parse_attrs(text[after : attr_end + 1]).items())
+            return _Inline("span", children=tuple(_parse_inlines(label)), attrs=attrs), attr_end + 1
+    return None
+
+
+def _parse_emphasis(text: str, start: int, delim: str) -> tuple[_Inline, int] | None:
+    inner = start + len(delim)
+    if inner >= len(text) or text[inner].isspace():
+        return None
+    # Intraword underscores (snake_case) are literal, as in pandoc.
+    if delim[0] == "_" and start > 0 and text[start - 1].isalnum():
+        return None
+
+    i = inner
+    while i < len(text):
+        ch = text[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == "`":
+            end = text.find("`", i + 1)
+            i = end + 1 if end != -1 else i + 1
+            continue
+        if ch == "[" and text.startswith("[[MD2DOCX_", i):
+            end = text.find("]]", i)
+            i = end + 2 if end != -1 else i + 1
+            continue
+        if text.startswith(delim, i) and i > inner and not text[i - 1].isspace():
+            if len(delim) == 1 and text.startswith(delim * 2, i):
+                i += 2
+                continue
+            after = i + len(delim)
+            if delim[0] == "_" and after < len(text) and text[after].isalnum():
+                i += 1
+                continue
+            kind = "strong" if len(delim) == 2 else "emph"
+            return _Inline(kind, children=tuple(_parse_inlines(text[inner:i]))), after
+        if len(delim) == 1 and text.startswith(delim * 2, i):
+            i += 2
+            continue
+        i += 1
+    return None
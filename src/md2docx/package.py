@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from pathlib import Path, PurePosixPath
+import os
+import struct
+import time
+from typing import Callable
+import zipfile
+import zlib
+
+
+# Minimal zip writer for the final .docx. Unchanged template parts are copied
+# as their original compressed bytes, already-compressed media is stored, and
+# only the parts we rewrite are deflated. Large parts can also be streamed
+# into an entry instead of being built as one bytes object first.
+
+# Formats whose payload is already compressed; deflating them again costs
+# time and saves nothing.
+STORED_EXTS = ("png", "jpg", "jpeg", "gif", "webp")
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIR = struct.Struct("<IHHHHIIH")
+_LOCAL_SIG = 0x04034B50
+_CENTRAL_SIG = 0x02014B50
+_END_SIG = 0x06054B50
+_VERSION = 20
+_FLAG_ENCRYPTED = 0x1
+_FLAG_UTF8 = 0x800
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+
+@dataclass(frozen=True)
+class RawEntry:
+    """A zip member as stored: compressed bytes plus the fields to re-emit it."""
+
+    name: str
+    compress_type: int
+    crc: int
+    file_size: int
+    date_time: tuple[int, int, int, int, int, int]
+    data: bytes
+
+    @property
+    def compress_size(self) -> int:
+        return len(self.data)
+
+
+def read_raw_entry(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> RawEntry:
+    """Read a member's compressed bytes without inflating them.
+
+    Encrypted members are decompressed and deflated again instead.
+    """
+    if info.flag_bits & _FLAG_ENCRYPTED or zf.fp is None:
+        return compress_entry(info.filename, zf.read(info), date_time=info.date_time)
+    fp = zf.fp
+    fp.seek(info.header_offset)
+    header = fp.read(_LOCAL_HEADER.size)
+    fields = _LOCAL_HEADER.unpack(header)
+    if fields[0] != _LOCAL_SIG:
+        raise RuntimeError(f"Bad zip local header for {info.filename}")
+    fp.seek(fields[9] + fields[10], 1)
+    return RawEntry(
+        name=info.filename,
+        compress_type=info.compress_type,
+        crc=info.CRC,
+        file_size=info.file_size,
+        date_time=info.date_time,
+        data=fp.read(info.compress_size),
+    )
+
+
+def compress_entry(
+    name: str, data: bytes, *, date_time: tuple[int, int, int, int, int, int] | None = None
+) -> RawEntry:
+    """Build an entry for `data`: stored for compressed media, deflated otherwise."""
+    ext = PurePosixPath(name).suffix.lower().lstrip(".")
+    if ext in STORED_EXTS:
+        method, payload = zipfile.ZIP_STORED, data
+    else:
+        co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        method, payload = zipfile.ZIP_DEFLATED, co.compress(data) + co.flush()
+    return RawEntry(
+        name=name,
+        compress_type=method,
+        crc=zlib.crc32(data),
+        file_size=len(data),
+        date_time=date_time or time.localtime(time.time())[:6],
+        data=payload,
+    )
+
+
+def compress_parts(
+    parts: list[tuple[str, bytes | Callable[[], bytes]]], *, max_workers: int | None = None
+) -> list[RawEntry]:
+    """Compress `parts` (zip name -> bytes or a serializer) in a thread pool.
+
+    Serializers run in the pool too, and zlib releases the GIL while
+    deflating. Entries are returned in the order of `parts`, with one shared
+    timestamp, so the package layout does not depend on scheduling.
+    """
+    date_time = time.localtime(time.time())[:6]
+
+    def build(part: tuple[str, bytes | Callable[[], bytes]]) -> RawEntry:
+        name, data = part
+        return compress_entry(name, data if isinstance(data, bytes) else data(), date_time=date_time)
+
+    workers = max(1, min(len(parts), max_workers or os.cpu_count() or 2))
+    if workers == 1:
+        return [build(part) for part in parts]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="md2docx-package") as pool:
+        return list(pool.map(build, parts))
+
+
+class PackageWriter:
+    """Write a zip package from RawEntry objects, in the order they are given."""
+
+    def __init__(self, path: Path) -> None:
+        self._fp = open(path, "wb")
+        self._central: list[bytes] = []
+        self._names: set[str] = set()
+        self._streaming = False
+
+    def __enter__(self) -> PackageWriter:
+        return self
+
+    def __exit__(self, exc_type: object, *exc: object) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._fp.close()
+
+    def writestr(self, name: str, data: bytes) -> None:
+        self.write_raw(compress_entry(name, data))
+
+    def write_raw(self, entry: RawEntry) -> None:
+        self._claim(entry.name)
+        offset = self._fp.tell()
+        self._fp.write(_local_header(entry, entry.compress_size))
+        self._fp.write(entry.data)
+        self._add_central(entry, entry.compress_size, offset)
+
+    def open(self, name: str) -> EntryStream:
+        """Open a deflated entry to write incrementally, like ZipFile.open(name, "w").
+
+        Nothing else may be written until the stream is closed.
+        """
+        self._claim(name)
+        self._streaming = True
+        return EntryStream(self, name)
+
+    def _claim(self, name: str) -> None:
+        if self._streaming:
+            raise RuntimeError(f"Cannot write {name} while another entry is being streamed")
+        if name in self._names:
+            raise RuntimeError(f"Duplicate zip entry: {name}")
+        self._names.add(name)
+
+    def _finish_stream(self, entry: RawEntry, compress_size: int, offset: int) -> None:
+        # The local header was written with zero sizes; patch it in place.
+        end = self._fp.tell()
+        self._fp.seek(offset)
+        self._fp.write(_local_header(entry, compress_size))
+        self._fp.seek(end)
+        self._streaming = False
+        self._add_central(entry, compress_size, offset)
+
+    def _add_central(self, entry: RawEntry, compress_size: int, offset: int) -> None:
+        if max(offset, compress_size, entry.file_size) >= _ZIP32_LIMIT:
+            raise RuntimeError(f"Zip entry too large for the docx writer: {entry.name}")
+        name, flags = _encode_name(entry.name)
+        dos_time, dos_date = _dos_date_time(entry.date_time)
+        self._central.append(
+            _CENTRAL_HEADER.pack(
+                _CENTRAL_SIG,
+                _VERSION,
+                _VERSION,
+                flags,
+                entry.compress_type,
+                dos_time,
+                dos_date,
+                entry.crc,
+                compress_size,
+                entry.file_size,
+                len(name),
+                0,
+                0,
+                0,
+                0,
+                0,
+                offset,
+            )
+            + name
+        )
+
+    def close(self) -> None:
+        if self._fp.closed:
+            return
+        start = self._fp.tell()
+        for record in self._central:
+            self._fp.write(record)
+        size = self._fp.tell() - start
+        count = len(self._central)
+        self._fp.write(_END_OF_CENTRAL_DIR.pack(_END_SIG, 0, 0, count, count, size, start, 0))
+        self._fp.close()
+
+
+class EntryStream:
+    """Writable file object for one PackageWriter entry, deflated as it is written."""
+
+    def __init__(self, writer: PackageWriter, name: str) -> None:
+        self._writer = writer
+        self._fp = writer._fp
+        self._entry = RawEntry(
+            name=name,
+            compress_type=zipfile.ZIP_DEFLATED,
+            crc=0,
+            file_size=0,
+            date_time=time.localtime(time.time())[:6],
+            data=b"",
+        )
+        self._offset = self._fp.tell()
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._crc = 0
+        self._size = 0
+        self._compress_size = 0
+        self._closed = False
+        self._fp.write(_local_header(self._entry, 0))
+
+    def __enter__(self) -> EntryStream:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def write(self, data: bytes) -> int:
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._emit(self._compressor.compress(data))
+        return len(data)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._emit(self._compressor.flush())
+        entry = replace(self._entry, crc=self._crc, file_size=self._size)
+        self._writer._finish_stream(entry, self._compress_size, self._offset)
+
+    def _emit(self, chunk: bytes) -> None:
+        self._fp.write(chunk)
+        self._compress_size += len(chunk)
+
+
+def _local_header(entry: RawEntry, compress_size: int) -> bytes:
+    name, flags = _encode_name(entry.name)
+    dos_time, dos_date = _dos_date_time(entry.date_time)
+    return (
+        _LOCAL_HEADER.pack(
+            _LOCAL_SIG,
+            _VERSION,
+            flags,
+            entry.compress_type,
+            dos_time,
+            dos_date,
+            entry.crc,
+            compress_size,
+            entry.file_size,
+            len(name),
+            0,
+        )
+        + name
+    )
+
+
+def _encode_name(name: str) -> tuple[bytes, int]:
+    try:
+        return name.encode("ascii"), 0
+    except UnicodeEncodeError:
+        return name.encode("utf-8"), _FLAG_UTF8
+
+
+def _dos_date_time(date_time: tuple[int, int, int, int, int, int]) -> tuple[int, int]:
+    year, month, day, hour, minute, second = date_time
+    year = min(max(year, 1980), 2107)
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
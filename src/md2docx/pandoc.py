@@ -1,8 +1,55 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from pathlib import Path
+import base64
+import hashlib
+import json
 import os
+import re
 import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from md2docx.cache import RenderCache
+from md2docx.docxops import write_reference_doc
+
+PANDOC_FROM = "markdown+fenced_divs+bracketed_spans+link_attributes+raw_attribute"
+
+# Turns caption/reference/citation markers into Word fields during the
+# conversion; docxops falls back to scanning for markers without it.
+FIELDS_FILTER = Path(__file__).resolve().parent / "filters" / "fields.lua"
+
+# When set (e.g. http://127.0.0.1:3030), conversions are POSTed to a running
+# `pandoc server` (see `md2docx pandoc-server`). The pandoc subprocess is used
+# when the variable is unset or the server is unreachable.
+PANDOC_SERVER_ENV = "MD2DOCX_PANDOC_SERVER"
+PANDOC_SERVER_DEFAULT_PORT = 3030
+PANDOC_SERVER_DEFAULT_TIMEOUT_S = 120
+_SERVER_TIMEOUT_S = 300.0
+
+_IMAGE_REF_RE = re.compile(r"!\[[^\]]*\]\(<?([^)\s>]+)>?")
+
+# Bump when docxops.write_reference_doc changes what it keeps.
+_REFERENCE_DOC_VERSION = "1"
+
+
+def prepare_reference_doc(*, template_docx: Path, workdir: Path, cache: RenderCache | None) -> Path:
+    """Stripped copy of the template to pass to pandoc as --reference-doc.
+
+    Pandoc only uses the template's styles, so cover pages and images are
+    left out. The result is cached by the template's content hash.
+    """
+    out = workdir / "reference.docx"
+    digest = hashlib.sha256(template_docx.read_bytes()).hexdigest()
+    key = RenderCache.make_key("reference-doc", _REFERENCE_DOC_VERSION, digest)
+    if cache is not None and cache.fetch(key, out):
+        return out
+    write_reference_doc(template_docx=template_docx, output_docx=out)
+    if cache is not None:
+        cache.store(key, out)
+    return out
 
 
 def run_pandoc_to_docx(
@@ -21,19 +68,29 @@ def run_pandoc_to_docx(
         s = str(p)
         if s not in uniq:
             uniq.append(s)
+    if _convert_via_server(
+        input_md=input_md,
+        output_docx=output_docx,
+        reference_doc=reference_doc,
+        resource_paths=[Path(p) for p in uniq],
+    ):
+        return
+
     resource_path_arg = os.pathsep.join(uniq)
 
     cmd = [
         "pandoc",
         str(input_md),
         "--from",
-        "markdown+fenced_divs+bracketed_spans+link_attributes+raw_attribute",
+        PANDOC_FROM,
         "--to",
         "docx",
         "--reference-doc",
         str(reference_doc),
         "--resource-path",
         resource_path_arg,
+        "--lua-filter",
+        str(FIELDS_FILTER),
         "-o",
         str(output_docx),
     ]
@@ -42,3 +99,119 @@ def run_pandoc_to_docx(
     if p.returncode != 0:
         stderr = p.stderr.decode("utf-8", errors="replace")
         raise RuntimeError(f"pandoc failed (code {p.returncode}): {stderr}")
+
+
+@lru_cache(maxsize=1)
+def pandoc_renderer_id() -> str:
+    """Identity of the pandoc converter used for section cache keys."""
+    try:
+        p = subprocess.run(["pandoc", "--version"], capture_output=True, text=True)
+        version = p.stdout.splitlines()[0] if p.returncode == 0 and p.stdout else "unknown"
+    except OSError:
+        version = "missing"
+    filter_digest = hashlib.sha256(FIELDS_FILTER.read_bytes()).hexdigest()[:16]
+    return f"pandoc|{version}|from={PANDOC_FROM}|filter={filter_digest}"
+
+
+def _convert_via_server(
+    *,
+    input_md: Path,
+    output_docx: Path,
+    reference_doc: Path,
+    resource_paths: list[Path],
+) -> bool:
+    """Convert through a pandoc server. Returns False if no server is reachable.
+
+    The server does no file IO of its own, so the reference doc and every
+    local image in the document are sent along in `files`. Images are taken
+    from the server's own parse of the markdown (a JSON AST request), so
+    reference-style and angle-bracket targets are found as pandoc sees them.
+    If the server still could not fetch a resource, the subprocess is used.
+    """
+    base = os.environ.get(PANDOC_SERVER_ENV)
+    if not base:
+        return False
+
+    text = input_md.read_text(encoding="utf-8")
+    ast = _server_request(base, {"text": text, "from": PANDOC_FROM, "to": "json"})
+    if ast is None:
+        return False
+
+    files = {"reference.docx": base64.b64encode(reference_doc.read_bytes()).decode("ascii")}
+    for ref in _local_image_targets(json.loads(_server_output(ast))):
+        for root in resource_paths:
+            path = root / ref
+            if path.is_file():
+                files[ref] = base64.b64encode(path.read_bytes()).decode("ascii")
+                break
+
+    reply = _server_request(
+        base,
+        {
+            "text": text,
+            "from": PANDOC_FROM,
+            "to": "docx",
+            "reference-doc": "reference.docx",
+            "files": files,
+        },
+    )
+    if reply is None:
+        return False
+    # pandoc replaces images it cannot fetch with their description.
+    if any(m.get("type") == "CouldNotFetchResource" for m in reply.get("messages") or []):
+        return False
+    output_docx.write_bytes(_server_output(reply))
+    return True
+
+
+def _server_request(base: str, payload: dict) -> dict | None:
+    """POST one conversion to the pandoc server; None if it is unreachable."""
+    req = urllib.request.Request(
+        base,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json", "Accept": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=_SERVER_TIMEOUT_S) as resp:
+            reply = json.loads(resp.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        detail = e.read().decode("utf-8", errors="replace").strip()
+        raise RuntimeError(f"pandoc server failed ({e.code}): {detail}") from e
+    except (urllib.error.URLError, OSError):
+        return None
+
+    if "output" not in reply:
+        raise RuntimeError(f"pandoc server failed: {reply.get('error') or reply}")
+    return reply
+
+
+def _server_output(reply: dict) -> bytes:
+    output = reply["output"]
+    return base64.b64decode(output) if reply.get("base64") else output.encode("utf-8")
+
+
+def _local_image_targets(node: object) -> list[str]:
+    """Local Image targets in a pandoc JSON AST, unescaped, in document order."""
+    out: dict[str, None] = {}
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(reversed(item))
+        elif isinstance(item, dict):
+            if item.get("t") == "Image":
+                target = urllib.parse.unquote(item["c"][2][0])
+                if target and "://" not in target and not target.startswith("data:"):
+                    out[target] = None
+            stack.extend(reversed(list(item.values())))
+    return list(out)
+
+
+def run_pandoc_server(*, port: int, timeout: int = PANDOC_SERVER_DEFAULT_TIMEOUT_S) -> int:
+    """Run `pandoc server` in the foreground until interrupted."""
+    cmd = ["pandoc", "server", "--port", str(port), "--timeout", str(timeout)]
+    try:
+        return subprocess.run(cmd).returncode
+    except KeyboardInterrupt:
+        return 0
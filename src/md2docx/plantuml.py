@@ -1,13 +1,178 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from pathlib import Path
+import hashlib
+import os
 import shutil
 import subprocess
+import urllib.error
+import urllib.request
+import zlib
+
+
+# Printed by PlantUML after each image in -pipe mode (see -pipedelimitor).
+_PIPE_DELIMITER = "___MD2DOCX_PLANTUML_END___"
+
+# When set (e.g. http://127.0.0.1:8080/plantuml), renders are HTTP requests to a
+# running PlantUML server such as `md2docx plantuml-server`. The -pipe JVM path
+# is used when the variable is unset or the server is unreachable.
+PLANTUML_SERVER_ENV = "MD2DOCX_PLANTUML_SERVER"
+PLANTUML_SERVER_DEFAULT_PORT = 8080
+_SERVER_TIMEOUT_S = 60.0
+_ENCODE_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_"
 
 
 def render_plantuml_to_png(plantuml_src: str, *, output_png: Path) -> None:
-    output_png.parent.mkdir(parents=True, exist_ok=True)
+    render_plantuml(plantuml_src, output=output_png, fmt="png")
+
+
+def render_plantuml(plantuml_src: str, *, output: Path, fmt: str = "png") -> None:
+    """Render one diagram to `output` as "png" or "svg"."""
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    if _render_via_server(plantuml_src, output=output, fmt=fmt):
+        return
+
+    result = _run_pipe(plantuml_src, fmt=fmt, extra_args=[])
+    if not result.stdout:
+        stderr = result.stderr.decode("utf-8", errors="replace").strip()
+        raise RuntimeError(f"PlantUML returned no {fmt.upper()} output. {stderr}")
+
+    output.write_bytes(result.stdout)
+
+
+def render_plantuml_batch(jobs: list[tuple[str, Path]], *, fmt: str = "png") -> None:
+    """Render several diagrams in a single JVM.
+
+    All sources are piped into one `-pipe` invocation and the concatenated
+    output stream is split on the pipe delimiter. If the batch fails or yields
+    an unexpected number of images we fall back to one JVM per diagram, which
+    also reports errors for the offending figure.
+    """
+    if not jobs:
+        return
+    if len(jobs) == 1 or os.environ.get(PLANTUML_SERVER_ENV):
+        for src, output in jobs:
+            render_plantuml(src, output=output, fmt=fmt)
+        return
+
+    try:
+        images = _render_pipe_batch([src for src, _ in jobs], fmt=fmt)
+    except RuntimeError:
+        images = None
+
+    if images is None or len(images) != len(jobs):
+        for src, output in jobs:
+            render_plantuml(src, output=output, fmt=fmt)
+        return
 
+    for (_, output), data in zip(jobs, images):
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_bytes(data)
+
+
+def _render_via_server(plantuml_src: str, *, output: Path, fmt: str) -> bool:
+    """Render through a PlantUML server. Returns False if no server is reachable."""
+    base = os.environ.get(PLANTUML_SERVER_ENV)
+    if not base:
+        return False
+
+    url = f"{base.rstrip('/')}/{fmt}/{_encode_source(plantuml_src)}"
+    try:
+        with urllib.request.urlopen(url, timeout=_SERVER_TIMEOUT_S) as resp:
+            data = resp.read()
+    except urllib.error.HTTPError as e:
+        # The server answers syntax errors with an error image and a 4xx status.
+        detail = e.headers.get("X-PlantUML-Diagram-Error") or e.reason
+        raise RuntimeError(f"Unable to render PlantUML (server): {detail}") from e
+    except (urllib.error.URLError, OSError):
+        return False
+
+    if not data:
+        return False
+    output.write_bytes(data)
+    return True
+
+
+def with_plantuml_dpi(plantuml_src: str, dpi: int) -> str:
+    """Insert `skinparam dpi` after the @start line (PlantUML renders at 96 DPI by default)."""
+    lines = plantuml_src.splitlines()
+    for idx, line in enumerate(lines):
+        if line.strip().lower().startswith("@start"):
+            lines.insert(idx + 1, f"skinparam dpi {dpi}")
+            return "\n".join(lines)
+    return f"skinparam dpi {dpi}\n{plantuml_src}"
+
+
+def _encode_source(plantuml_src: str) -> str:
+    # PlantUML text encoding: raw deflate, then a base64 variant over a custom alphabet.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    data = compressor.compress(plantuml_src.encode("utf-8")) + compressor.flush()
+
+    out: list[str] = []
+    for i in range(0, len(data), 3):
+        chunk = data[i : i + 3].ljust(3, b"\0")
+        b1, b2, b3 = chunk[0], chunk[1], chunk[2]
+        out.append(_ENCODE_ALPHABET[b1 >> 2])
+        out.append(_ENCODE_ALPHABET[((b1 & 0x3) << 4) | (b2 >> 4)])
+        out.append(_ENCODE_ALPHABET[((b2 & 0xF) << 2) | (b3 >> 6)])
+        out.append(_ENCODE_ALPHABET[b3 & 0x3F])
+    return "".join(out)
+
+
+def run_plantuml_server(*, host: str, port: int) -> int:
+    """Run PlantUML's built-in web server in the foreground until interrupted."""
+    cmd = [
+        *_java_jar_cmd(),
+        f"-picoweb:{port}:{host}",
+    ]
+    try:
+        return subprocess.run(cmd).returncode
+    except KeyboardInterrupt:
+        return 0
+
+
+def _render_pipe_batch(sources: list[str], *, fmt: str) -> list[bytes]:
+    stdin = "\n".join(src.strip() for src in sources) + "\n"
+    result = _run_pipe(stdin, fmt=fmt, extra_args=["-pipedelimitor", _PIPE_DELIMITER])
+
+    parts = result.stdout.split(_PIPE_DELIMITER.encode("ascii"))
+    images: list[bytes] = []
+    for part in parts:
+        # The delimiter is written with println, so strip the line break it leaves behind.
+        if part.startswith(b"\r\n"):
+            part = part[2:]
+        elif part.startswith(b"\n"):
+            part = part[1:]
+        if part:
+            images.append(part)
+    return images
+
+
+def _run_pipe(stdin: str, *, fmt: str, extra_args: list[str]) -> subprocess.CompletedProcess[bytes]:
+    cmd = [
+        *_java_jar_cmd(),
+        "-charset",
+        "UTF-8",
+        f"-t{fmt}",
+        "-pipe",
+        *extra_args,
+    ]
+
+    try:
+        return subprocess.run(
+            cmd,
+            input=stdin.encode("utf-8"),
+            check=True,
+            capture_output=True,
+        )
+    except subprocess.CalledProcessError as e:
+        stderr = e.stderr.decode("utf-8", errors="replace").strip()
+        raise RuntimeError(f"Unable to render PlantUML: {stderr or e}") from e
+
+
+def _java_jar_cmd() -> list[str]:
     java_bin = _resolve_java_bin()
     if not java_bin:
         raise RuntimeError(
@@ -21,33 +186,35 @@ def render_plantuml_to_png(plantuml_src: str, *, output_png: Path) -> None:
             f"PlantUML jar not found at {jar_path}. Ensure tools/plantuml/plantuml.jar exists in this repository."
         )
 
-    cmd = [
+    return [
         java_bin,
         "-Djava.awt.headless=true",
         "-jar",
         str(jar_path),
-        "-charset",
-        "UTF-8",
-        "-tpng",
-        "-pipe",
     ]
 
+
+def plantuml_renderer_id() -> str:
+    """Identity of the PlantUML renderer used for render cache keys."""
+    jar_path = _plantuml_jar_path()
+    return f"plantuml|jar={_jar_digest(jar_path)}"
+
+
+def _jar_digest(jar_path: Path) -> str:
     try:
-        result = subprocess.run(
-            cmd,
-            input=plantuml_src.encode("utf-8"),
-            check=True,
-            capture_output=True,
-        )
-    except subprocess.CalledProcessError as e:
-        stderr = e.stderr.decode("utf-8", errors="replace").strip()
-        raise RuntimeError(f"Unable to render PlantUML: {stderr or e}") from e
+        st = jar_path.stat()
+    except OSError:
+        return "missing"
+    return _file_sha256(str(jar_path), st.st_mtime_ns, st.st_size)
 
-    if not result.stdout:
-        stderr = result.stderr.decode("utf-8", errors="replace").strip()
-        raise RuntimeError(f"PlantUML returned no PNG output. {stderr}")
 
-    output_png.write_bytes(result.stdout)
+@lru_cache(maxsize=8)
+def _file_sha256(path: str, mtime_ns: int, size: int) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
 
 def _plantuml_jar_path() -> Path:
@@ -55,6 +222,7 @@ def _plantuml_jar_path() -> Path:
     return repo_root / "tools" / "plantuml" / "plantuml.jar"
 
 
+@lru_cache(maxsize=1)
 def _resolve_java_bin() -> str | None:
     java_bin = shutil.which("java")
     if java_bin:
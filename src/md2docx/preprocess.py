@@ -1,13 +1,24 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
+import hashlib
 import re
-import struct
 
-from md2docx.codeimg import render_code_to_png
-from md2docx.mermaid import render_mermaid_to_png
-from md2docx.plantuml import render_plantuml_to_png
+from md2docx.cache import RenderCache
+from md2docx.codeimg import code_renderer_id, render_code_batch
+from md2docx.codetext import render_code_to_openxml
+from md2docx.imageprobe import probe_image
+from md2docx.mermaid import (
+    MERMAID_FALLBACK_SCALE,
+    MERMAID_SCALE,
+    MERMAID_WIDTH,
+    mermaid_renderer_id,
+    mermaid_size_for_dpi,
+    render_mermaid_batch,
+)
+from md2docx.plantuml import plantuml_renderer_id, render_plantuml_batch, with_plantuml_dpi
+from md2docx.scheduler import RenderLimits, RenderTask, run_render_tasks, split_balanced
 
 
 CAPTION_FIG_RE = re.compile(r"^\[\[MD2DOCX_CAPTION_FIG:([A-Za-z0-9_-]+)\|(.*)\]\]$")
@@ -17,6 +28,8 @@ CAPTION_TAB_RE = re.compile(r"^\[\[MD2DOCX_CAPTION_TAB:([A-Za-z0-9_-]+)\|(.*)\]\
 @dataclass(frozen=True)
 class PreprocessResult:
     markdown: str
+    # sha256 of a PNG diagram -> its SVG rendering (diagram_format="svg").
+    svg_images: dict[str, Path] = field(default_factory=dict)
 
 
 _FIG_DIRECTIVE_RE = re.compile(r"^<!--\s*figure\s+(.*?)\s*-->\s*$")
@@ -28,22 +41,13 @@ _CITATION_GROUP_RE = re.compile(r"\[(?P<content>[^\[\]]*?@[^\]]*?)\]")
 MERMAID_MAX_WIDTH_IN = 6.0
 MERMAID_MAX_HEIGHT_IN = 7.0
 
+# Code figures are rendered as PNG screenshots ("image") or as native,
+# searchable Word text ("text"). Per figure: <!--figure ... render=text-->.
+CODE_FIGURE_MODES = ("image", "text")
 
-def _png_dimensions(path: Path) -> tuple[int, int] | None:
-    data = path.read_bytes()
-    if data[:8] != b"\x89PNG\r\n\x1a\n":
-        return None
-    off = 8
-    if len(data) < off + 24:
-        return None
-    length = struct.unpack(">I", data[off : off + 4])[0]
-    if data[off + 4 : off + 8] != b"IHDR":
-        return None
-    ihdr = data[off + 8 : off + 8 + length]
-    if len(ihdr) < 8:
-        return None
-    w, h = struct.unpack(">II", ihdr[:8])
-    return int(w), int(h)
+# Mermaid/PlantUML diagrams are embedded as PNG, or as SVG with a small PNG
+# fallback for readers without SVG support.
+DIAGRAM_FORMATS = ("png", "svg")
 
 
 def _parse_kv(s: str) -> dict[str, str]:
@@ -93,16 +97,163 @@ def _replace_citation_groups(text: str) -> str:
     return _CITATION_GROUP_RE.sub(repl, text)
 
 
-def preprocess_markdown(*, input_md: Path, out_dir: Path, media_dir: Path) -> PreprocessResult:
+@dataclass
+class _FigureJob:
+    kind: str  # "mermaid" | "plantuml" | "code"
+    source: str
+    output: Path
+    # Index in the output lines of the image line, filled in after rendering.
+    # None for the SVG companion of a PNG fallback.
+    line_index: int | None
+    language: str | None = None
+    fmt: str = "png"
+    # Mermaid device scale factor and viewport width (CSS px).
+    scale: str = MERMAID_SCALE
+    width: str = MERMAID_WIDTH
+    # For SVG jobs: the PNG rendered alongside as fallback.
+    fallback_png: Path | None = None
+
+
+def _cache_key(job: _FigureJob) -> str:
+    if job.kind == "mermaid":
+        return RenderCache.make_key(mermaid_renderer_id(), job.fmt, job.scale, job.width, job.source)
+    if job.kind == "plantuml":
+        return RenderCache.make_key(plantuml_renderer_id(), job.fmt, job.source)
+    return RenderCache.make_key(code_renderer_id(), job.language or "", job.source)
+
+
+def _diagram_jobs(
+    kind: str,
+    source: str,
+    *,
+    media_dir: Path,
+    fig_id: str,
+    line_index: int,
+    diagram_format: str,
+    dpi: int | None,
+) -> list[_FigureJob]:
+    png = media_dir / f"fig_{fig_id}.png"
+    if diagram_format == "png":
+        if dpi is None:
+            return [_FigureJob(kind=kind, source=source, output=png, line_index=line_index)]
+        # Render at the DPI budget for the largest displayed size instead of
+        # the fixed default resolution.
+        if kind == "plantuml":
+            return [_FigureJob(kind=kind, source=with_plantuml_dpi(source, dpi), output=png, line_index=line_index)]
+        scale, width = mermaid_size_for_dpi(dpi, max_width_in=MERMAID_MAX_WIDTH_IN)
+        return [_FigureJob(kind=kind, source=source, output=png, line_index=line_index, scale=scale, width=width)]
+    # The PNG is only a fallback, so Mermaid renders it at 1x instead of 4x
+    # and the DPI budget does not apply.
+    return [
+        _FigureJob(kind=kind, source=source, output=png, line_index=line_index, scale=MERMAID_FALLBACK_SCALE),
+        _FigureJob(
+            kind=kind,
+            source=source,
+            output=media_dir / f"fig_{fig_id}.svg",
+            line_index=None,
+            fmt="svg",
+            fallback_png=png,
+        ),
+    ]
+
+
+# Rough per-renderer cost model (seconds) used to start the longest work first:
+# a fixed process/browser startup plus a term proportional to the source size.
+_RENDER_STARTUP_COST = {"mermaid": 3.0, "plantuml": 1.5, "code": 0.05}
+_RENDER_CHAR_COST = {"mermaid": 0.002, "plantuml": 0.001, "code": 0.0001}
+
+
+def _job_cost(job: _FigureJob) -> float:
+    return _RENDER_CHAR_COST[job.kind] * len(job.source)
+
+
+def _render_figure_jobs(
+    jobs: list[_FigureJob],
+    *,
+    cache: RenderCache | None,
+    limits: RenderLimits,
+) -> None:
+    pending = [job for job in jobs if cache is None or not cache.fetch(_cache_key(job), job.output)]
+
+    def task(kind: str, fmt: str, scale: str, width: str, group: list[_FigureJob]) -> RenderTask:
+        cost = _RENDER_STARTUP_COST[kind] + sum(_job_cost(j) for j in group)
+
+        def run() -> None:
+            if kind == "mermaid":
+                render_mermaid_batch([(j.source, j.output) for j in group], fmt=fmt, scale=scale, width=width)
+            elif kind == "plantuml":
+                render_plantuml_batch([(j.source, j.output) for j in group], fmt=fmt)
+            else:
+                render_code_batch([(j.source, j.language, j.output) for j in group])
+            if cache is not None:
+                for j in group:
+                    cache.store(_cache_key(j), j.output)
+
+        return RenderTask(renderer=kind, cost=cost, run=run)
+
+    # Jobs are batched (one mmdc / one JVM / one reused Pygments formatter per
+    # batch and output format), with as many batches as the renderer may run
+    # concurrently.
+    tasks: list[RenderTask] = []
+    variants = sorted({(j.kind, j.fmt, j.scale, j.width) for j in pending})
+    for kind, fmt, scale, width in variants:
+        variant_jobs = [j for j in pending if (j.kind, j.fmt, j.scale, j.width) == (kind, fmt, scale, width)]
+        for group in split_balanced(variant_jobs, parts=limits.for_renderer(kind), cost=_job_cost):
+            tasks.append(task(kind, fmt, scale, width, group))
+
+    run_render_tasks(tasks, limits=limits)
+
+
+def _figure_dpi(figure: dict[str, str], *, default: int | None, line_no: int) -> int | None:
+    raw = figure.get("dpi")
+    if raw is None:
+        return default
+    try:
+        dpi = int(raw)
+    except ValueError:
+        dpi = 0
+    if dpi <= 0:
+        raise ValueError(f"invalid figure dpi {raw!r} at line {line_no}")
+    return dpi
+
+
+def _image_line(png_path: Path, *, out_dir: Path) -> str:
+    # Reference relative to processed.md
+    rel = png_path.relative_to(out_dir)
+    info = probe_image(png_path)
+    width_in = MERMAID_MAX_WIDTH_IN
+    if info is not None and info.height > 0:
+        width_in = min(MERMAID_MAX_WIDTH_IN, MERMAID_MAX_HEIGHT_IN * (info.width / info.height))
+    return f"![]({rel.as_posix()}){{width={width_in:.2f}in}}"
+
+
+def preprocess_markdown(
+    *,
+    input_md: Path,
+    out_dir: Path,
+    media_dir: Path,
+    cache: RenderCache | None = None,
+    limits: RenderLimits | None = None,
+    code_figures: str = "image",
+    diagram_format: str = "png",
+    figure_dpi: int | None = None,
+) -> PreprocessResult:
+    if diagram_format not in DIAGRAM_FORMATS:
+        raise ValueError(f"unknown diagram format {diagram_format!r}")
+    if code_figures not in CODE_FIGURE_MODES:
+        raise ValueError(f"unknown code figure render mode {code_figures!r}")
+
     raw = input_md.read_text(encoding="utf-8")
     lines = raw.splitlines()
 
     out_lines: list[str] = []
+    jobs: list[_FigureJob] = []
 
     i = 0
     in_code_fence = False
     code_fence = ""
     pending_figure: dict[str, str] | None = None
+    figure_line = 0
     pending_table: dict[str, str] | None = None
 
     while i < len(lines):
@@ -140,18 +291,18 @@ def preprocess_markdown(*, input_md: Path, out_dir: Path, media_dir: Path) -> Pr
                     ]
                 )
 
-                png_path = media_dir / f"fig_{fig_id}.png"
-                render_mermaid_to_png("\n".join(mermaid_lines), output_png=png_path)
-
-                # Reference relative to processed.md
-                rel = png_path.relative_to(out_dir)
-                dims = _png_dimensions(png_path)
-                width_in = MERMAID_MAX_WIDTH_IN
-                if dims is not None:
-                    w_px, h_px = dims
-                    if h_px > 0:
-                        width_in = min(MERMAID_MAX_WIDTH_IN, MERMAID_MAX_HEIGHT_IN * (w_px / h_px))
-                out_lines.append(f"![]({rel.as_posix()}){{width={width_in:.2f}in}}")
+                jobs.extend(
+                    _diagram_jobs(
+                        "mermaid",
+                        "\n".join(mermaid_lines),
+                        media_dir=media_dir,
+                        fig_id=fig_id,
+                        line_index=len(out_lines),
+                        diagram_format=diagram_format,
+                        dpi=_figure_dpi(pending_figure, default=figure_dpi, line_no=figure_line),
+                    )
+                )
+                out_lines.append("")
                 out_lines.append("")
                 out_lines.append(f"Fuente: {source}")
                 out_lines.append("")
@@ -184,18 +335,18 @@ def preprocess_markdown(*, input_md: Path, out_dir: Path, media_dir: Path) -> Pr
                     ]
                 )
 
-                png_path = media_dir / f"fig_{fig_id}.png"
-                render_plantuml_to_png("\n".join(plantuml_lines), output_png=png_path)
-
-                # Reference relative to processed.md
-                rel = png_path.relative_to(out_dir)
-                dims = _png_dimensions(png_path)
-                width_in = MERMAID_MAX_WIDTH_IN
-                if dims is not None:
-                    w_px, h_px = dims
-                    if h_px > 0:
-                        width_in = min(MERMAID_MAX_WIDTH_IN, MERMAID_MAX_HEIGHT_IN * (w_px / h_px))
-                out_lines.append(f"![]({rel.as_posix()}){{width={width_in:.2f}in}}")
+                jobs.extend(
+                    _diagram_jobs(
+                        "plantuml",
+                        "\n".join(plantuml_lines),
+                        media_dir=media_dir,
+                        fig_id=fig_id,
+                        line_index=len(out_lines),
+                        diagram_format=diagram_format,
+                        dpi=_figure_dpi(pending_figure, default=figure_dpi, line_no=figure_line),
+                    )
+                )
+                out_lines.append("")
                 out_lines.append("")
                 out_lines.append(f"Fuente: {source}")
                 out_lines.append("")
@@ -230,17 +381,27 @@ def preprocess_markdown(*, input_md: Path, out_dir: Path, media_dir: Path) -> Pr
                     ]
                 )
 
-                png_path = media_dir / f"code_{fig_id}.png"
-                render_code_to_png("\n".join(code_lines), language=lang, output_png=png_path)
-
-                rel = png_path.relative_to(out_dir)
-                dims = _png_dimensions(png_path)
-                width_in = MERMAID_MAX_WIDTH_IN
-                if dims is not None:
-                    w_px, h_px = dims
-                    if h_px > 0:
-                        width_in = min(MERMAID_MAX_WIDTH_IN, MERMAID_MAX_HEIGHT_IN * (w_px / h_px))
-                out_lines.append(f"![]({rel.as_posix()}){{width={width_in:.2f}in}}")
+                mode = pending_figure.get("render", code_figures)
+                if mode == "text":
+                    # Native Word code block, passed through pandoc as raw OpenXML.
+                    out_lines.extend(
+                        [
+                            "```{=openxml}",
+                            render_code_to_openxml("\n".join(code_lines), language=lang),
+                            "```",
+                        ]
+                    )
+                else:
+                    jobs.append(
+                        _FigureJob(
+                            kind="code",
+                            source="\n".join(code_lines),
+                            output=media_dir / f"code_{fig_id}.png",
+                            line_index=len(out_lines),
+                            language=lang,
+                        )
+                    )
+                    out_lines.append("")
                 out_lines.append("")
                 out_lines.append(f"Fuente: {source}")
                 out_lines.append("")
@@ -296,6 +457,11 @@ def preprocess_markdown(*, input_md: Path, out_dir: Path, media_dir: Path) -> Pr
                     raise ValueError(f"figure directive missing required keys at line {i+1}")
                 pending_figure = {k: v for k, v in pending_figure.items()}
                 pending_figure["id"] = _sanitize_id(pending_figure["id"])
+                if pending_figure.get("render", code_figures) not in CODE_FIGURE_MODES:
+                    raise ValueError(
+                        f"unknown code figure render mode {pending_figure['render']!r} at line {i+1}"
+                    )
+                figure_line = i + 1
                 i += 1
                 continue
 
@@ -351,4 +517,13 @@ def preprocess_markdown(*, input_md: Path, out_dir: Path, media_dir: Path) -> Pr
             out_lines.append(_replace_inline_tokens(line))
         i += 1
 
-    return PreprocessResult(markdown="\n".join(out_lines) + "\n")
+    # Rendering may finish in any order; image lines are filled in by job index.
+    _render_figure_jobs(jobs, cache=cache, limits=limits or RenderLimits())
+    svg_images: dict[str, Path] = {}
+    for job in jobs:
+        if job.line_index is not None:
+            out_lines[job.line_index] = _image_line(job.output, out_dir=out_dir)
+        if job.fallback_png is not None:
+            svg_images[hashlib.sha256(job.fallback_png.read_bytes()).hexdigest()] = job.output
+
+    return PreprocessResult(markdown="\n".join(out_lines) + "\n", svg_images=svg_images)
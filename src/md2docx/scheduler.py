@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable
+import os
+
+
+def _default_code_jobs() -> int:
+    return os.cpu_count() or 2
+
+
+@dataclass(frozen=True)
+class RenderLimits:
+    """Maximum concurrent tasks per renderer.
+
+    Chromium (Mermaid) is memory hungry, a JVM (PlantUML) less so, and
+    Pygments runs in-process, so each renderer gets its own cap. `pandoc`
+    bounds the section conversions of a split build.
+    """
+
+    mermaid: int = 2
+    plantuml: int = 2
+    code: int = field(default_factory=_default_code_jobs)
+    pandoc: int = field(default_factory=_default_code_jobs)
+
+    def for_renderer(self, renderer: str) -> int:
+        return max(1, int(getattr(self, renderer)))
+
+
+@dataclass(frozen=True)
+class RenderTask:
+    renderer: str  # "mermaid" | "plantuml" | "code" | "pandoc"
+    # Relative duration estimate; larger tasks are started first.
+    cost: float
+    run: Callable[[], None]
+
+
+def run_render_tasks(tasks: list[RenderTask], *, limits: RenderLimits) -> None:
+    """Run tasks concurrently, one thread pool per renderer.
+
+    Tasks are submitted longest-first so the slowest work overlaps with
+    everything else. The first failure cancels tasks that have not started
+    yet and is re-raised.
+    """
+    if not tasks:
+        return
+    if len(tasks) == 1:
+        tasks[0].run()
+        return
+
+    renderers = sorted({t.renderer for t in tasks})
+    pools = {
+        name: ThreadPoolExecutor(max_workers=limits.for_renderer(name), thread_name_prefix=f"md2docx-{name}")
+        for name in renderers
+    }
+    futures: list[Future[None]] = []
+    try:
+        for task in sorted(tasks, key=lambda t: t.cost, reverse=True):
+            futures.append(pools[task.renderer].submit(task.run))
+
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for f in not_done:
+            f.cancel()
+        for f in done:
+            f.result()
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def split_balanced(items: list, *, parts: int, cost: Callable[[object], float]) -> list[list]:
+    """Split items into at most `parts` groups of similar total cost (longest first)."""
+    parts = max(1, min(parts, len(items)))
+    groups: list[list] = [[] for _ in range(parts)]
+    totals = [0.0] * parts
+    for item in sorted(items, key=cost, reverse=True):
+        idx = totals.index(min(totals))
+        groups[idx].append(item)
+        totals[idx] += cost(item)
+    return [g for g in groups if g]
@@ -0,0 +1,369 @@
+from __future__ import annotations
+
+from pathlib import Path
+import copy
+import hashlib
+import re
+import zipfile
+
+from lxml import etree as ET
+
+from md2docx.cache import RenderCache
+from md2docx.docxops import NS, PKG_REL_NS, R_NS, W_NS, WP_NS, BodyPackage
+from md2docx.pandoc import _IMAGE_REF_RE, pandoc_renderer_id, run_pandoc_to_docx
+from md2docx.scheduler import RenderLimits, RenderTask, run_render_tasks
+
+
+# Split builds convert each Heading 1 section with its own pandoc run (in
+# parallel, cached by content) and stitch the section bodies back together.
+# Footnote and link reference definitions are global in markdown, so every
+# section gets a copy of the definitions it uses.
+
+_FENCE_RE = re.compile(r"^\s*(`{3,}|~{3,})")
+_DEFINITION_RE = re.compile(r"^ {0,3}\[(\^?[^\]]+)\]:")
+_NOTE_REF_RE = re.compile(r"\[\^([^\]\s]+)\]")
+# Any bracketed text: link text, a full/collapsed reference label or a
+# shortcut reference.
+_BRACKETED_RE = re.compile(r"\[([^\[\]]+)\]")
+_SEQ_INSTR_RE = re.compile(r"^\s*SEQ (\S+)")
+_REF_INSTR_RE = re.compile(r"^\s*REF (\S+)")
+
+# Rough cost model (seconds): pandoc startup plus a term per character.
+_PANDOC_STARTUP_COST = 0.3
+_PANDOC_CHAR_COST = 0.00002
+
+
+def split_markdown_sections(markdown: str) -> list[str]:
+    """Split markdown before each `# ` heading (outside code and comments)."""
+    sections: list[list[str]] = [[]]
+    definitions: list[tuple[str, list[str]]] = []
+    lines = markdown.split("\n")
+    fence: str | None = None
+    in_comment = False
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        m = _FENCE_RE.match(line)
+        if not in_comment and m and (fence is None or m.group(1).startswith(fence)):
+            fence = None if fence else m.group(1)[:3]
+        elif fence is None and not in_comment:
+            d = _DEFINITION_RE.match(line)
+            if d:
+                block = [line]
+                i += 1
+                while i < len(lines) and (
+                    lines[i].startswith(("    ", "\t"))
+                    or (not lines[i].strip() and i + 1 < len(lines) and lines[i + 1].startswith(("    ", "\t")))
+                ):
+                    block.append(lines[i])
+                    i += 1
+                definitions.append((d.group(1), block))
+                continue
+            if line.startswith("# ") and any(s.strip() for s in sections[-1]):
+                sections.append([])
+            if "<!--" in line and "-->" not in line[line.index("<!--") :]:
+                in_comment = True
+        elif in_comment and "-->" in line:
+            in_comment = False
+        sections[-1].append(line)
+        i += 1
+
+    out: list[str] = []
+    for section in sections:
+        text = "\n".join(section)
+        notes = set(_NOTE_REF_RE.findall(text))
+        labels = {_normalize_label(b) for b in _BRACKETED_RE.findall(text)}
+        used = [
+            block
+            for label, block in definitions
+            if (label[1:] in notes if label.startswith("^") else _normalize_label(label) in labels)
+        ]
+        if used:
+            text = text.rstrip("\n") + "\n\n" + "\n\n".join("\n".join(b) for b in used) + "\n"
+        out.append(text)
+    return out
+
+
+def _normalize_label(label: str) -> str:
+    # Link reference labels match case-insensitively, with whitespace collapsed.
+    return " ".join(label.split()).casefold()
+
+
+def convert_sections(
+    markdown: str,
+    *,
+    workdir: Path,
+    reference_doc: Path,
+    resource_paths: list[Path],
+    cache: RenderCache | None,
+    limits: RenderLimits,
+) -> BodyPackage:
+    """Convert markdown section by section and stitch the results."""
+    section_dir = workdir / "sections"
+    section_dir.mkdir(parents=True, exist_ok=True)
+    reference_digest = hashlib.sha256(reference_doc.read_bytes()).hexdigest()
+
+    outputs: list[Path] = []
+    tasks: list[RenderTask] = []
+    for idx, text in enumerate(split_markdown_sections(markdown)):
+        md_path = section_dir / f"section_{idx:04d}.md"
+        out_path = section_dir / f"section_{idx:04d}.docx"
+        outputs.append(out_path)
+        key = RenderCache.make_key(
+            pandoc_renderer_id(), reference_digest, _image_digests(text, resource_paths), text
+        )
+        if cache is not None and cache.fetch(key, out_path):
+            continue
+        md_path.write_text(text, encoding="utf-8")
+
+        def run(md_path: Path = md_path, out_path: Path = out_path, key: str = key) -> None:
+            run_pandoc_to_docx(
+                input_md=md_path, output_docx=out_path, reference_doc=reference_doc, resource_paths=resource_paths
+            )
+            if cache is not None:
+                cache.store(key, out_path)
+
+        tasks.append(RenderTask(renderer="pandoc", cost=_PANDOC_STARTUP_COST + _PANDOC_CHAR_COST * len(text), run=run))
+
+    run_render_tasks(tasks, limits=limits)
+    return stitch_sections(outputs)
+
+
+def _image_digests(text: str, resource_paths: list[Path]) -> str:
+    # Pandoc embeds local images, so their content is part of the cache key.
+    out: list[str] = []
+    for ref in dict.fromkeys(_IMAGE_REF_RE.findall(text)):
+        digest = "missing"
+        for root in resource_paths:
+            path = root / ref
+            if path.is_file():
+                digest = hashlib.sha256(path.read_bytes()).hexdigest()
+                break
+        out.append(f"{ref}={digest}")
+    return "\n".join(out)
+
+
+def stitch_sections(paths: list[Path]) -> BodyPackage:
+    """Concatenate section docx bodies, renumbering ids that would collide.
+
+    Image and hyperlink relationships, media names, footnotes, list numbering,
+    bookmarks and drawing ids are renumbered per section; styles are merged
+    by id.
+    """
+    document = body = rels = footnotes = styles = numbering = None
+    # Numbering definitions of the first section, by id, as serialized XML.
+    base_abstracts: dict[str, bytes] = {}
+    base_nums: dict[str, bytes] = {}
+    next_num = next_abstract = 0
+    style_ids: set[str] = set()
+    parts: dict[str, bytes] = {}
+    next_rel = next_note = 1
+    next_bookmark = 1
+    sect_pr = None
+    markers = False
+
+    for idx, path in enumerate(paths):
+        with zipfile.ZipFile(path, "r") as zs:
+            doc_bytes = zs.read("word/document.xml")
+            markers = markers or b"[[MD2DOCX_" in doc_bytes
+            doc = ET.fromstring(doc_bytes)
+            sec_rels = ET.fromstring(zs.read("word/_rels/document.xml.rels"))
+            sec_notes = (
+                ET.fromstring(zs.read("word/footnotes.xml")) if "word/footnotes.xml" in zs.namelist() else None
+            )
+            sec_numbering = ET.fromstring(zs.read("word/numbering.xml"))
+            sec_styles = ET.fromstring(zs.read("word/styles.xml"))
+
+            if document is None:
+                document, body = doc, doc.find("w:body", namespaces=NS)
+                sect_pr = body.find("w:sectPr", namespaces=NS)
+                if sect_pr is not None:
+                    body.remove(sect_pr)
+                content = list(body)
+                # Package-level relationships (styles, settings, ...) are kept
+                # from the first section; content ones are renumbered below.
+                rels = ET.Element(f"{{{PKG_REL_NS}}}Relationships", nsmap={None: PKG_REL_NS})
+                for rel in sec_rels:
+                    if not _is_content_rel(rel):
+                        rels.append(copy.deepcopy(rel))
+                        next_rel = max(next_rel, _rid_number(rel.get("Id")) + 1)
+                styles = sec_styles
+                numbering = sec_numbering
+                base_abstracts = {
+                    a.get(_w("abstractNumId")): ET.tostring(a)
+                    for a in numbering.findall("w:abstractNum", namespaces=NS)
+                }
+                base_nums = {n.get(_w("numId")): ET.tostring(n) for n in numbering.findall("w:num", namespaces=NS)}
+                next_abstract = max((int(a) for a in base_abstracts), default=0) + 1
+                next_num = max((int(n) for n in base_nums), default=0) + 1
+                style_ids = {s.get(_w("styleId")) for s in styles.findall("w:style", namespaces=NS)}
+                footnotes = ET.Element(_w("footnotes"), nsmap=sec_notes.nsmap if sec_notes is not None else {"w": W_NS})
+                if sec_notes is not None:
+                    for note in sec_notes.findall("w:footnote", namespaces=NS):
+                        if int(note.get(_w("id"), "0")) <= 0:
+                            footnotes.append(copy.deepcopy(note))
+            else:
+                sec_body = doc.find("w:body", namespaces=NS)
+                content = [c for c in sec_body if c.tag != _w("sectPr")]
+                for st in sec_styles.findall("w:style", namespaces=NS):
+                    if st.get(_w("styleId")) not in style_ids:
+                        style_ids.add(st.get(_w("styleId")))
+                        styles.append(st)
+
+            # Relationships and media
+            rel_map: dict[str, str] = {}
+            for rel in sec_rels:
+                if not _is_content_rel(rel):
+                    continue
+                new_id = f"rId{next_rel}"
+                next_rel += 1
+                rel_map[rel.get("Id")] = new_id
+                new_rel = copy.deepcopy(rel)
+                new_rel.set("Id", new_id)
+                if rel.get("TargetMode") is None:
+                    target = rel.get("Target") or ""
+                    new_target = f"media/s{idx:04d}_{target.rsplit('/', 1)[-1]}"
+                    parts[f"word/{new_target}"] = zs.read(f"word/{target}")
+                    new_rel.set("Target", new_target)
+                rels.append(new_rel)
+
+        # Footnotes
+        note_map: dict[str, str] = {}
+        if sec_notes is not None:
+            for note in sec_notes.findall("w:footnote", namespaces=NS):
+                old = note.get(_w("id"), "0")
+                if int(old) <= 0:
+                    continue
+                note_map[old] = str(next_note)
+                note.set(_w("id"), str(next_note))
+                next_note += 1
+                footnotes.append(note)
+
+        # List numbering: definitions identical to the first section's (the
+        # reference doc's and pandoc's fixed ones) are shared, the lists
+        # generated for this section get new ids.
+        abstract_map: dict[str, str] = {}
+        num_map: dict[str, str] = {}
+        if idx:
+            first_num = numbering.find("w:num", namespaces=NS)
+            for an in sec_numbering.findall("w:abstractNum", namespaces=NS):
+                old = an.get(_w("abstractNumId"))
+                if base_abstracts.get(old) == ET.tostring(an):
+                    continue
+                abstract_map[old] = str(next_abstract)
+                an.set(_w("abstractNumId"), str(next_abstract))
+                next_abstract += 1
+                if first_num is not None:
+                    first_num.addprevious(an)
+                else:
+                    numbering.append(an)
+            for num in sec_numbering.findall("w:num", namespaces=NS):
+                old = num.get(_w("numId"))
+                ref = num.find("w:abstractNumId", namespaces=NS)
+                if ref is not None and ref.get(_w("val")) in abstract_map:
+                    ref.set(_w("val"), abstract_map[ref.get(_w("val"))])
+                if base_nums.get(old) == ET.tostring(num):
+                    continue
+                num_map[old] = str(next_num)
+                num.set(_w("numId"), str(next_num))
+                next_num += 1
+                numbering.append(num)
+
+        bookmark_map: dict[str, str] = {}
+        for node in content:
+            for el in node.iter():
+                if not isinstance(el.tag, str):
+                    continue
+                for attr, value in el.attrib.items():
+                    if attr.startswith(f"{{{R_NS}}}") and value in rel_map:
+                        el.set(attr, rel_map[value])
+                if el.tag == _w("footnoteReference") and el.get(_w("id")) in note_map:
+                    el.set(_w("id"), note_map[el.get(_w("id"))])
+                elif el.tag == _w("numId") and el.get(_w("val")) in num_map:
+                    el.set(_w("val"), num_map[el.get(_w("val"))])
+                elif el.tag in (_w("bookmarkStart"), _w("bookmarkEnd")):
+                    raw = el.get(_w("id"), "")
+                    if raw not in bookmark_map:
+                        bookmark_map[raw] = str(next_bookmark)
+                        next_bookmark += 1
+                    el.set(_w("id"), bookmark_map[raw])
+            if idx:
+                body.append(node)
+
+    for n, docpr in enumerate(document.iter(f"{{{WP_NS}}}docPr"), start=1):
+        docpr.set("id", str(n))
+    _renumber_captions(document)
+    if sect_pr is not None:
+        body.append(sect_pr)
+
+    parts["word/styles.xml"] = _to_bytes(styles)
+    parts["word/numbering.xml"] = _to_bytes(numbering)
+    parts["word/footnotes.xml"] = _to_bytes(footnotes)
+    return BodyPackage(document=document, rels=rels, parts=parts, markers=markers)
+
+
+def _renumber_captions(document: ET._Element) -> None:
+    """Number the SEQ and REF results written by the fields filter across sections.
+
+    Each section's pandoc run numbers its captions from 1, and a REF to a
+    caption in another section has no number at all. The fields stay as
+    they are; only their cached results are rewritten in document order.
+    """
+    counts: dict[str, int] = {}
+    numbers: dict[str, str] = {}
+    refs: list[tuple[str, ET._Element]] = []
+    for instr in document.iter(_w("instrText")):
+        seq = _SEQ_INSTR_RE.match(instr.text or "")
+        if seq is None:
+            ref = _REF_INSTR_RE.match(instr.text or "")
+            if ref is not None:
+                refs.append((ref.group(1), instr))
+            continue
+        label = seq.group(1)
+        counts[label] = counts.get(label, 0) + 1
+        result = _field_result(instr)
+        if result is not None:
+            result.text = str(counts[label])
+        # The caption bookmark opens the paragraph, before the label run.
+        for prev in instr.getparent().itersiblings(preceding=True):
+            if prev.tag == _w("bookmarkStart"):
+                numbers.setdefault(prev.get(_w("name"), ""), f"{label} {counts[label]}")
+                break
+    for name, instr in refs:
+        result = _field_result(instr)
+        if result is not None and name in numbers:
+            result.text = numbers[name]
+
+
+def _field_result(instr: ET._Element) -> ET._Element | None:
+    # First w:t after the field's separate fldChar, before its end.
+    separated = False
+    for run in instr.getparent().itersiblings():
+        char = run.find("w:fldChar", namespaces=NS)
+        if char is not None:
+            if char.get(_w("fldCharType")) == "end":
+                return None
+            separated = separated or char.get(_w("fldCharType")) == "separate"
+            continue
+        t = run.find("w:t", namespaces=NS)
+        if separated and t is not None:
+            return t
+    return None
+
+
+def _w(tag: str) -> str:
+    return f"{{{W_NS}}}{tag}"
+
+
+def _to_bytes(root: ET._Element) -> bytes:
+    return ET.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+
+def _is_content_rel(rel: ET._Element) -> bool:
+    rel_type = rel.get("Type") or ""
+    return rel_type.endswith("/image") or rel_type.endswith("/hyperlink")
+
+
+def _rid_number(rid: str | None) -> int:
+    m = re.match(r"rId(\d+)$", rid or "")
+    return int(m.group(1)) if m else 0